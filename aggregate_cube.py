@@ -0,0 +1,275 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+from pathlib import Path
+import logging
+import math
+import json
+
+import numpy
+import pandas
+
+import quantile_sketch
+import background_writer
+
+# The aggregate cube keeps, for each Run Type, Run Number, Has Moved and column, the count, sum, sum of squares,
+# min, max and a quantile sketch of the values. It is built when the assays are read and the joiners merge the
+# cubes of their children, so grouped summaries (i.e. the median Volume per Run Type, moving vs not moving) are
+# answered with query_cube without reading the data. As for the sketches, the raw measurements are aggregated
+# with all the rows and the summary columns with one row per mitochondria. Runs whose name is not <type>_<number>
+# have no Run Type and Run Number columns, their cells have None (null in the json) for these dimensions
+cube_version = 1
+cube_name = "aggregate_cube.json"
+dimensions = ["Run Type", "Run Number", "Has Moved"]
+
+class CubeCell:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sketch = quantile_sketch.QuantileSketch()
+
+    def add(self, values: numpy.ndarray):
+        values = values[~numpy.isnan(values)]
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.sumsq += float(numpy.square(values).sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.sketch.add(values)
+
+    def merge(self, other: "CubeCell"):
+        self.count += other.count
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "sumsq": self.sumsq,
+            "min": self.min if self.count > 0 else None,
+            "max": self.max if self.count > 0 else None,
+            "sketch": self.sketch.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, cell_dict: dict):
+        cell = cls()
+        cell.count = cell_dict["count"]
+        cell.sum = cell_dict["sum"]
+        cell.sumsq = cell_dict["sumsq"]
+        if cell.count > 0:
+            cell.min = cell_dict["min"]
+            cell.max = cell_dict["max"]
+        cell.sketch = quantile_sketch.QuantileSketch.from_dict(cell_dict["sketch"])
+        return cell
+
+def _normalise(dimension: str, value):
+    # The values are normalised so cubes built from the csv files and from the dataframes in memory match
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if dimension == "Has Moved":
+        return str(value) in ["True", "true", "1"]
+    return str(value)
+
+def _cell_key(run_type, run_number, has_moved, column: str):
+    return (_normalise("Run Type", run_type), _normalise("Run Number", run_number), _normalise("Has Moved", has_moved), column)
+
+def _sort_key(key: tuple):
+    # The missing dimensions (None) sort first
+    return tuple("" if value is None else str(value) for value in key)
+
+# The cube is a dictionary of (Run Type, Run Number, Has Moved, column) to CubeCell
+
+def new_cube():
+    return {}
+
+def _update_columns(cube: dict, data_df: pandas.DataFrame, columns: list[str]):
+    columns = [column for column in columns if column in data_df.columns]
+    # The dimensions missing from the data are filled with None
+    missing = [dimension for dimension in dimensions if dimension not in data_df.columns]
+    if len(missing) > 0:
+        data_df = data_df.assign(**{dimension: "" for dimension in missing})
+    for (run_type, run_number, has_moved), group_df in data_df.groupby(dimensions, sort = False, dropna = False):
+        if "Run Type" in missing:
+            run_type = None
+        if "Run Number" in missing:
+            run_number = None
+        if "Has Moved" in missing:
+            has_moved = None
+        for column in columns:
+            key = _cell_key(run_type, run_number, has_moved, column)
+            if key not in cube:
+                cube[key] = CubeCell()
+            cube[key].add(group_df[column].to_numpy(dtype = float))
+
+def update_cube(
+                cube: dict,
+                run_df: pandas.DataFrame,
+                measurements: list[str],
+                summary_columns: list[str],
+                ):
+    run_df = run_df.reset_index()
+    sliced_df = run_df[~run_df.duplicated(subset = ["Run ID", "Mitochondria"], keep = 'last')]
+
+    _update_columns(cube, run_df, measurements)
+    _update_columns(cube, sliced_df, summary_columns)
+
+def merge_cube(cube: dict, other_cube: dict):
+    for key, cell in other_cube.items():
+        if key not in cube:
+            cube[key] = CubeCell()
+        cube[key].merge(cell)
+
+def save_cube(cube: dict, data_directory: Path):
+    cells = []
+    for (run_type, run_number, has_moved, column), cell in sorted(cube.items(), key = lambda item: _sort_key(item[0])):
+        cells += [{
+            "Run Type": run_type,
+            "Run Number": run_number,
+            "Has Moved": has_moved,
+            "column": column,
+            **cell.to_dict(),
+        }]
+    background_writer.write_file(data_directory/cube_name, json.dumps({"cube_version": cube_version, "cells": cells}))
+
+def load_cube(data_directory: Path, logger: logging.Logger = None):
+    cube_file = data_directory/cube_name
+    if not cube_file.is_file():
+        if logger is not None:
+            logger.warning(f"There is no aggregate cube in {data_directory}")
+        return None
+
+    with open(cube_file, 'r') as json_file:
+        cube_dict = json.load(json_file)
+    if cube_dict["cube_version"] != cube_version:
+        if logger is not None:
+            logger.warning(f"The aggregate cube in {data_directory} has an unsupported version")
+        return None
+
+    cube = new_cube()
+    for cell_dict in cube_dict["cells"]:
+        cube[_cell_key(cell_dict["Run Type"], cell_dict["Run Number"], cell_dict["Has Moved"], cell_dict["column"])] = CubeCell.from_dict(cell_dict)
+    return cube
+
+def get_cube_columns(cube: dict):
+    return sorted({key[3] for key in cube})
+
+def _check_dimensions(group_vars: list[str]):
+    for var in group_vars:
+        if var not in dimensions:
+            raise RuntimeError(f"Unknown cube dimension {var}, the dimensions are: {', '.join(dimensions)}")
+
+def _get_allowed_values(filters: dict):
+    # Maps the index of each filtered dimension to the set of values to keep
+    _check_dimensions(list(filters))
+    allowed = {}
+    for dimension, values in filters.items():
+        if not isinstance(values, (list, tuple, set)):
+            values = [values]
+        allowed[dimensions.index(dimension)] = {_normalise(dimension, value) for value in values}
+    return allowed
+
+def query_cube(
+                cube: dict,
+                group_by: list[str] = ("Run Type",),
+                columns: list[str] = None,
+                filters: dict = None,
+                quantiles: list[float] = (0.25, 0.5, 0.75),
+                ):
+    # Returns a dataframe with a row per group (of the group_by dimensions) and column, with the count, mean,
+    # standard deviation, min, max and quantiles of the values, merging the cells of the cube of each group.
+    # filters maps dimensions to a value or list of values to keep, i.e. {"Run Type": ["Ctrl", "Drug"]}
+    _check_dimensions(group_by)
+    allowed = _get_allowed_values(filters if filters is not None else {})
+
+    indices = [dimensions.index(dimension) for dimension in group_by]
+    groups = {}
+    for key, cell in cube.items():
+        if columns is not None and key[3] not in columns:
+            continue
+        if any(key[index] not in values for index, values in allowed.items()):
+            continue
+        group_key = tuple(key[index] for index in indices) + (key[3],)
+        if group_key not in groups:
+            groups[group_key] = CubeCell()
+        groups[group_key].merge(cell)
+
+    rows = []
+    for group_key, cell in sorted(groups.items(), key = lambda item: _sort_key(item[0])):
+        row = {dimension: value for dimension, value in zip(group_by, group_key[:-1])}
+        row["Column"] = group_key[-1]
+        row["Count"] = cell.count
+        row["Mean"] = cell.sum / cell.count if cell.count > 0 else math.nan
+        row["Standard Deviation"] = math.sqrt(max(cell.sumsq - cell.sum**2 / cell.count, 0) / (cell.count - 1)) if cell.count > 1 else math.nan
+        row["Min"] = cell.min if cell.count > 0 else math.nan
+        row["Max"] = cell.max if cell.count > 0 else math.nan
+        for q in quantiles:
+            row[f'P{q*100:g}'] = cell.sketch.quantile(q)
+        rows += [row]
+    return pandas.DataFrame(rows, columns = list(group_by) + ["Column", "Count", "Mean", "Standard Deviation", "Min", "Max"] + [f'P{q*100:g}' for q in quantiles])
+
+def write_cube_summary(
+                        cube: dict,
+                        data_directory: Path,
+                        ):
+    # A csv with the statistics of every cell of the cube, for reading the grouped summaries without python
+    summary_df = query_cube(cube, group_by = dimensions, quantiles = [0.05, 0.25, 0.5, 0.75, 0.95])
+    background_writer.write_output(data_directory/"cube_summary.csv", summary_df.to_csv(index = False))
+
+class CubeData:
+    # Plotting view of a cube, the box plots in utilities accept it in place of a dataframe and draw the boxes from
+    # the sketches of the cube, so they are made without reading the data
+    def __init__(
+                    self,
+                    cube: dict,
+                    filters: dict = None,
+                    ):
+        self.cube = cube
+        self.filters = filters if filters is not None else {}
+
+    def get_sketches(self, column: str, group_vars: list[str]):
+        _check_dimensions(group_vars)
+        allowed = _get_allowed_values(self.filters)
+
+        sketches = {}
+        indices = [dimensions.index(var) for var in group_vars]
+        for key, cell in self.cube.items():
+            if key[3] != column or any(key[index] not in values for index, values in allowed.items()):
+                continue
+            group_key = tuple(key[index] for index in indices)
+            if group_key not in sketches:
+                sketches[group_key] = quantile_sketch.QuantileSketch(cell.sketch.relative_accuracy, cell.sketch.min_value)
+            sketches[group_key].merge(cell.sketch)
+        return dict(sorted(sketches.items(), key = lambda item: tuple(str(value) for value in item[0])))
+
+if __name__ == "__main__":
+    raise RuntimeError("Do not try to run this file, it is not a standalone script. It contains the aggregate cube used by the other scripts")
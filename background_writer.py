@@ -0,0 +1,188 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+from pathlib import Path
+import concurrent.futures
+import threading
+import shutil
+import uuid
+import os
+
+import progress
+
+# The outputs (plot html, json and small csv files) are serialized in the main thread and handed to a background
+# writer, so the plotting and data processing do not wait for the disk (which is usually network storage).
+# A writer is opened together with each task, after handle_task in the same with statement, so it is flushed
+# (and any write error raised) before the task is marked as completed:
+#   with Tiago.handle_task(...) as Joana, background_writer.BackgroundWriter():
+# Outside of a writer the outputs are written immediately.
+# Every output is written to a temporary file next to it and renamed over it once complete, so a crashed run or a
+# concurrent reader never sees a partially written output
+# The data products (all_data.csv and its partitions) are not queued: serializing them to a single string would
+# hold them in memory twice more, so write_csv streams them to the file a chunk of rows at a time instead
+default_workers = 4
+default_max_pending_bytes = 256*1024*1024
+default_csv_chunk_rows = 100000
+
+_active_writers = []
+
+def get_temporary_path(path: Path):
+    return path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+
+def _write_file(path: Path, content: bytes):
+    temporary_file = get_temporary_path(path)
+    try:
+        with open(temporary_file, 'wb') as out_file:
+            out_file.write(content)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.replace(temporary_file, path)
+    except BaseException:
+        temporary_file.unlink(missing_ok = True)
+        raise
+    progress.count("bytes_written", len(content))
+
+class AtomicFile:
+    # For the outputs written incrementally, i.e. appended chunk by chunk: the with statement gives a temporary path
+    # to write to, which replaces the output once the with statement completes. With copy_existing the temporary
+    # file starts as a copy of the output, for appending to it
+    def __init__(
+                    self,
+                    path: Path,
+                    copy_existing: bool = False,
+                    ):
+        self.path = path
+        self.copy_existing = copy_existing
+        self.temporary_path = get_temporary_path(path)
+        self.copied_bytes = 0
+
+    def __enter__(self):
+        if self.copy_existing and self.path.exists():
+            shutil.copyfile(self.path, self.temporary_path)
+            self.copied_bytes = self.temporary_path.stat().st_size
+        return self.temporary_path
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            # Synced to disk before the rename, as the outputs written by the background writer
+            with open(self.temporary_path, 'rb') as out_file:
+                os.fsync(out_file.fileno())
+            progress.count("bytes_written", self.temporary_path.stat().st_size - self.copied_bytes)
+            os.replace(self.temporary_path, self.path)
+        else:
+            self.temporary_path.unlink(missing_ok = True)
+        return False
+
+class BackgroundWriter:
+    def __init__(
+                    self,
+                    workers: int = default_workers,
+                    max_pending_bytes: int = default_max_pending_bytes,
+                    ):
+        self.max_pending_bytes = max_pending_bytes
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "background_writer")
+        self._condition = threading.Condition()
+        self._pending_bytes = 0
+        self._futures = []
+
+    def _write(self, path: Path, content: bytes):
+        try:
+            _write_file(path, content)
+        finally:
+            with self._condition:
+                self._pending_bytes -= len(content)
+                self._condition.notify_all()
+
+    def _raise_errors(self, wait: bool):
+        futures = self._futures
+        if wait:
+            concurrent.futures.wait(futures)
+        self._futures = [future for future in futures if not future.done()]
+        for future in futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def write(self, path: Path, content):
+        if isinstance(content, str):
+            content = content.encode("utf8")
+
+        self._raise_errors(wait = False)
+
+        # Backpressure: wait while the pending outputs use too much memory, a single output larger than the limit is still accepted when nothing else is pending
+        with self._condition:
+            while self._pending_bytes > 0 and self._pending_bytes + len(content) > self.max_pending_bytes:
+                self._condition.wait()
+            self._pending_bytes += len(content)
+
+        self._futures += [self._executor.submit(self._write, path, content)]
+
+    def flush(self):
+        self._raise_errors(wait = True)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        _active_writers.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active_writers.remove(self)
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not hide the original exception behind a write error
+            try:
+                self.close()
+            except Exception:
+                pass
+        return False
+
+def write_file(path: Path, content):
+    # Write immediately, for the outputs which are read back by the task, i.e. the json files
+    if isinstance(content, str):
+        content = content.encode("utf8")
+    _write_file(path, content)
+
+def write_output(path: Path, content):
+    # Write through the innermost open writer, or immediately if there is none
+    if len(_active_writers) > 0:
+        _active_writers[-1].write(path, content)
+    else:
+        write_file(path, content)
+
+def write_csv(path: Path, data_df, **to_csv_kwargs):
+    # Write a dataframe immediately, streaming it to the file in chunks of rows
+    with AtomicFile(path) as temporary_path:
+        data_df.to_csv(temporary_path, chunksize = default_csv_chunk_rows, **to_csv_kwargs)
+
+def flush_outputs():
+    # Wait for all the pending outputs, for instance before listing the sizes of the outputs
+    for writer in _active_writers:
+        writer.flush()
+
+if __name__ == "__main__":
+    raise RuntimeError("Do not try to run this file, it is not a standalone script. It contains the background writer used by the other scripts")
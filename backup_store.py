@@ -0,0 +1,188 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+from pathlib import Path
+import logging
+import shutil
+import json
+import gzip
+import os
+
+import lip_pps_run_manager as RM
+
+import run_manifest
+import input_catalog
+import background_writer
+import run_lock
+
+# Content addressed store shared by all the runs in an output path. Each unique input file is stored once, as
+# objects/<first 2 hex digits of the sha256>/<sha256>, either as a reflink (copy on write clone) of the input when
+# the filesystem supports it or as a gzip compressed copy (<sha256>.gz) otherwise. The objects are never linked to
+# the inputs, so rewriting an input does not change them, they are read only and are never removed, as older runs
+# may still reference them. The runs reference the objects from their backup directory, with a hardlink to
+# uncompressed objects and in backup_references.json. The index of the hashes is shared by the runs, it is updated
+# under a lock
+store_directory_name = ".backup_store"
+references_name = "backup_references.json"
+index_lock_wait = 60
+
+FICLONE = 0x40049409  # ioctl request to clone a file on Linux (btrfs, xfs, ...)
+
+def _load_hash_index(store_directory: Path):
+    index_file = store_directory / "hash_index.json"
+    if not index_file.is_file():
+        return {}
+    with open(index_file, 'r') as json_file:
+        return json.load(json_file)
+
+def _save_hash_index(
+                        store_directory: Path,
+                        hash_index: dict,
+                        logger: logging.Logger = None,
+                        ):
+    # The store is shared by the runs of the output path, which may be written at the same time, so the index is
+    # reloaded under the lock and the entries saved by the other runs since it was loaded are kept
+    with run_lock.RunLock(store_directory / "hash_index.json", logger, wait = index_lock_wait):
+        saved_index = _load_hash_index(store_directory)
+        saved_index.update(hash_index)
+        background_writer.write_file(store_directory / "hash_index.json", json.dumps(saved_index))
+
+def get_file_hash(
+                    file: Path,
+                    hash_index: dict,
+                    ):
+    # The hash of an input is only recomputed if its size or modification time changed since it was last stored
+    file_stat = input_catalog.get_input_stat(file)
+    key = str(file.absolute())
+    if key in hash_index and hash_index[key][0] == file_stat.st_size and hash_index[key][1] == file_stat.st_mtime_ns:
+        return hash_index[key][2]
+
+    sha256 = run_manifest.file_sha256(file)
+    hash_index[key] = [file_stat.st_size, file_stat.st_mtime_ns, sha256]
+    return sha256
+
+def _reflink(source: Path, destination: Path):
+    try:
+        import fcntl
+    except ImportError:  # Not available outside of unix
+        return False
+
+    try:
+        with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        return True
+    except OSError:
+        if destination.exists():
+            destination.unlink()
+        return False
+
+def store_file(
+                source: Path,
+                sha256: str,
+                store_directory: Path,
+                ):
+    # Returns the path of the object holding the contents of the source, only copying the data if it is not stored yet
+    object_directory = store_directory / "objects" / sha256[:2]
+    object_path = object_directory / sha256
+    compressed_path = object_directory / f'{sha256}.gz'
+    # An object hardlinked to its input (by an older version of the store) is replaced by an independent copy
+    if object_path.is_file() and not (input_catalog.is_plain_file(source) and os.path.samefile(source, object_path)):
+        return object_path
+    if compressed_path.is_file():
+        return compressed_path
+
+    object_directory.mkdir(parents = True, exist_ok = True)
+    temporary_path = object_directory / f'{sha256}.tmp{os.getpid()}'
+    if input_catalog.is_plain_file(source) and _reflink(source, temporary_path):
+        final_path = object_path
+        temporary_path.chmod(0o444)
+    else:
+        with input_catalog.open_input(source) as in_file, gzip.open(temporary_path, 'wb') as out_file:
+            shutil.copyfileobj(in_file, out_file, 1024*1024)
+        final_path = compressed_path
+        temporary_path.chmod(0o444)
+    temporary_path.replace(final_path)
+
+    return final_path
+
+def backup_files(
+                    Tiago: RM.RunManager,
+                    file_list: list[Path],
+                    store_directory: Path,
+                    logger: logging.Logger,
+                    ):
+    # Backup the input files of a run through the shared store, returns a dictionary with the sha256 of each file
+    store_directory.mkdir(exist_ok = True)
+    backup_directory = Tiago.backup_directory
+    backup_directory.mkdir(exist_ok = True)
+
+    hash_index = _load_hash_index(store_directory)
+    references = {}
+    file_hashes = {}
+    for file in file_list:
+        sha256 = get_file_hash(file, hash_index)
+        object_path = store_file(file, sha256, store_directory)
+        file_hashes[file] = sha256
+
+        references[file.name] = {
+            "source": str(file.absolute()),
+            "size": input_catalog.get_input_stat(file).st_size,
+            "sha256": sha256,
+            "object": str(object_path.relative_to(store_directory)),
+        }
+
+        # Uncompressed objects are also made available under their original name, without using extra disk space
+        if object_path.suffix != ".gz":
+            backup_path = backup_directory / file.name
+            if backup_path.exists() or backup_path.is_symlink():
+                if backup_path.is_file() and os.path.samefile(backup_path, object_path):
+                    continue
+                backup_path.unlink()
+            try:
+                os.link(object_path, backup_path)
+            except OSError:
+                logger.info(f"Unable to hardlink {file.name} into the backup directory, it is only referenced in {references_name}")
+
+    _save_hash_index(store_directory, hash_index, logger)
+    background_writer.write_file(backup_directory / references_name, json.dumps({"store": str(store_directory.absolute()), "files": references}, indent = 2))
+
+    return file_hashes
+
+def restore_file(
+                    backup_directory: Path,
+                    file_name: str,
+                    destination: Path,
+                    ):
+    # Recover an input file of a run from the store, regardless of how the object is stored
+    with open(backup_directory / references_name, 'r') as json_file:
+        references = json.load(json_file)
+    object_path = Path(references["store"]) / references["files"][file_name]["object"]
+
+    if object_path.suffix == ".gz":
+        with gzip.open(object_path, 'rb') as in_file, open(destination, 'wb') as out_file:
+            shutil.copyfileobj(in_file, out_file, 1024*1024)
+    else:
+        shutil.copyfile(object_path, destination)
+
+if __name__ == "__main__":
+    raise RuntimeError("Do not try to run this file, it is not a standalone script. It contains the backup store used by the other scripts")
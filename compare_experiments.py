@@ -23,14 +23,68 @@
 from pathlib import Path
 import logging
 import pandas
-import pickle
+import numpy
 
 import lip_pps_run_manager as RM
 
 import utilities
+import background_writer
+import run_lock
+import preview
+import progress
+import dashboard
+import plot_spec
+import plot_pool
+import input_catalog
+import motility
+import run_type_statistics
+import quantile_sketch
+import aggregate_cube
+import run_manifest
+import streaming_summary
 
 from process_all_assays import script_main as process_all_assays
 
+def get_assay_runs(
+                    data_directory: Path,
+                    partitions: list[dict] = None,
+                    ):
+    if partitions is None:
+        partitions = utilities.list_partitions(data_directory)
+    if partitions is not None:
+        # The partition values are strings, the run numbers are converted as pandas does when reading the data
+        runs = set(partition["Run Number"] for partition in partitions)
+        if all(run.lstrip("-").isdigit() for run in runs):
+            return sorted(int(run) for run in runs)
+        return sorted(runs)
+    return sorted(pandas.read_csv(data_directory/"all_data.csv", usecols=["Run Number"])["Run Number"].unique())
+
+def iter_assay_data(
+                    data_directory: Path,
+                    partitions: list[dict] = None,
+                    ):
+    # Yields the run number, the data and the sliced data (a single row with the summary values for each
+    # mitochondria) of each assay, visiting every row only once
+    if partitions is None:
+        partitions = utilities.list_partitions(data_directory)
+    if partitions is not None:
+        # The partitions are only listed once, each assay only reads its own partitions
+        for run in get_assay_runs(data_directory, partitions):
+            run_df = utilities.read_partitioned_data(data_directory, {"Run Number": run}, partitions)
+            yield run, run_df, run_df[~run_df.duplicated(subset=["Run Type", "Mitochondria"], keep='last')]
+    else:
+        # Runs joined without partitions: sort once by run and walk the contiguous blocks of each run
+        full_df = pandas.read_csv(data_directory/"all_data.csv")
+        progress.count_read(len(full_df), data_directory/"all_data.csv")
+        full_df.sort_values("Run Number", kind="stable", inplace=True, ignore_index=True)
+        summary_mask = ~full_df.duplicated(subset=["Run Number", "Run Type", "Mitochondria"], keep='last').to_numpy()
+
+        run_numbers = full_df["Run Number"].to_numpy()
+        boundaries = [0] + (numpy.flatnonzero(run_numbers[1:] != run_numbers[:-1]) + 1).tolist() + [len(full_df)]
+        for start, stop in zip(boundaries[:-1], boundaries[1:]):
+            run_df = full_df.iloc[start:stop]
+            yield run_numbers[start], run_df, run_df[summary_mask[start:stop]]
+
 def compare_individual_assays_task(
                         Zacarias: RM.RunManager,
                         logger: logging.Logger,
@@ -40,25 +94,16 @@ def compare_individual_assays_task(
     if not Zacarias.task_completed("join_experiments"):
         raise RuntimeError("Only call the plotter task after the joiner task has successfully completed")
 
-    with open(Zacarias.data_directory/"all_measurements.pkl", 'rb') as pickle_file:
-        all_measurements = pickle.load(pickle_file)
+    all_measurements = run_manifest.load_measurements(Zacarias.data_directory, logger)
 
-    full_df = pandas.read_csv(Zacarias.data_directory/"all_data.csv")
-    runs = sorted(full_df["Run Number"].unique())
+    partitions = utilities.list_partitions(Zacarias.data_directory)
+    runs = get_assay_runs(Zacarias.data_directory, partitions)
 
-    with Zacarias.handle_task(task_name, drop_old_data=True, loop_iterations = len(runs)) as Rembrandt:
-        for run in runs:
+    with Zacarias.handle_task(task_name, drop_old_data=True, loop_iterations = len(runs)) as Rembrandt, progress.TaskProgress(Rembrandt, len(runs)), background_writer.BackgroundWriter(), plot_spec.PlotLevel("compare_assays"):
+        for run, run_df, sliced_df in iter_assay_data(Zacarias.data_directory, partitions):
             output_dir = Rembrandt.task_path / f'assay_{run}'
             output_dir.mkdir(exist_ok = True)
 
-            run_df : pandas.DataFrame = full_df.loc[full_df["Run Number"] == run]
-
-            # Get sliced df with a single value for each of the summary values
-            run_df.set_index(["Run Type", "Mitochondria"], inplace=True)
-            sliced_df = run_df[~run_df.index.duplicated(keep='last')]
-            sliced_df.reset_index(inplace=True)
-            run_df.reset_index(inplace=True)
-
             for measurement in all_measurements:
                 utilities.make_histogram_plot(
                     data_df = sliced_df,
@@ -202,21 +247,24 @@ def compare_individual_assays_task(
 
             Rembrandt.loop_tick()
 
+        dashboard.write_dashboard(Rembrandt.task_path, Rembrandt.run_name, all_measurements)
 
-def summarise_experiments_task(
+
+def compare_run_types_task(
                         Zacarias: RM.RunManager,
                         logger: logging.Logger,
-                        marginal_type: str = "rug",
-                        task_name: str = "plot_summary",
+                        n_resamples: int = 10000,
+                        confidence: float = 0.95,
+                        workers: int = None,
+                        task_name: str = "compare_run_types",
                         ):
     if not Zacarias.task_completed("join_experiments"):
-        raise RuntimeError("Only call the plotter task after the joiner task has successfully completed")
+        raise RuntimeError("Only call the statistics task after the joiner task has successfully completed")
 
-    with open(Zacarias.data_directory/"all_measurements.pkl", 'rb') as pickle_file:
-        all_measurements = pickle.load(pickle_file)
+    all_measurements = run_manifest.load_measurements(Zacarias.data_directory, logger)
 
-    with Zacarias.handle_task(task_name, drop_old_data=True, loop_iterations = len(all_measurements)) as Picasso:
-        full_df = pandas.read_csv(Picasso.data_directory/"all_data.csv")
+    with Zacarias.handle_task(task_name, drop_old_data=True) as Pascal, progress.TaskProgress(Pascal), background_writer.BackgroundWriter():
+        full_df = utilities.read_partitioned_data(Pascal.data_directory)
 
         # Get sliced df with a single value for each of the summary values
         full_df.set_index(["Run ID", "Mitochondria"], inplace=True)
@@ -224,8 +272,69 @@ def summarise_experiments_task(
         sliced_df.reset_index(inplace=True)
         full_df.reset_index(inplace=True)
 
+        summary_columns = []
+        for column in utilities.get_summary_columns(all_measurements):
+            if column in sliced_df.columns:
+                summary_columns += [column]
+
+        results_df = run_type_statistics.compare_run_types(
+            full_df = full_df,
+            sliced_df = sliced_df,
+            measurement_columns = all_measurements,
+            summary_columns = summary_columns,
+            n_resamples = n_resamples,
+            confidence = confidence,
+            workers = workers,
+        )
+
+        if len(results_df) == 0:
+            logger.warning("There are not enough Run Types to compare")
+        background_writer.write_output(Pascal.data_directory/"run_type_comparison.csv", results_df.to_csv(index=False))
+        run_manifest.update_outputs(Pascal.data_directory)
+
+def summarise_experiments_task(
+                        Zacarias: RM.RunManager,
+                        logger: logging.Logger,
+                        marginal_type: str = "rug",
+                        task_name: str = "plot_summary",
+                        memory_budget: float = None,
+                        plot_workers: int = plot_pool.default_plot_workers,
+                        ):
+    if not Zacarias.task_completed("join_experiments"):
+        raise RuntimeError("Only call the plotter task after the joiner task has successfully completed")
+
+    all_measurements = run_manifest.load_measurements(Zacarias.data_directory, logger)
+
+    with Zacarias.handle_task(task_name, drop_old_data=True, loop_iterations = len(all_measurements)) as Picasso, progress.TaskProgress(Picasso, len(all_measurements)), background_writer.BackgroundWriter(), plot_spec.PlotLevel("experiments"), plot_pool.PlotPool(plot_workers) as plotter:
+        chunk_rows = streaming_summary.get_chunk_rows(Picasso.data_directory, memory_budget)
+        if chunk_rows is None:
+            full_df = utilities.read_partitioned_data(Picasso.data_directory)
+
+            # Get sliced df with a single value for each of the summary values
+            full_df.set_index(["Run ID", "Mitochondria"], inplace=True)
+            sliced_df = full_df[~full_df.index.duplicated(keep='last')]
+            sliced_df.reset_index(inplace=True)
+            full_df.reset_index(inplace=True)
+        else:
+            # The joined data does not fit in memory, it is summarised in chunks and the plots are made from the summaries
+            logger.info(f"The joined data does not fit in the memory budget, summarising it in chunks of {chunk_rows} rows")
+            full_df, sliced_df = streaming_summary.stream_summary_data(
+                Picasso.data_directory,
+                all_measurements,
+                utilities.get_summary_columns(all_measurements),
+                chunk_rows,
+                logger,
+            )
+
+        # With plot_workers, the plots are made by worker processes sharing the data of the task
+        plotter.share([full_df, sliced_df])
+
+        # The boxes per Run Type, moving vs not moving, are drawn from the aggregate cube
+        cube = aggregate_cube.load_cube(Picasso.data_directory, logger)
+        cube_data = aggregate_cube.CubeData(cube) if cube is not None else None
+
         for measurement in all_measurements:
-            utilities.make_histogram_plot(
+            plotter.make_histogram_plot(
                 data_df = sliced_df,
                 x_var = f'{measurement} Mean',
                 base_path = Picasso.task_path,
@@ -238,7 +347,7 @@ def summarise_experiments_task(
                 group_var = "Run Type",
             )
 
-            utilities.make_histogram_plot(
+            plotter.make_histogram_plot(
                 data_df = sliced_df,
                 x_var = f'{measurement} Median',
                 base_path = Picasso.task_path,
@@ -251,7 +360,7 @@ def summarise_experiments_task(
                 group_var = "Run Type",
             )
 
-            utilities.make_histogram_plot(
+            plotter.make_histogram_plot(
                 data_df = sliced_df,
                 x_var = f'{measurement} Standard Deviation',
                 base_path = Picasso.task_path,
@@ -264,7 +373,7 @@ def summarise_experiments_task(
                 group_var = "Run Type",
             )
 
-            utilities.make_histogram_plot(
+            plotter.make_histogram_plot(
                 data_df = full_df,
                 x_var = f'{measurement}',
                 base_path = Picasso.task_path,
@@ -277,7 +386,7 @@ def summarise_experiments_task(
                 group_var = "Run Type",
             )
 
-            utilities.make_histogram_plot(
+            plotter.make_histogram_plot(
                 data_df = full_df,
                 x_var = f'{measurement}',
                 base_path = Picasso.task_path,
@@ -291,8 +400,36 @@ def summarise_experiments_task(
                 pattern_shape_var = "Has Moved",
             )
 
+            if cube_data is not None:
+                plotter.make_box_plot(
+                    data_df = cube_data,
+                    x_var = f'{measurement}',
+                    base_path = Picasso.task_path,
+                    file_name = f'{measurement}_movement',
+                    run_name = Picasso.run_name,
+                    x_label = utilities.measurement_to_label(measurement),
+                    group_var = "Run Type",
+                    pattern_shape_var = "Has Moved",
+                )
+
             Picasso.loop_tick()
 
+        for column in motility.get_motility_columns(all_measurements):
+            if column not in sliced_df.columns:
+                continue
+            plotter.make_histogram_plot(
+                data_df = sliced_df,
+                x_var = column,
+                base_path = Picasso.task_path,
+                file_name = column.replace(" ", "_"),
+                run_name = Picasso.run_name,
+                nbins = 100,
+                logy = True,
+                x_label = motility.motility_labels[column],
+                marginal_type = marginal_type,
+                group_var = "Run Type",
+            )
+
         mean_measurements = []
         median_measurements = []
         std_measurements = []
@@ -315,7 +452,7 @@ def summarise_experiments_task(
             median_labels[median_measurement] = label
             std_labels[std_measurement]       = label
 
-        utilities.make_multiscatter_plot(
+        plotter.make_multiscatter_plot(
             data_df = sliced_df,
             run_name = Picasso.run_name,
             base_path = Picasso.task_path,
@@ -325,7 +462,7 @@ def summarise_experiments_task(
             color_var = "Run Type",
             opacity = 0.5,
         )
-        utilities.make_multiscatter_plot(
+        plotter.make_multiscatter_plot(
             data_df = sliced_df,
             run_name = Picasso.run_name,
             base_path = Picasso.task_path,
@@ -335,7 +472,7 @@ def summarise_experiments_task(
             color_var = "Run Type",
             opacity = 0.5,
         )
-        utilities.make_multiscatter_plot(
+        plotter.make_multiscatter_plot(
             data_df = sliced_df,
             run_name = Picasso.run_name,
             base_path = Picasso.task_path,
@@ -345,7 +482,7 @@ def summarise_experiments_task(
             color_var = "Run Type",
             opacity = 0.5,
         )
-        utilities.make_multiscatter_plot(
+        plotter.make_multiscatter_plot(
             data_df = full_df,
             run_name = Picasso.run_name,
             base_path = Picasso.task_path,
@@ -355,7 +492,7 @@ def summarise_experiments_task(
             color_var = "Run Type",
             opacity = 0.5,
         )
-        utilities.make_multiscatter_plot(
+        plotter.make_multiscatter_plot(
             data_df = full_df,
             run_name = Picasso.run_name,
             base_path = Picasso.task_path,
@@ -367,6 +504,9 @@ def summarise_experiments_task(
             opacity = 0.5,
         )
 
+        plotter.wait()
+        dashboard.write_dashboard(Picasso.task_path, Picasso.run_name, all_measurements)
+
 def join_experiment_data(
                     Zacarias: RM.RunManager,
                     experiment_list: list[str],
@@ -375,32 +515,49 @@ def join_experiment_data(
     if not Zacarias.task_completed("read_experiments"):
         raise RuntimeError("Only call the joiner task after the read experiments task has successfully completed")
 
-    with Zacarias.handle_task("join_experiments", drop_old_data=True, loop_iterations = len(experiment_list)) as Martin:
+    with Zacarias.handle_task("join_experiments", drop_old_data=True, loop_iterations = len(experiment_list)) as Martin, progress.TaskProgress(Martin, len(experiment_list)), background_writer.BackgroundWriter():
         merged_df = None
-        merged_measurements = None
+        merged_sketches = quantile_sketch.new_sketches()
+        merged_cube = aggregate_cube.new_cube()
+        merged_description = None
+        run_ids = []
+        inputs = []
 
+        experiment_directories = []
         for experiment in experiment_list:
             experiment_run_dir = Martin.path_directory.parent / experiment
             Bob = RM.RunManager(experiment_run_dir)
             if not Bob.task_completed("join_assays"):
                 logger.error(f"The join assays task has not completed for experiment {experiment}")
                 continue
+            experiment_directories += [Bob.data_directory]
+
+        # Plan the join from the manifests of the experiments, before reading their data
+        join_plan = run_manifest.plan_join(experiment_directories, logger)
+        merged_measurements = join_plan["measurements"]
+        if join_plan["rows"] is not None:
+            logger.info(f"Joining {join_plan['rows']} rows from {len(experiment_directories)} experiments, needing about {join_plan['memory']/1024/1024:.1f} MB")
 
-            experiment_df = pandas.read_csv(Bob.data_directory / "all_data.csv")
+        for experiment_directory in experiment_directories:
+            experiment_df = utilities.read_partitioned_data(experiment_directory)
 
-            with open(Bob.data_directory/"all_measurements.pkl", 'rb') as pickle_file:
-                experiment_measurements = pickle.load(pickle_file)
+            experiment_description, experiment_run_ids, experiment_input = run_manifest.describe_child(experiment_directory, experiment_df, logger)
+            merged_description = run_manifest.merge_descriptions(merged_description, experiment_description)
+            run_ids += experiment_run_ids
+            inputs += [experiment_input]
+
+            experiment_sketches = quantile_sketch.load_sketches(experiment_directory, logger)
+            if experiment_sketches is not None:
+                quantile_sketch.merge_sketches(merged_sketches, experiment_sketches)
+
+            experiment_cube = aggregate_cube.load_cube(experiment_directory, logger)
+            if experiment_cube is not None:
+                aggregate_cube.merge_cube(merged_cube, experiment_cube)
 
             if merged_df is None:
                 merged_df = experiment_df
-                merged_measurements = experiment_measurements
             else:
                 merged_df = pandas.concat([merged_df, experiment_df])
-                previous_measurements = merged_measurements
-                merged_measurements = []
-                for measurement in previous_measurements:
-                    if measurement in experiment_measurements:
-                        merged_measurements += [measurement]
 
             Martin.loop_tick()
 
@@ -409,10 +566,24 @@ def join_experiment_data(
 
         if not Martin.data_directory.exists():
             Martin.data_directory.mkdir()
-        merged_df.to_csv(Martin.data_directory/"all_data.csv")
-
-        with open(Martin.data_directory/"all_measurements.pkl", 'wb') as pickle_file:
-            pickle.dump(merged_measurements, pickle_file)
+        utilities.write_partitions(merged_df, Martin.data_directory)
+        # The runs joined by older versions also hold the joined data in all_data.csv
+        (Martin.data_directory/"all_data.csv").unlink(missing_ok = True)
+
+        quantile_sketch.save_sketches(merged_sketches, Martin.data_directory)
+        quantile_sketch.write_quantile_summary(merged_sketches, Martin.data_directory)
+        aggregate_cube.save_cube(merged_cube, Martin.data_directory)
+        aggregate_cube.write_cube_summary(merged_cube, Martin.data_directory)
+
+        run_manifest.write_manifest(
+            data_directory = Martin.data_directory,
+            run_name = Martin.run_name,
+            level = "experiments",
+            measurements = merged_measurements,
+            description = merged_description,
+            run_ids = run_ids,
+            inputs = inputs,
+        )
 
 def read_experiments_task(
                     Zacarias: RM.RunManager,
@@ -420,25 +591,28 @@ def read_experiments_task(
                     logger: logging.Logger,
                     marginal_type: str = "rug",
                     disable_plots: bool = False,
+                    memory_budget: float = None,
+                    plot_workers: int = plot_pool.default_plot_workers,
                     ):
-    dir_list = []
-    for dir_path in mitometer_path.iterdir():
-        if dir_path.is_dir():
-            dir_list += [dir_path]
-    del dir_path
+    # Scan the whole input tree once, the catalog of each experiment is handed down to the lower levels
+    catalog = input_catalog.build_catalog(mitometer_path, depth = 2, cache_directory = Zacarias.path_directory.parent, logger = logger)
+    dir_list = catalog["directories"]
 
-    with Zacarias.handle_task("read_experiments", drop_old_data=True, loop_iterations = len(dir_list)) as Harry:
+    with Zacarias.handle_task("read_experiments", drop_old_data=True, loop_iterations = len(dir_list)) as Harry, progress.TaskProgress(Harry, len(dir_list)):
         run_list = []
-        for dir_path in dir_list:
+        for dir_node in dir_list:
             process_all_assays(
-                mitometer_path = dir_path,
-                run_name = f'processed_{dir_path.name}',
+                mitometer_path = Path(dir_node["path"]),
+                run_name = f'processed_{dir_node["name"]}',
                 output_path = Zacarias.path_directory.parent,
                 marginal_type = marginal_type,
                 disable_plots = disable_plots,
+                memory_budget = memory_budget,
+                catalog = dir_node,
+                plot_workers = plot_workers,
             )
 
-            run_list += [f'processed_{dir_path.name}']
+            run_list += [f'processed_{dir_node["name"]}']
             Harry.loop_tick()
 
         run_list.sort()
@@ -452,10 +626,15 @@ def script_main(
                 marginal_type: str = "rug",
                 disable_plots: bool = False,
                 compare_individual: bool = False,
+                memory_budget: float = None,
+                compare_statistics: bool = False,
+                n_resamples: int = 10000,
+                workers: int = None,
+                plot_workers: int = plot_pool.default_plot_workers,
                 ):
     logger = logging.getLogger('compare_experiments')
 
-    with RM.RunManager(output_path / run_name) as Zacarias:
+    with run_lock.RunLock(output_path / run_name, logger), RM.RunManager(output_path / run_name) as Zacarias:
         Zacarias.create_run(raise_error=False)
 
         run_list = read_experiments_task(
@@ -464,6 +643,8 @@ def script_main(
                          logger = logger,
                          marginal_type = marginal_type,
                          disable_plots = disable_plots,
+                         memory_budget = memory_budget,
+                         plot_workers = plot_workers,
                          )
 
         join_experiment_data(
@@ -477,6 +658,8 @@ def script_main(
                 Zacarias = Zacarias,
                 logger = logger,
                 marginal_type = marginal_type,
+                memory_budget = memory_budget,
+                plot_workers = plot_workers,
             )
 
         if compare_individual:
@@ -487,6 +670,14 @@ def script_main(
             )
             pass
 
+        if compare_statistics:
+            compare_run_types_task(
+                Zacarias = Zacarias,
+                logger = logger,
+                n_resamples = n_resamples,
+                workers = workers,
+            )
+
 if __name__ == "__main__":
     import argparse
 
@@ -530,6 +721,37 @@ if __name__ == "__main__":
         action = 'store_true',
         dest = 'compare_individual',
     )
+    parser.add_argument(
+        '-s',
+        '--compareStatistics',
+        help = 'If set, the Run Types are compared with statistical tests and bootstrap confidence intervals for every measurement and summary column',
+        action = 'store_true',
+        dest = 'compare_statistics',
+    )
+    parser.add_argument(
+        '--bootstrapResamples',
+        metavar = 'N',
+        type = int,
+        help = 'Number of bootstrap resamples used for the confidence intervals of the statistical comparison. Default: 10000',
+        default = 10000,
+        dest = 'n_resamples',
+    )
+    parser.add_argument(
+        '--workers',
+        metavar = 'N',
+        type = int,
+        help = 'Number of worker processes used to parallelise the statistical comparison. Default: the number of CPUs',
+        default = None,
+        dest = 'workers',
+    )
+    parser.add_argument(
+        '--plotWorkers',
+        metavar = 'N',
+        type = int,
+        help = 'Number of worker processes making the summary plots of the joined data, which share the data through memory mapped files instead of copying it. Default: 0, the plots are made in the main process',
+        default = plot_pool.default_plot_workers,
+        dest = 'plot_workers',
+    )
     parser.add_argument(
         '--marginalType',
         metavar = 'TYPE',
@@ -546,6 +768,60 @@ if __name__ == "__main__":
         action = 'store_true',
         dest = 'disable_plots',
     )
+    parser.add_argument(
+        '--memoryBudget',
+        metavar = 'MB',
+        type = float,
+        help = 'If set, the measurement files of each assay are read in chunks of mitochondria and written to disk incrementally, keeping the memory used while reading below roughly this many MB. The summary plots of joined data larger than this are made from histograms, quantile sketches and a random sample accumulated while reading the data in chunks',
+        default = None,
+        dest = 'memory_budget',
+    )
+    parser.add_argument(
+        '--preview',
+        metavar = 'N',
+        type = int,
+        help = 'If set, only a random sample of N mitochondria of each assay is read, the same in all the measurement files of the assay, for a quick look at the results. The outputs are labelled as a preview',
+        default = None,
+        dest = 'preview_rows',
+    )
+    parser.add_argument(
+        '--previewSeed',
+        metavar = 'SEED',
+        type = int,
+        help = 'Seed of the random sample of the mitochondria with --preview, the same seed samples the same mitochondria. Default: 0',
+        default = 0,
+        dest = 'preview_seed',
+    )
+    parser.add_argument(
+        '--progressInterval',
+        metavar = 'SECONDS',
+        type = float,
+        help = 'If set, a structured log line with the throughput (rows parsed, MB read, figures rendered and MB written per second) and the estimated time remaining of the running task and of the whole run is logged every SECONDS seconds, whatever the log level',
+        default = None,
+        dest = 'progress_interval',
+    )
+    parser.add_argument(
+        '--plotSpec',
+        metavar = 'PATH',
+        type = Path,
+        help = 'Path to a json plot spec selecting the measurements, statistics, groupings and kinds of the plots made at each level. Default: all the plots are made',
+        default = None,
+        dest = 'plot_spec',
+    )
+    parser.add_argument(
+        '--offlinePlots',
+        help = 'If set, the plots load plotly.js from a copy written in the output directory instead of from the internet',
+        action = 'store_true',
+        dest = 'offline_plots',
+    )
+    parser.add_argument(
+        '--mathjaxPath',
+        metavar = 'PATH',
+        type = Path,
+        help = 'Path to the MathJax.js file of a local MathJax installation, used by the plots with --offlinePlots. Without it the LaTeX in the plot labels is not rendered offline',
+        default = None,
+        dest = 'mathjax_path',
+    )
     parser.add_argument(
         '-l',
         '--log-level',
@@ -593,8 +869,38 @@ if __name__ == "__main__":
         exit(1)
     output_path = output_path.absolute()
 
+    if args.plot_spec is not None:
+        if not args.plot_spec.is_file():
+            logging.error("You must define a valid plot spec path")
+            exit(1)
+        try:
+            plot_spec.load_plot_spec(args.plot_spec)
+        except RuntimeError as error:
+            logging.error(f"You must define a valid plot spec: {error}")
+            exit(1)
+
+    if args.offline_plots:
+        mathjax_path: Path = args.mathjax_path
+        if mathjax_path is not None and not mathjax_path.is_file():
+            logging.error("You must define a valid MathJax path")
+            exit(1)
+        utilities.setup_offline_plot_assets(output_path, logging.getLogger("plot_assets"), mathjax_path)
+
     marginal_type: str = args.marginal_type
     if marginal_type == "None":
         marginal_type = None
 
-    script_main(mitometer_path, args.run_name, output_path, marginal_type, args.disable_plots, args.compare_individual)
\ No newline at end of file
+    if args.preview_rows is not None:
+        if args.preview_rows <= 0:
+            logging.error("You must define a positive number of mitochondria to preview")
+            exit(1)
+        preview.set_preview(args.preview_rows, args.preview_seed)
+        logging.warning(preview.get_preview_label())
+
+    if args.progress_interval is not None:
+        if args.progress_interval <= 0:
+            logging.error("You must define a positive progress interval")
+            exit(1)
+        progress.set_report_interval(args.progress_interval)
+
+    script_main(mitometer_path, args.run_name, output_path, marginal_type, args.disable_plots, args.compare_individual, args.memory_budget, args.compare_statistics, args.n_resamples, args.workers, args.plot_workers)
\ No newline at end of file
@@ -0,0 +1,136 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+from pathlib import Path
+import html
+import urllib.parse
+
+import background_writer
+import preview
+
+# The dashboard is an index.html in the task directory listing all the plots of the task, grouped by directory
+# and measurement. Each plot is an iframe whose source is only set when it scrolls close to the view, so opening
+# the dashboard of a large run does not load all the plots at once
+dashboard_name = "index.html"
+
+_page_template = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; margin: 0 2em; }}
+nav {{ position: sticky; top: 0; background: white; padding: 0.5em 0; border-bottom: 1px solid #ccc; z-index: 1; }}
+nav a {{ margin-right: 1em; }}
+figure {{ margin: 1em 0; }}
+figcaption {{ font-weight: bold; }}
+iframe {{ width: 100%; height: 520px; border: 1px solid #eee; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+{notice}<nav>{navigation}</nav>
+{sections}
+<script>
+const frames = document.querySelectorAll("iframe[data-src]");
+function load(frame) {{
+    frame.src = frame.dataset.src;
+    frame.removeAttribute("data-src");
+}}
+if ("IntersectionObserver" in window) {{
+    const observer = new IntersectionObserver(function(entries) {{
+        for (const entry of entries) {{
+            if (entry.isIntersecting) {{
+                observer.unobserve(entry.target);
+                load(entry.target);
+            }}
+        }}
+    }}, {{ rootMargin: "500px 0px" }});
+    frames.forEach(function(frame) {{ observer.observe(frame); }});
+}} else {{
+    frames.forEach(load);
+}}
+</script>
+</body>
+</html>
+"""
+
+def get_plot_group(file_stem: str, measurements: list[str]):
+    # Returns the measurement and the statistic of a plot from its file name (i.e. Volume_mean_histogram -> Volume, mean_histogram)
+    for measurement in sorted(measurements, key = len, reverse = True):
+        if file_stem.startswith(f'{measurement}_'):
+            return measurement, file_stem[len(measurement)+1:]
+    return "Other", file_stem
+
+def list_plots(task_path: Path, measurements: list[str]):
+    # Returns {section: {measurement: [(statistic, relative path)]}}, with a section for each subdirectory with plots
+    sections = {}
+    for file in sorted(task_path.rglob("*.html")):
+        if file.name == dashboard_name:
+            continue
+        relative_path = file.relative_to(task_path)
+        section = relative_path.parent.as_posix() if relative_path.parent != Path(".") else ""
+        measurement, statistic = get_plot_group(file.stem, measurements)
+        sections.setdefault(section, {}).setdefault(measurement, []).append((statistic, relative_path.as_posix()))
+    return sections
+
+def write_dashboard(
+                    task_path: Path,
+                    run_name: str,
+                    measurements: list[str],
+                    ):
+    # The plots may still be pending in the background writer
+    background_writer.flush_outputs()
+
+    sections = list_plots(task_path, measurements)
+
+    navigation = []
+    section_html = []
+    for section in sorted(sections):
+        groups = sections[section]
+        for measurement in sorted(groups, key = lambda measurement: (measurement == "Other", measurement)):
+            anchor = urllib.parse.quote(f'{section}/{measurement}' if section != "" else measurement)
+            heading = f'{section} - {measurement}' if section != "" else measurement
+            navigation += [f'<a href="#{anchor}">{html.escape(heading)}</a>']
+
+            figures = []
+            for statistic, relative_path in sorted(groups[measurement]):
+                source = html.escape(urllib.parse.quote(relative_path))
+                figures += [
+                    f'<figure><figcaption>{html.escape(statistic)} <a href="{source}" target="_blank">(open)</a></figcaption>'
+                    f'<iframe data-src="{source}" title="{html.escape(statistic)}"></iframe></figure>'
+                ]
+            section_html += [f'<section id="{anchor}"><h2>{html.escape(heading)}</h2>\n' + "\n".join(figures) + '\n</section>']
+
+    background_writer.write_output(
+        task_path/dashboard_name,
+        _page_template.format(
+            title = html.escape(f'{run_name} - {task_path.name}' + (" (preview)" if preview.get_preview() is not None else "")),
+            notice = f'<p><strong>{html.escape(preview.get_preview_label())}</strong></p>\n' if preview.get_preview() is not None else "",
+            navigation = "\n".join(navigation),
+            sections = "\n".join(section_html),
+        ),
+    )
+
+if __name__ == "__main__":
+    raise RuntimeError("Do not try to run this file, it is not a standalone script. It contains the plot dashboard used by the other scripts")
@@ -0,0 +1,353 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+from pathlib import Path, PurePosixPath
+import logging
+import threading
+import tempfile
+import hashlib
+import tarfile
+import zipfile
+import atexit
+import shutil
+import gzip
+import json
+import io
+import os
+
+import background_writer
+import progress
+
+# The catalog describes the input tree (experiments -> assays -> measurement files) as nested nodes, one per
+# directory, with the files in the directory and the subdirectories. It is built once with os.scandir, cached
+# on disk and the nodes are handed down to the scripts processing each level
+# Archives are handled as if they were directories, the files inside them have paths below the path of the
+# archive (i.e. experiment/assay.zip/file.txt) which are opened with open_input
+# Zip archives are read in place. Tar archives can not be read at random (a compressed tar has to be decompressed
+# from the start up to each member), so the first time a member of a tar is opened the whole tar is read once, in
+# order, and extracted to a temporary directory, from which the members are then opened. The temporary directories
+# are removed when the process exits
+catalog_version = 3
+
+archive_suffixes = [".zip", ".tar", ".tar.gz", ".tgz"]
+measurement_suffixes = [".txt", ".txt.gz"]
+
+def is_archive(file_name: str):
+    return any(file_name.endswith(suffix) for suffix in archive_suffixes)
+
+def is_measurement_file(file_name: str):
+    return any(file_name.endswith(suffix) for suffix in measurement_suffixes)
+
+def strip_archive_suffix(file_name: str):
+    for suffix in archive_suffixes:
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)]
+    return file_name
+
+def parse_measurement_name(file_name: str):
+    if file_name.endswith(".txt.gz"):
+        file_name = file_name[:-3]
+    measurement_index = file_name.find(".tif_")
+    if measurement_index >= 0:
+        return file_name[measurement_index+5:-4]
+    return file_name
+
+def find_archive(path: Path):
+    # Returns the archive containing the path and the name of the member inside the archive, or None if the path is a regular file
+    for parent in path.parents:
+        if is_archive(parent.name) and parent.is_file():
+            return parent, path.relative_to(parent).as_posix()
+    return None, None
+
+def is_plain_file(path: Path):
+    return not path.name.endswith(".gz") and find_archive(path)[0] is None
+
+class _ArchiveMember(io.RawIOBase):
+    # A file inside an archive, the archive is closed together with the file
+    def __init__(self, archive, member_file):
+        self._archive = archive
+        self._member_file = member_file
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self._member_file.readinto(buffer)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._member_file.close()
+            finally:
+                self._archive.close()
+        super().close()
+
+_extracted_tars = {}
+_extracted_lock = threading.Lock()
+
+def _remove_extracted_tars():
+    with _extracted_lock:
+        for directory in _extracted_tars.values():
+            shutil.rmtree(directory, ignore_errors = True)
+        _extracted_tars.clear()
+
+atexit.register(_remove_extracted_tars)
+
+def _is_safe_member(name: str):
+    parts = PurePosixPath(name).parts
+    return len(parts) > 0 and not PurePosixPath(name).is_absolute() and ".." not in parts
+
+def _extract_tar(archive_path: Path):
+    # Returns the temporary directory where the tar is extracted, reading the tar in a single streamed pass the first time
+    archive_stat = os.stat(archive_path)
+    key = (str(archive_path.absolute()), archive_stat.st_mtime_ns, archive_stat.st_size)
+    with _extracted_lock:
+        if key not in _extracted_tars:
+            directory = Path(tempfile.mkdtemp(prefix = "mitonalysis_archive_"))
+            try:
+                with tarfile.open(archive_path, 'r|*') as archive:
+                    for member in archive:
+                        if not member.isfile() or not _is_safe_member(member.name):
+                            continue
+                        member_path = directory / member.name
+                        member_path.parent.mkdir(parents = True, exist_ok = True)
+                        with archive.extractfile(member) as in_file, open(member_path, 'wb') as out_file:
+                            shutil.copyfileobj(in_file, out_file, 1024*1024)
+            except BaseException:
+                shutil.rmtree(directory, ignore_errors = True)
+                raise
+            _extracted_tars[key] = directory
+        return _extracted_tars[key]
+
+def open_input(path: Path):
+    # Open an input file for reading in binary mode, decompressing it while it is read
+    archive_path, member = find_archive(path)
+    if archive_path is not None:
+        if archive_path.name.endswith(".zip"):
+            archive = zipfile.ZipFile(archive_path)
+            return progress.counting_input(_ArchiveMember(archive, archive.open(member)))
+        return progress.counting_input(open(_extract_tar(archive_path) / member, 'rb'))
+    if path.name.endswith(".gz"):
+        return progress.counting_input(gzip.open(path, 'rb'))
+    return progress.counting_input(open(path, 'rb'))
+
+def get_input_stat(path: Path):
+    # Stat of the file on disk holding the input, i.e. the archive for the files inside archives
+    archive_path, _ = find_archive(path)
+    if archive_path is not None:
+        return os.stat(archive_path)
+    return os.stat(path)
+
+def list_archive(archive_path: Path):
+    if archive_path.name.endswith(".zip"):
+        with zipfile.ZipFile(archive_path) as archive:
+            return [(info.filename, info.file_size) for info in archive.infolist() if not info.is_dir()]
+    with tarfile.open(archive_path, 'r|*') as archive:
+        return [(member.name, member.size) for member in archive if member.isfile() and _is_safe_member(member.name)]
+
+def _archive_node(
+                    name: str,
+                    path: PurePosixPath,
+                    tree: dict,
+                    depth: int,
+                    archive_path: Path,
+                    mtime_ns: int,
+                    ):
+    node = {
+        "name": name,
+        "path": str(path),
+        "mtime_ns": mtime_ns,
+        "archive": str(archive_path),
+        "files": [],
+        "directories": [],
+    }
+    for file_name in sorted(tree["files"]):
+        node["files"] += [{
+            "name": file_name,
+            "measurement": parse_measurement_name(file_name),
+            "size": tree["files"][file_name],
+            "mtime_ns": mtime_ns,
+        }]
+    if depth > 0:
+        for directory_name in sorted(tree["directories"]):
+            node["directories"] += [_archive_node(directory_name, path / directory_name, tree["directories"][directory_name], depth - 1, archive_path, mtime_ns)]
+    return node
+
+def scan_archive(
+                    archive_path: Path,
+                    depth: int,
+                    ):
+    tree = {"files": {}, "directories": {}}
+    for member, size in list_archive(archive_path):
+        parts = PurePosixPath(member).parts
+        subtree = tree
+        for part in parts[:-1]:
+            subtree = subtree["directories"].setdefault(part, {"files": {}, "directories": {}})
+        subtree["files"][parts[-1]] = size
+
+    # Archives often hold a single top directory named as the archive (i.e. Ctrl.tar.gz holding Ctrl/1/...), it is
+    # skipped so the archive replaces it. Only that directory is skipped, the levels below it are the assays
+    name = strip_archive_suffix(archive_path.name)
+    path = archive_path
+    if len(tree["files"]) == 0 and list(tree["directories"]) == [name]:
+        tree = tree["directories"][name]
+        path = path / name
+
+    return _archive_node(name, path, tree, depth, archive_path, os.stat(archive_path).st_mtime_ns)
+
+def _scan_or_reuse_archive(
+                            archive_path: Path,
+                            depth: int,
+                            cached_node: dict = None,
+                            ):
+    if cached_node is not None and cached_node.get("archive") == str(archive_path) and cached_node["mtime_ns"] == os.stat(archive_path).st_mtime_ns:
+        return cached_node
+    return scan_archive(archive_path, depth)
+
+def _add_archive(
+                    node: dict,
+                    path: Path,
+                    archive_node: dict,
+                    depth: int,
+                    ):
+    # Archives are subdirectories, except when scanning the files of an assay where the files inside are added to the assay
+    if depth > 0:
+        node["directories"] += [archive_node]
+    else:
+        for file in archive_node["files"]:
+            file = dict(file)
+            file["name"] = (Path(archive_node["path"]) / file["name"]).relative_to(path).as_posix()
+            node["files"] += [file]
+
+def scan_directory(
+                    path: Path,
+                    depth: int,
+                    cached_node: dict = None,
+                    skip_unreadable_archives: bool = False,
+                    logger: logging.Logger = None,
+                    verify_files: bool = False,
+                    ):
+    # With skip_unreadable_archives, the archives which can not be listed (i.e. still being written) are left out
+    directory_stat = os.stat(path)
+    node = {
+        "name": path.name,
+        "path": str(path),
+        "mtime_ns": directory_stat.st_mtime_ns,
+        "files": [],
+        "directories": [],
+    }
+
+    # Adding, removing or renaming entries changes the mtime of the directory, so the entries of a directory with the
+    # same mtime as in the cache are reused without listing it, only its subdirectories are checked (the exports are
+    # written once). A file rewritten in place (same name) does not change the mtime of its directory and is not
+    # noticed, the stale size and mtime in the catalog are not used for anything else: the inputs are stat'ed again
+    # when they are hashed and backed up. With verify_files (i.e. while watching files being copied) every directory
+    # is listed and the cached entry of a file is only reused if its size and mtime match
+    cached_files = {}
+    cached_directories = {}
+    if cached_node is not None:
+        cached_files = {file["name"]: file for file in cached_node["files"]}
+        cached_directories = {directory["name"]: directory for directory in cached_node["directories"]}
+
+    if cached_node is not None and not verify_files and cached_node["mtime_ns"] == node["mtime_ns"]:
+        node["files"] = cached_node["files"]
+        if depth > 0:
+            for name in sorted(cached_directories):
+                cached_directory = cached_directories[name]
+                if "archive" in cached_directory:
+                    node["directories"] += [_scan_or_reuse_archive(Path(cached_directory["archive"]), depth - 1, cached_directory)]
+                else:
+                    node["directories"] += [scan_directory(path / name, depth - 1, cached_directory, skip_unreadable_archives, logger, verify_files)]
+        return node
+
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file() and is_archive(entry.name):
+                try:
+                    archive_node = _scan_or_reuse_archive(Path(entry.path), max(depth - 1, 0), cached_directories.get(strip_archive_suffix(entry.name)))
+                except (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError):
+                    if not skip_unreadable_archives:
+                        raise
+                    if logger is not None:
+                        logger.debug(f"Skipping the archive {entry.path}, it can not be listed")
+                    continue
+                _add_archive(node, path, archive_node, depth)
+            elif entry.is_file():
+                entry_stat = entry.stat()
+                cached_file = cached_files.get(entry.name)
+                if cached_file is not None and cached_file["size"] == entry_stat.st_size and cached_file["mtime_ns"] == entry_stat.st_mtime_ns:
+                    node["files"] += [cached_file]
+                    continue
+                node["files"] += [{
+                    "name": entry.name,
+                    "measurement": parse_measurement_name(entry.name),
+                    "size": entry_stat.st_size,
+                    "mtime_ns": entry_stat.st_mtime_ns,
+                }]
+            elif entry.is_dir() and depth > 0:
+                node["directories"] += [scan_directory(Path(entry.path), depth - 1, cached_directories.get(entry.name), skip_unreadable_archives, logger, verify_files)]
+
+    node["files"].sort(key = lambda file: file["name"])
+    node["directories"].sort(key = lambda directory: directory["name"])
+    return node
+
+def get_cache_file(root: Path, cache_directory: Path):
+    root_hash = hashlib.sha1(str(root.absolute()).encode("utf8")).hexdigest()[:16]
+    return cache_directory / f'.mitometer_catalog_{root_hash}.json'
+
+def build_catalog(
+                    root: Path,
+                    depth: int,
+                    cache_directory: Path = None,
+                    logger: logging.Logger = None,
+                    skip_unreadable_archives: bool = False,
+                    verify_files: bool = False,
+                    ):
+    # Depth is the number of directory levels below the root to scan, 0 for an assay, 1 for an experiment and 2 for a comparison
+    cached_node = None
+    cache_file = None
+    if cache_directory is not None:
+        cache_file = get_cache_file(root, cache_directory)
+        if cache_file.is_file():
+            try:
+                with open(cache_file, 'r') as json_file:
+                    cache = json.load(json_file)
+                if cache["catalog_version"] == catalog_version and cache["depth"] == depth:
+                    cached_node = cache["root"]
+            except (json.JSONDecodeError, KeyError):
+                if logger is not None:
+                    logger.warning(f"Ignoring the corrupted catalog cache {cache_file}")
+
+    node = scan_directory(root.absolute(), depth, cached_node, skip_unreadable_archives, logger, verify_files)
+
+    if cache_file is not None:
+        background_writer.write_file(cache_file, json.dumps({"catalog_version": catalog_version, "depth": depth, "root": node}))
+
+    return node
+
+def get_file_paths(node: dict):
+    # The measurement files of the node, loose, compressed or inside archives
+    return [Path(node["path"]) / file["name"] for file in node["files"] if is_measurement_file(file["name"])]
+
+if __name__ == "__main__":
+    raise RuntimeError("Do not try to run this file, it is not a standalone script. It contains the input catalog used by the other scripts")
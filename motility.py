@@ -0,0 +1,143 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+import numpy
+import pandas
+
+# Measurements for which a motility analysis is done while reading the mitometer files
+# The exports only hold the magnitude of the displacement of each mitochondria, not its position or the direction
+# of the displacement, so a mean squared displacement of the positions can not be computed. The mean squared
+# increment of the displacement magnitude, <(|d|(t + lag) - |d|(t))^2>, is computed instead and its first lags are
+# fitted as an MSD would be. It is labelled as such, it is not the MSD of the positions
+increment_measurement = "displacement"
+vacf_measurement = "velocity"
+
+motility_labels = {
+    f"{increment_measurement} Mean Squared Increment Coefficient": r"$\text{Mean Squared Increment of the Displacement Magnitude / (2 lag) }[\mu m^2/frame]$",
+    f"{increment_measurement} Mean Squared Increment Exponent": r"$\text{Mean Squared Increment Exponent of the Displacement Magnitude } \alpha$",
+    f"{vacf_measurement} Autocorrelation": r"$\text{Velocity Autocorrelation at lag 1}$",
+}
+
+def get_motility_columns(all_measurements: list[str]):
+    columns = []
+    for column in motility_labels:
+        if column.split(" ")[0] in all_measurements:
+            columns += [column]
+    return columns
+
+def masked_cross_correlation(
+                                a: numpy.ndarray,
+                                b: numpy.ndarray,
+                                ):
+    # Computes sum_t a[:, t] * b[:, t + lag] for every lag in [0, frames) and every row at once,
+    # zero padding to avoid the circular wrap around of the FFT
+    frames = a.shape[1]
+    fft_size = 1 << (2 * frames - 1).bit_length()
+
+    a_fft = numpy.fft.rfft(a, n = fft_size, axis = 1)
+    b_fft = numpy.fft.rfft(b, n = fft_size, axis = 1)
+
+    return numpy.fft.irfft(numpy.conj(a_fft) * b_fft, n = fft_size, axis = 1)[:, :frames]
+
+def compute_mean_squared_increment(values: numpy.ndarray):
+    # values is a (tracks, frames) array with NaN for the frames where the mitochondria was not found
+    # Returns the time averaged mean squared increment of the values for each track and lag, NaN for lags without
+    # any valid pair of frames
+    mask = (~numpy.isnan(values)).astype(float)
+    positions = numpy.nan_to_num(values) * mask
+    squares = positions * positions
+
+    pair_count = numpy.rint(masked_cross_correlation(mask, mask))
+    lagged_squares = masked_cross_correlation(mask, squares)
+    leading_squares = masked_cross_correlation(squares, mask)
+    products = masked_cross_correlation(positions, positions)
+
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        increments = (lagged_squares + leading_squares - 2 * products) / pair_count
+    increments[pair_count < 1] = numpy.nan
+    # Clip the rounding errors of the FFT
+    increments[increments < 0] = 0
+
+    return increments
+
+def compute_vacf(values: numpy.ndarray):
+    # Normalised velocity autocorrelation for each track and lag, NaN for lags without any valid pair of frames
+    mask = (~numpy.isnan(values)).astype(float)
+    velocities = numpy.nan_to_num(values) * mask
+
+    pair_count = numpy.rint(masked_cross_correlation(mask, mask))
+    products = masked_cross_correlation(velocities, velocities)
+
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        vacf = products / pair_count
+        vacf = vacf / vacf[:, :1]
+    vacf[pair_count < 1] = numpy.nan
+
+    return vacf
+
+def fit_mean_squared_increment(
+                                increments: numpy.ndarray,
+                                fit_lags: int = 4,
+                                ):
+    # Fits the first lags of the mean squared increment of each track, returning the coefficient of a linear fit
+    # through the origin (increment = 2 C lag, as the diffusion coefficient of an MSD) and the exponent of a power law fit
+    lags = numpy.arange(1, min(fit_lags, increments.shape[1] - 1) + 1, dtype = float)
+    fit_increments = increments[:, 1:len(lags) + 1]
+    valid = ~numpy.isnan(fit_increments)
+
+    lag_values = numpy.where(valid, lags, 0)
+    increment_values = numpy.where(valid, fit_increments, 0)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        coefficient = (lag_values * increment_values).sum(axis = 1) / (lag_values * lag_values).sum(axis = 1) / 2
+
+        log_valid = valid & (increment_values > 0)
+        log_lags = numpy.where(log_valid, numpy.log(lags), 0)
+        log_increments = numpy.log(numpy.where(log_valid, increment_values, 1))
+        points = log_valid.sum(axis = 1)
+        centered_lags = numpy.where(log_valid, log_lags - log_lags.sum(axis = 1, keepdims = True) / points[:, None], 0)
+        centered_increments = numpy.where(log_valid, log_increments - log_increments.sum(axis = 1, keepdims = True) / points[:, None], 0)
+        exponent = (centered_lags * centered_increments).sum(axis = 1) / (centered_lags * centered_lags).sum(axis = 1)
+    exponent[points < 2] = numpy.nan
+
+    return coefficient, exponent
+
+def motility_summary(
+                        file_df: pandas.DataFrame,
+                        measurement_name: str,
+                        fit_lags: int = 4,
+                        ):
+    # Returns the per mitochondria motility summary columns for the measurement, empty if there are none
+    summary_df = pandas.DataFrame(index = file_df.index)
+    values = file_df.to_numpy(dtype = float)
+
+    if measurement_name == increment_measurement:
+        coefficient, exponent = fit_mean_squared_increment(compute_mean_squared_increment(values), fit_lags = fit_lags)
+        summary_df[f'{measurement_name} Mean Squared Increment Coefficient'] = coefficient
+        summary_df[f'{measurement_name} Mean Squared Increment Exponent'] = exponent
+    elif measurement_name == vacf_measurement and values.shape[1] > 1:
+        summary_df[f'{measurement_name} Autocorrelation'] = compute_vacf(values)[:, 1]
+
+    return summary_df
+
+if __name__ == "__main__":
+    raise RuntimeError("Do not try to run this file, it is not a standalone script. It contains the motility analysis used by the other scripts")
@@ -0,0 +1,248 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+from pathlib import Path
+import concurrent.futures
+import multiprocessing
+import contextlib
+import tempfile
+import shutil
+import uuid
+
+import numpy
+import pandas
+
+import background_writer
+import utilities
+import plot_spec
+import preview
+import progress
+
+# Pool of worker processes making the plots of a summary task in parallel. Sending the data of the task to every
+# worker (pickling it with each plot) costs more than making the plots, so the dataframes are written once to a
+# memory mapped file (in /dev/shm, so in memory, when it exists) and the workers map the file and build zero copy
+# views of the columns. The numeric columns are mapped as they are, the other columns (i.e. Run ID) are stored
+# as integer codes and rebuilt from their few distinct values. The tasks call the make_*_plot functions of
+# utilities through the pool, with the shared dataframes as data_df:
+#   with plot_pool.PlotPool(workers) as plotter:
+#       plotter.share([full_df, sliced_df])
+#       plotter.make_histogram_plot(data_df = full_df, ...)
+# Without workers, or for data which is not a dataframe, the plots are made in the main process.
+# Memory mapped files are used rather than multiprocessing.shared_memory, as the resource tracker of python < 3.13
+# unlinks the shared memory when the first worker attaching to it exits
+# The workers are spawned, not forked: a forked worker would inherit the background writers of the task (and their
+# threads), so its figures would only be queued on a copy of the writer which is never flushed. The workers write
+# their outputs themselves, before the plot is reported as done
+default_plot_workers = 0
+shared_memory_directory = Path("/dev/shm")
+
+_attached_frames = {}
+
+def share_frame(data_df: pandas.DataFrame, directory: Path):
+    # Writes the columns of data_df to a file in directory, returns the description of the file for attach_frame
+    columns = []
+    arrays = []
+    offset = 0
+    for column in data_df.columns:
+        series = data_df[column]
+        if isinstance(series.dtype, numpy.dtype) and series.dtype.kind in "biuf":
+            array = series.to_numpy()
+            column_description = {"name": column, "dtype": array.dtype.str}
+        else:
+            codes, uniques = pandas.factorize(series)
+            array = codes.astype(numpy.int32)
+            column_description = {"name": column, "dtype": array.dtype.str, "categories": list(uniques), "original_dtype": str(series.dtype)}
+        # Keep each column aligned for its dtype
+        offset = -(-offset // 8) * 8
+        column_description["offset"] = offset
+        columns += [column_description]
+        arrays += [(offset, array)]
+        offset += array.nbytes
+
+    path = directory / f'{uuid.uuid4().hex}.frame'
+    mapped = numpy.memmap(path, dtype = numpy.uint8, mode = 'w+', shape = (max(offset, 1),))
+    for offset, array in arrays:
+        mapped[offset:offset + array.nbytes] = numpy.ascontiguousarray(array).view(numpy.uint8)
+    mapped.flush()
+    del mapped
+
+    return {"path": str(path), "rows": len(data_df), "columns": columns}
+
+def attach_frame(description: dict):
+    # Returns a dataframe over the file written by share_frame, mapping the file only once per process
+    if description["path"] in _attached_frames:
+        return _attached_frames[description["path"]]
+
+    data = {}
+    rows = description["rows"]
+    for column in description["columns"]:
+        dtype = numpy.dtype(column["dtype"])
+        if rows == 0:
+            array = numpy.empty(0, dtype = dtype)
+        else:
+            array = numpy.memmap(description["path"], dtype = dtype, mode = 'r', offset = column["offset"], shape = (rows,))
+        if "categories" in column:
+            data[column["name"]] = pandas.Categorical.from_codes(numpy.asarray(array), column["categories"]).astype(column["original_dtype"])
+        else:
+            data[column["name"]] = array
+    data_df = pandas.DataFrame(data, copy = False)
+    _attached_frames[description["path"]] = data_df
+    return data_df
+
+def _init_worker():
+    # Nothing is written through the background writers or counted in the tasks of the main process from a worker
+    background_writer._active_writers.clear()
+    progress._active_counters.clear()
+
+def _make_plot(
+                function_name: str,
+                arguments: dict,
+                frames: dict,
+                plot_assets: dict,
+                spec: dict,
+                level: str,
+                preview_settings: dict,
+                ):
+    # Runs in the worker processes, the arguments referring to a shared dataframe are replaced by its view
+    import work_queue
+
+    work_queue.set_plot_assets(plot_assets)
+    plot_spec.set_plot_spec(spec)
+    if preview_settings is None:
+        preview.set_preview(None)
+    else:
+        preview.set_preview(preview_settings["rows"], preview_settings["seed"])
+    for key, value in arguments.items():
+        if isinstance(value, dict) and "shared_frame" in value:
+            arguments[key] = attach_frame(frames[value["shared_frame"]])
+
+    # The work done in the worker is counted in the task of the main process
+    with progress.ProgressCounters() as counters, plot_spec.PlotLevel(level) if level is not None else contextlib.nullcontext():
+        getattr(utilities, function_name)(**arguments)
+    return counters.get_totals()
+
+class PlotPool:
+    def __init__(
+                    self,
+                    workers: int = default_plot_workers,
+                    ):
+        self.workers = workers
+        self._frames = {}
+        self._directory = None
+        self._executor = None
+        self._futures = []
+
+    def share(self, data_frames: list):
+        # Shares the dataframes with the workers, anything else (i.e. streamed data) is plotted in the main process
+        data_frames = [data_df for data_df in data_frames if isinstance(data_df, pandas.DataFrame)]
+        if self.workers is None or self.workers <= 0 or len(data_frames) == 0:
+            return
+
+        parent_directory = shared_memory_directory if shared_memory_directory.is_dir() else None
+        self._directory = Path(tempfile.mkdtemp(prefix = "mitonalysis_plots_", dir = parent_directory))
+        for data_df in data_frames:
+            self._frames[id(data_df)] = (data_df, share_frame(data_df, self._directory))
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers = self.workers,
+            mp_context = multiprocessing.get_context("spawn"),
+            initializer = _init_worker,
+        )
+
+    def _submit(self, function_name: str, arguments: dict):
+        import work_queue
+
+        frames = {}
+        for key, value in arguments.items():
+            if id(value) in self._frames and self._frames[id(value)][0] is value:
+                frames[str(id(value))] = self._frames[id(value)][1]
+                arguments[key] = {"shared_frame": str(id(value))}
+
+        # Plots of data which is not shared are made in the main process
+        if len(frames) == 0:
+            getattr(utilities, function_name)(**arguments)
+            return
+
+        self._raise_errors(wait = False)
+        self._futures += [self._executor.submit(
+            _make_plot,
+            function_name,
+            arguments,
+            frames,
+            work_queue.get_plot_assets(),
+            plot_spec.get_plot_spec(),
+            plot_spec.get_plot_level(),
+            preview.get_preview(),
+        )]
+
+    def __getattr__(self, name: str):
+        if not name.startswith("make_"):
+            raise AttributeError(name)
+        if self._executor is None:
+            return getattr(utilities, name)
+        return lambda **arguments: self._submit(name, arguments)
+
+    def _raise_errors(self, wait: bool):
+        futures = self._futures
+        if wait:
+            concurrent.futures.wait(futures)
+        self._futures = [future for future in futures if not future.done()]
+        for future in futures:
+            if future.done() and future.exception() is None:
+                progress.add_counts(future.result())
+        for future in futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def wait(self):
+        # Waits for all the submitted plots, for instance before making the dashboard of the task
+        self._raise_errors(wait = True)
+
+    def close(self):
+        try:
+            if self._executor is not None:
+                self.wait()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures = True)
+                self._executor = None
+            if self._directory is not None:
+                shutil.rmtree(self._directory, ignore_errors = True)
+                self._directory = None
+            self._frames = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not hide the original exception behind a plotting error
+            try:
+                self.close()
+            except Exception:
+                pass
+        return False
+
+if __name__ == "__main__":
+    raise RuntimeError("Do not try to run this file, it is not a standalone script. It contains the plotting worker processes used by the other scripts")
@@ -0,0 +1,445 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+from pathlib import Path
+import logging
+import functools
+import threading
+import tempfile
+import html
+import urllib.parse
+import http.server
+import time
+import os
+
+import motility
+import utilities
+import run_manifest
+import streaming_summary
+
+# Local server rendering the plots of the runs in an output directory when they are requested, so the scripts can
+# be run with -d and the plots browsed afterwards. The data of each run is summarised once into the binned
+# histograms, quantile sketches and random sample of streaming_summary (reading it in chunks, so runs larger than
+# the memory can be served) and every plot is made from these with the same make_*_plot functions as the scripts.
+# The rendered plots are kept in an LRU cache. Any other path is served as a file from the output directory, so the
+# plots and dashboards which were made by the scripts can be browsed as well. The runs are listed again every
+# rescan interval (and when an unknown run is requested), so the runs written while the server runs are served too.
+# With offline plots, the rendered plots load plotly.js from the copy in the output directory and MathJax from the
+# local installation, served under /mathjax/
+default_port = 8050
+default_cache_size = 128
+default_chunk_rows = 100000
+default_rescan_interval = 10
+mathjax_url_prefix = "/mathjax/"
+
+kinds = ["histogram", "pdf", "box", "violin", "scatter_matrix"]
+group_vars = ["Run Type", "Run ID", "Has Moved"]
+
+_index_template = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; margin: 0 2em; }}
+td, th {{ padding: 0.2em 0.6em; text-align: left; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+{body}
+</body>
+</html>
+"""
+
+def find_runs(output_path: Path):
+    # The runs with data under output_path, by their path relative to it. The hidden directories (i.e. the backup
+    # store) and the partitions of the runs are not descended into
+    runs = {}
+    for directory, directory_names, file_names in os.walk(output_path):
+        has_data = "all_data.csv" in file_names or "partitions" in directory_names
+        directory_names[:] = sorted(name for name in directory_names if not name.startswith(".") and name not in ["partitions", utilities.plot_assets_directory_name])
+        data_directory = Path(directory)
+        if run_manifest.manifest_name not in file_names or not has_data:
+            continue
+        run_path = data_directory.parent if data_directory.name == "data" else data_directory
+        runs[run_path.relative_to(output_path).as_posix()] = data_directory
+    return dict(sorted(runs.items()))
+
+class PlotRenderer:
+    def __init__(
+                    self,
+                    output_path: Path,
+                    logger: logging.Logger,
+                    cache_size: int = default_cache_size,
+                    chunk_rows: int = default_chunk_rows,
+                    rescan_interval: float = default_rescan_interval,
+                    ):
+        self.output_path = output_path
+        self.logger = logger
+        self.chunk_rows = chunk_rows
+        self.rescan_interval = rescan_interval
+        self._runs = find_runs(output_path)
+        self._scan_time = time.monotonic()
+        self._runs_lock = threading.Lock()
+        self._summaries = {}
+        self._lock = threading.Lock()
+        self.render = functools.lru_cache(maxsize = cache_size)(self._render)
+
+    def get_runs(self, rescan: bool = False):
+        with self._runs_lock:
+            if rescan or time.monotonic() - self._scan_time > self.rescan_interval:
+                self._runs = find_runs(self.output_path)
+                self._scan_time = time.monotonic()
+            return self._runs
+
+    def get_data_directory(self, run: str):
+        runs = self.get_runs()
+        if run not in runs:
+            runs = self.get_runs(rescan = True)
+        if run not in runs:
+            raise RuntimeError(f"Unknown run {run}")
+        return runs[run]
+
+    def get_summary(self, run: str):
+        # Returns the measurements and the StreamedData of all the rows and of one row per mitochondria of the run,
+        # summarised again if the data changed since it was last summarised
+        data_directory = self.get_data_directory(run)
+        data_stats = [data_file.stat() for data_file in utilities.get_data_files(data_directory)]
+        version = tuple((data_stat.st_mtime_ns, data_stat.st_size) for data_stat in data_stats)
+        with self._lock:
+            if run not in self._summaries or self._summaries[run][0] != version:
+                self.logger.info(f"Summarising the data of run {run}")
+                measurements = run_manifest.load_measurements(data_directory, self.logger)
+                full_data, sliced_data = streaming_summary.stream_summary_data(
+                    data_directory,
+                    measurements,
+                    utilities.get_summary_columns(measurements),
+                    self.chunk_rows,
+                    self.logger,
+                )
+                self._summaries[run] = (version, measurements, full_data, sliced_data)
+            return self._summaries[run]
+
+    def _render(
+                self,
+                run: str,
+                version: tuple,
+                kind: str,
+                variables: tuple[str],
+                group_var: str = None,
+                pattern_shape_var: str = None,
+                logy: bool = False,
+                ):
+        # version is only part of the arguments so the cached plots of data which changed are not reused
+        _, measurements, full_data, sliced_data = self.get_summary(run)
+        summary_columns = utilities.get_summary_columns(measurements)
+        data = sliced_data if all(variable in summary_columns for variable in variables) else full_data
+        for variable in variables:
+            if variable not in data.columns:
+                raise RuntimeError(f"There is no variable {variable} in run {run}")
+
+        x_var = variables[0]
+        x_label = motility.motility_labels.get(x_var)
+        if x_label is None:
+            x_label = utilities.measurement_to_label(x_var.split(" ")[0])
+
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            base_path = Path(temporary_directory)
+            arguments = dict(
+                data_df = data,
+                x_var = x_var,
+                base_path = base_path,
+                file_name = "plot",
+                run_name = run,
+                group_var = group_var,
+                full_html = True,
+                x_label = x_label,
+                pattern_shape_var = pattern_shape_var,
+            )
+            if kind in ["histogram", "pdf"]:
+                utilities.make_histogram_plot_type_choice(
+                    hist_type = "count" if kind == "histogram" else "pdf",
+                    logy = logy,
+                    **arguments,
+                )
+            elif kind == "box":
+                utilities.make_box_plot(**arguments)
+            elif kind == "violin":
+                utilities.make_violin_plot(**arguments)
+            elif kind == "scatter_matrix":
+                utilities.make_multiscatter_plot(
+                    data_df = data,
+                    run_name = run,
+                    base_path = base_path,
+                    dimensions = list(variables),
+                    color_var = group_var,
+                    symbol_var = pattern_shape_var,
+                    full_html = True,
+                    file_name = "plot",
+                )
+            else:
+                raise RuntimeError(f"Unknown plot kind {kind}, the kinds are: {', '.join(kinds)}")
+
+            plot_files = list(base_path.glob("*.html"))
+            if len(plot_files) == 0:
+                raise RuntimeError(f"No plot was made for {kind} of {', '.join(variables)}")
+            return plot_files[0].read_bytes()
+
+    def render_plot(self, run: str, query: dict):
+        self.get_data_directory(run)
+        kind = query.get("kind", "histogram")
+        variables = tuple(query["x"].split(",")) if "x" in query else ()
+        if len(variables) == 0:
+            raise RuntimeError("The variable to plot must be given with x=")
+
+        def get_group(key: str):
+            value = query.get(key, "")
+            if value == "":
+                return None
+            if value not in group_vars:
+                raise RuntimeError(f"Unknown grouping {value}, the groupings are: {', '.join(group_vars)}")
+            return value
+
+        version, _, _, _ = self.get_summary(run)
+        return self.render(
+            run,
+            version,
+            kind,
+            variables,
+            get_group("group"),
+            get_group("pattern"),
+            query.get("logy", "0") == "1",
+        )
+
+    def get_index_page(self):
+        rows = []
+        for run in self.get_runs():
+            link = html.escape(f'/run?{urllib.parse.urlencode({"run": run})}')
+            rows += [f'<li><a href="{link}">{html.escape(run)}</a></li>']
+        return _index_template.format(title = html.escape(f'Runs in {self.output_path}'), body = "<ul>\n" + "\n".join(rows) + "\n</ul>")
+
+    def get_run_page(self, run: str):
+        measurements = run_manifest.load_measurements(self.get_data_directory(run), self.logger)
+
+        def link(text: str, **query):
+            url = "/plot?" + urllib.parse.urlencode({"run": run, **query})
+            return f'<a href="{html.escape(url)}" target="_blank">{html.escape(text)}</a>'
+
+        rows = []
+        for measurement in measurements:
+            for variable in [measurement] + [f'{measurement} {statistic}' for statistic in ["Mean", "Median", "Standard Deviation"]]:
+                cells = [f'<td>{html.escape(variable)}</td>']
+                for kind in ["histogram", "pdf", "box", "violin"]:
+                    cells += [
+                        '<td>' + " ".join([
+                            link(kind, kind = kind, x = variable, logy = "1" if kind == "histogram" else "0"),
+                            link("by type", kind = kind, x = variable, group = "Run Type", logy = "1" if kind == "histogram" else "0"),
+                            link("moved", kind = kind, x = variable, group = "Run Type", pattern = "Has Moved", logy = "1" if kind == "histogram" else "0"),
+                        ]) + '</td>'
+                    ]
+                rows += ['<tr>' + "".join(cells) + '</tr>']
+        for statistic in ["Mean", "Median", "Standard Deviation"]:
+            rows += [f'<tr><td>{html.escape(statistic)} scatter matrix</td><td colspan="4">' + link("by type", kind = "scatter_matrix", x = ",".join(f'{measurement} {statistic}' for measurement in measurements), group = "Run Type") + '</td></tr>']
+
+        body = '<table>\n<tr><th>Variable</th><th>Histogram</th><th>PDF</th><th>Box</th><th>Violin</th></tr>\n' + "\n".join(rows) + '\n</table>'
+        body += f'\n<p>Plots are made on request from a summary of the data, any of the groupings {", ".join(group_vars)} can be given in the url with group= and pattern=</p>'
+        return _index_template.format(title = html.escape(run), body = body)
+
+class PlotRequestHandler(http.server.SimpleHTTPRequestHandler):
+    renderer: PlotRenderer = None
+    mathjax_directory: Path = None
+
+    def translate_path(self, path: str):
+        # The files of the local MathJax installation are served from its directory
+        url_path = urllib.parse.unquote(urllib.parse.urlsplit(path).path)
+        if self.mathjax_directory is not None and url_path.startswith(mathjax_url_prefix):
+            file_path = (self.mathjax_directory / url_path[len(mathjax_url_prefix):]).resolve()
+            if file_path.is_relative_to(self.mathjax_directory):
+                return str(file_path)
+            return str(self.mathjax_directory / "not_found")
+        return super().translate_path(path)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory = str(self.renderer.output_path), **kwargs)
+
+    def send_content(self, content: bytes, content_type: str = "text/html; charset=utf-8"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            if url.path == "/":
+                self.send_content(self.renderer.get_index_page().encode())
+            elif url.path == "/run":
+                self.send_content(self.renderer.get_run_page(query.get("run", "")).encode())
+            elif url.path == "/plot":
+                self.send_content(self.renderer.render_plot(query.get("run", ""), query))
+            else:
+                super().do_GET()
+        except RuntimeError as error:
+            self.send_error(400, str(error))
+
+    def log_message(self, format, *args):
+        self.renderer.logger.info("%s - %s" % (self.address_string(), format % args))
+
+def serve(
+            output_path: Path,
+            logger: logging.Logger,
+            port: int = default_port,
+            cache_size: int = default_cache_size,
+            chunk_rows: int = default_chunk_rows,
+            rescan_interval: float = default_rescan_interval,
+            offline_plots: bool = False,
+            mathjax_path: Path = None,
+            ):
+    renderer = PlotRenderer(output_path, logger, cache_size, chunk_rows, rescan_interval)
+    mathjax_directory = None
+    if offline_plots:
+        # The rendered plots are served from /plot, so the assets are referenced by their url on the server
+        utilities.setup_offline_plot_assets(output_path, logger, mathjax_path)
+        utilities.plot_assets["plotlyjs"] = "/" + utilities.plot_assets["plotlyjs"].relative_to(output_path).as_posix()
+        if mathjax_path is not None:
+            mathjax_directory = mathjax_path.absolute().parent
+            utilities.plot_assets["mathjax"] = mathjax_url_prefix + urllib.parse.quote(mathjax_path.name)
+    handler = type("Handler", (PlotRequestHandler,), {"renderer": renderer, "mathjax_directory": mathjax_directory})
+    with http.server.ThreadingHTTPServer(("127.0.0.1", port), handler) as server:
+        logger.warning(f"Serving the plots of {len(renderer.get_runs())} runs in {output_path} at http://127.0.0.1:{server.server_address[1]}/")
+        server.serve_forever()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+                    prog='plot_server.py',
+                    description='This script serves the runs in an output directory on localhost, making their plots when they are requested',
+                    #epilog='Text at the bottom of help'
+                    )
+
+    parser.add_argument(
+        '-o',
+        '--outputDirectory',
+        metavar = 'PATH',
+        type = Path,
+        help = 'Path to the output directory of the scripts, or to a single run',
+        required = True,
+        dest = 'output_path',
+    )
+    parser.add_argument(
+        '-p',
+        '--port',
+        metavar = 'PORT',
+        type = int,
+        help = 'Port on localhost to serve the plots on. Default: 8050',
+        default = default_port,
+        dest = 'port',
+    )
+    parser.add_argument(
+        '--cacheSize',
+        metavar = 'N',
+        type = int,
+        help = 'Number of rendered plots kept in memory. Default: 128',
+        default = default_cache_size,
+        dest = 'cache_size',
+    )
+    parser.add_argument(
+        '--chunkRows',
+        metavar = 'N',
+        type = int,
+        help = 'Number of rows read at a time when summarising the data of a run. Default: 100000',
+        default = default_chunk_rows,
+        dest = 'chunk_rows',
+    )
+    parser.add_argument(
+        '--rescanInterval',
+        metavar = 'SECONDS',
+        type = float,
+        help = 'Time after which the runs in the output directory are listed again, so new runs are served. Default: 10',
+        default = default_rescan_interval,
+        dest = 'rescan_interval',
+    )
+    parser.add_argument(
+        '--offlinePlots',
+        help = 'If set, the plots load plotly.js from a copy written in the output directory instead of from the internet',
+        action = 'store_true',
+        dest = 'offline_plots',
+    )
+    parser.add_argument(
+        '--mathjaxPath',
+        metavar = 'PATH',
+        type = Path,
+        help = 'Path to the MathJax.js file of a local MathJax installation, used by the plots with --offlinePlots. Without it the LaTeX in the plot labels is not rendered offline',
+        default = None,
+        dest = 'mathjax_path',
+    )
+    parser.add_argument(
+        '-l',
+        '--log-level',
+        metavar = 'LEVEL',
+        type = str,
+        help = 'Set the logging level. Default: WARNING',
+        choices = ["CRITICAL","ERROR","WARNING","INFO","DEBUG","NOTSET"],
+        default = "WARNING",
+        dest = 'log_level',
+    )
+
+    args = parser.parse_args()
+
+    if args.log_level == "CRITICAL":
+        logging.basicConfig(level=50)
+    elif args.log_level == "ERROR":
+        logging.basicConfig(level=40)
+    elif args.log_level == "WARNING":
+        logging.basicConfig(level=30)
+    elif args.log_level == "INFO":
+        logging.basicConfig(level=20)
+    elif args.log_level == "DEBUG":
+        logging.basicConfig(level=10)
+    elif args.log_level == "NOTSET":
+        logging.basicConfig(level=0)
+
+    output_path: Path = args.output_path
+    if not output_path.is_dir():
+        logging.error("You must define a valid output path")
+        exit(1)
+
+    mathjax_path: Path = args.mathjax_path
+    if args.offline_plots and mathjax_path is not None and not mathjax_path.is_file():
+        logging.error("You must define a valid MathJax path")
+        exit(1)
+
+    serve(
+        output_path = output_path.absolute(),
+        logger = logging.getLogger('plot_server'),
+        port = args.port,
+        cache_size = args.cache_size,
+        chunk_rows = args.chunk_rows,
+        rescan_interval = args.rescan_interval,
+        offline_plots = args.offline_plots,
+        mathjax_path = mathjax_path,
+    )
@@ -0,0 +1,150 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+from pathlib import Path
+import json
+
+# The plot spec is a json file selecting which plots are made at each level, for instance:
+#   {
+#     "assay": {"kinds": ["histogram"], "statistics": ["mean", "raw"]},
+#     "experiments": {"measurements": ["Volume", "speed"], "groupings": ["Run Type"], "kinds": ["histogram", "box"]}
+#   }
+# Each level selects the measurements, statistics, groupings (the grouping columns of the plot joined with "/",
+# or "none") and kinds of the plots, a missing key or level does not restrict the plots. The plotting functions in
+# utilities skip the plots which are not selected at the level of the current task, before building them
+levels = ["assay", "assays", "experiments", "compare_assays"]
+selectors = ["measurements", "statistics", "groupings", "kinds"]
+statistics = ["mean", "median", "std", "raw", "motility"]
+kinds = ["histogram", "pdf", "box", "violin", "scatter_matrix"]
+
+statistic_suffixes = {
+    " Mean": "mean",
+    " Median": "median",
+    " Standard Deviation": "std",
+}
+
+_plot_spec = None
+_active_levels = []
+
+def validate_plot_spec(plot_spec: dict):
+    for level, level_spec in plot_spec.items():
+        if level not in levels:
+            raise RuntimeError(f"Unknown level {level} in the plot spec, the levels are: {', '.join(levels)}")
+        for selector, values in level_spec.items():
+            if selector not in selectors:
+                raise RuntimeError(f"Unknown key {selector} for level {level} in the plot spec, the keys are: {', '.join(selectors)}")
+            if not isinstance(values, list):
+                raise RuntimeError(f"The {selector} of level {level} in the plot spec must be a list")
+        for value in level_spec.get("statistics", []):
+            if value not in statistics:
+                raise RuntimeError(f"Unknown statistic {value} in the plot spec, the statistics are: {', '.join(statistics)}")
+        for value in level_spec.get("kinds", []):
+            if value not in kinds:
+                raise RuntimeError(f"Unknown plot kind {value} in the plot spec, the kinds are: {', '.join(kinds)}")
+
+def set_plot_spec(plot_spec: dict):
+    global _plot_spec
+    if plot_spec is not None:
+        validate_plot_spec(plot_spec)
+    _plot_spec = plot_spec
+
+def get_plot_spec():
+    return _plot_spec
+
+def load_plot_spec(spec_file: Path):
+    with open(spec_file, 'r') as json_file:
+        try:
+            spec = json.load(json_file)
+        except json.JSONDecodeError as error:
+            raise RuntimeError(f"The plot spec {spec_file} is not valid json: {error}")
+    set_plot_spec(spec)
+
+def get_plot_level():
+    # The level of the plots being made, None outside of a PlotLevel
+    if len(_active_levels) == 0:
+        return None
+    return _active_levels[-1]
+
+class PlotLevel:
+    # Sets the level whose selection applies to the plots made inside the with statement
+    def __init__(self, level: str):
+        if level not in levels:
+            raise RuntimeError(f"Unknown plot level {level}")
+        self.level = level
+
+    def __enter__(self):
+        _active_levels.append(self.level)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active_levels.pop()
+        return False
+
+def describe_variable(variable: str):
+    # Returns the measurement and the statistic of a plotted column (i.e. "Volume Mean" -> Volume, mean)
+    import motility
+
+    for suffix, statistic in statistic_suffixes.items():
+        if variable.endswith(suffix):
+            return variable[:-len(suffix)], statistic
+    if variable in motility.motility_labels:
+        return variable.split(" ")[0], "motility"
+    return variable, "raw"
+
+def get_grouping(group_vars: list[str]):
+    group_vars = [var for var in group_vars if var is not None]
+    if len(group_vars) == 0:
+        return "none"
+    return "/".join(group_vars)
+
+def _get_level_spec():
+    if _plot_spec is None or len(_active_levels) == 0:
+        return {}
+    return _plot_spec.get(_active_levels[-1], {})
+
+def _is_selected(level_spec: dict, selector: str, value: str):
+    return selector not in level_spec or value in level_spec[selector]
+
+def is_wanted(
+                kind: str,
+                variable: str,
+                group_vars: list[str] = (),
+                ):
+    level_spec = _get_level_spec()
+    measurement, statistic = describe_variable(variable)
+    return (
+        _is_selected(level_spec, "kinds", kind) and
+        _is_selected(level_spec, "measurements", measurement) and
+        _is_selected(level_spec, "statistics", statistic) and
+        _is_selected(level_spec, "groupings", get_grouping(group_vars))
+    )
+
+def filter_dimensions(
+                        dimensions: list[str],
+                        group_vars: list[str] = (),
+                        ):
+    # The dimensions of a scatter matrix which are selected, none if the scatter matrix is not
+    return [dimension for dimension in dimensions if is_wanted("scatter_matrix", dimension, group_vars)]
+
+if __name__ == "__main__":
+    raise RuntimeError("Do not try to run this file, it is not a standalone script. It contains the plot spec used by the other scripts")
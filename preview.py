@@ -0,0 +1,97 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+from pathlib import Path
+import heapq
+import zlib
+import io
+
+import numpy
+import pandas
+
+import input_catalog
+
+# Preview mode, for a quick look at the results: only a random sample of the mitochondria (the rows of the
+# measurement files) of each assay is read and the whole pipeline runs on the sample. The sample is drawn with
+# reservoir sampling while the lines of each file are read, only the sampled lines are parsed. The i-th row gets
+# the i-th random key of a generator seeded with the seed and the name of the assay and the rows with the smallest
+# keys are kept, so the same mitochondria are sampled in all the measurement files of an assay and in every run
+# with the same seed. The manifests, plots and dashboards of a preview are labelled as sampled
+_preview = None
+
+def set_preview(
+                rows: int,
+                seed: int = 0,
+                ):
+    # rows is the number of mitochondria sampled per assay, None to read all of them
+    global _preview
+    if rows is None:
+        _preview = None
+        return
+    if rows <= 0:
+        raise RuntimeError("The number of mitochondria sampled in preview mode must be positive")
+    _preview = {"rows": rows, "seed": seed}
+
+def get_preview():
+    return _preview
+
+def get_preview_label():
+    if _preview is None:
+        return None
+    return f'Preview: random sample of {_preview["rows"]} mitochondria per assay (seed {_preview["seed"]})'
+
+def _get_key_generator(sample_key: str):
+    return numpy.random.default_rng([_preview["seed"], zlib.crc32(sample_key.encode("utf8"))])
+
+def read_sampled_file(
+                        file: Path,
+                        sample_key: str,
+                        ):
+    # Reads the sampled rows of a measurement file, indexed by their row number in the file
+    rng = _get_key_generator(sample_key)
+    keys = numpy.empty(0)
+    reservoir = []  # Heap of (-key, row, line), the row with the largest key is on top
+    row = 0
+    with input_catalog.open_input(file) as in_file:
+        for line in in_file:
+            if line.strip() == b'':
+                continue
+            # The keys are drawn in blocks, the i-th row always gets the i-th key
+            if row % 4096 == 0:
+                keys = rng.random(4096)
+            key = keys[row % 4096]
+            if len(reservoir) < _preview["rows"]:
+                heapq.heappush(reservoir, (-key, row, line))
+            elif key < -reservoir[0][0]:
+                heapq.heapreplace(reservoir, (-key, row, line))
+            row += 1
+
+    if len(reservoir) == 0:
+        return pandas.DataFrame()
+    sampled = sorted((row, line) for _, row, line in reservoir)
+    file_df = pandas.read_csv(io.BytesIO(b''.join(line if line.endswith(b'\n') else line + b'\n' for _, line in sampled)), header=None)
+    file_df.index = [row for row, _ in sampled]
+    return file_df
+
+if __name__ == "__main__":
+    raise RuntimeError("Do not try to run this file, it is not a standalone script. It contains the preview mode used by the other scripts")
@@ -23,11 +23,25 @@
 from pathlib import Path
 import logging
 import pandas
-import pickle
+import time
 
 import lip_pps_run_manager as RM
 
 import utilities
+import background_writer
+import run_lock
+import preview
+import progress
+import dashboard
+import plot_spec
+import plot_pool
+import input_catalog
+import motility
+import quantile_sketch
+import aggregate_cube
+import run_manifest
+import work_queue
+import streaming_summary
 
 from read_mitometer_file import script_main as read_mitometer_file
 
@@ -36,24 +50,40 @@ def summarise_all_assays_task(
                         logger: logging.Logger,
                         marginal_type: str = "rug",
                         task_name: str = "plot_summary",
+                        memory_budget: float = None,
+                        plot_workers: int = plot_pool.default_plot_workers,
                         ):
     if not Leonardo.task_completed("join_assays"):
         raise RuntimeError("Only call the plotter task after the joiner task has successfully completed")
 
-    with open(Leonardo.data_directory/"all_measurements.pkl", 'rb') as pickle_file:
-        all_measurements = pickle.load(pickle_file)
+    all_measurements = run_manifest.load_measurements(Leonardo.data_directory, logger)
 
-    with Leonardo.handle_task(task_name, drop_old_data=True, loop_iterations = len(all_measurements)) as Picasso:
-        full_df = pandas.read_csv(Picasso.data_directory/"all_data.csv")
+    with Leonardo.handle_task(task_name, drop_old_data=True, loop_iterations = len(all_measurements)) as Picasso, progress.TaskProgress(Picasso, len(all_measurements)), background_writer.BackgroundWriter(), plot_spec.PlotLevel("assays"), plot_pool.PlotPool(plot_workers) as plotter:
+        chunk_rows = streaming_summary.get_chunk_rows(Picasso.data_directory, memory_budget)
+        if chunk_rows is None:
+            full_df = utilities.read_partitioned_data(Picasso.data_directory)
 
-        # Get sliced df with a single value for each of the summary values
-        full_df.set_index(["Run ID", "Mitochondria"], inplace=True)
-        sliced_df = full_df[~full_df.index.duplicated(keep='last')]
-        sliced_df.reset_index(inplace=True)
-        full_df.reset_index(inplace=True)
+            # Get sliced df with a single value for each of the summary values
+            full_df.set_index(["Run ID", "Mitochondria"], inplace=True)
+            sliced_df = full_df[~full_df.index.duplicated(keep='last')]
+            sliced_df.reset_index(inplace=True)
+            full_df.reset_index(inplace=True)
+        else:
+            # The joined data does not fit in memory, it is summarised in chunks and the plots are made from the summaries
+            logger.info(f"The joined data does not fit in the memory budget, summarising it in chunks of {chunk_rows} rows")
+            full_df, sliced_df = streaming_summary.stream_summary_data(
+                Picasso.data_directory,
+                all_measurements,
+                utilities.get_summary_columns(all_measurements),
+                chunk_rows,
+                logger,
+            )
+
+        # With plot_workers, the plots are made by worker processes sharing the data of the task
+        plotter.share([full_df, sliced_df])
 
         for measurement in all_measurements:
-            utilities.make_histogram_plot(
+            plotter.make_histogram_plot(
                 data_df = sliced_df,
                 x_var = f'{measurement} Mean',
                 base_path = Picasso.task_path,
@@ -65,7 +95,7 @@ def summarise_all_assays_task(
                 marginal_type = marginal_type,
             )
 
-            utilities.make_histogram_plot(
+            plotter.make_histogram_plot(
                 data_df = sliced_df,
                 x_var = f'{measurement} Median',
                 base_path = Picasso.task_path,
@@ -77,7 +107,7 @@ def summarise_all_assays_task(
                 marginal_type = marginal_type,
             )
 
-            utilities.make_histogram_plot(
+            plotter.make_histogram_plot(
                 data_df = sliced_df,
                 x_var = f'{measurement} Standard Deviation',
                 base_path = Picasso.task_path,
@@ -89,7 +119,7 @@ def summarise_all_assays_task(
                 marginal_type = marginal_type,
             )
 
-            utilities.make_histogram_plot(
+            plotter.make_histogram_plot(
                 data_df = full_df,
                 x_var = f'{measurement}',
                 base_path = Picasso.task_path,
@@ -101,7 +131,7 @@ def summarise_all_assays_task(
                 x_label = utilities.measurement_to_label(measurement),
             )
 
-            utilities.make_histogram_plot(
+            plotter.make_histogram_plot(
                 data_df = full_df,
                 x_var = f'{measurement}',
                 base_path = Picasso.task_path,
@@ -114,7 +144,7 @@ def summarise_all_assays_task(
                 group_var = "Has Moved",
             )
 
-            utilities.make_histogram_plot(
+            plotter.make_histogram_plot(
                 data_df = full_df,
                 x_var = f'{measurement}',
                 base_path = Picasso.task_path,
@@ -127,7 +157,7 @@ def summarise_all_assays_task(
                 group_var = "Run ID",
             )
 
-            utilities.make_histogram_plot(
+            plotter.make_histogram_plot(
                 data_df = full_df,
                 x_var = f'{measurement}',
                 base_path = Picasso.task_path,
@@ -142,7 +172,7 @@ def summarise_all_assays_task(
             )
 
             if marginal_type == "box":
-                utilities.make_box_plot(
+                plotter.make_box_plot(
                     data_df = full_df,
                     x_var = f'{measurement}',
                     base_path = Picasso.task_path,
@@ -152,7 +182,7 @@ def summarise_all_assays_task(
                     group_var = "Run ID",
                 )
 
-                utilities.make_box_plot(
+                plotter.make_box_plot(
                     data_df = full_df,
                     x_var = f'{measurement}',
                     base_path = Picasso.task_path,
@@ -163,7 +193,7 @@ def summarise_all_assays_task(
                     pattern_shape_var = "Has Moved",
                 )
             elif marginal_type == "violin":
-                utilities.make_violin_plot(
+                plotter.make_violin_plot(
                     data_df = full_df,
                     x_var = f'{measurement}',
                     base_path = Picasso.task_path,
@@ -173,7 +203,7 @@ def summarise_all_assays_task(
                     group_var = "Run ID",
                 )
 
-                utilities.make_violin_plot(
+                plotter.make_violin_plot(
                     data_df = full_df,
                     x_var = f'{measurement}',
                     base_path = Picasso.task_path,
@@ -186,6 +216,21 @@ def summarise_all_assays_task(
 
             Picasso.loop_tick()
 
+        for column in motility.get_motility_columns(all_measurements):
+            if column not in sliced_df.columns:
+                continue
+            plotter.make_histogram_plot(
+                data_df = sliced_df,
+                x_var = column,
+                base_path = Picasso.task_path,
+                file_name = column.replace(" ", "_"),
+                run_name = Picasso.run_name,
+                nbins = 100,
+                logy = True,
+                x_label = motility.motility_labels[column],
+                marginal_type = marginal_type,
+            )
+
         mean_measurements = []
         median_measurements = []
         std_measurements = []
@@ -208,7 +253,7 @@ def summarise_all_assays_task(
             median_labels[median_measurement] = label
             std_labels[std_measurement]       = label
 
-        utilities.make_multiscatter_plot(
+        plotter.make_multiscatter_plot(
             data_df = sliced_df,
             run_name = Picasso.run_name,
             base_path = Picasso.task_path,
@@ -217,7 +262,7 @@ def summarise_all_assays_task(
             file_name = "multi_scatter_mean",
             opacity = 0.5,
         )
-        utilities.make_multiscatter_plot(
+        plotter.make_multiscatter_plot(
             data_df = sliced_df,
             run_name = Picasso.run_name,
             base_path = Picasso.task_path,
@@ -226,7 +271,7 @@ def summarise_all_assays_task(
             file_name = "multi_scatter_median",
             opacity = 0.5,
         )
-        utilities.make_multiscatter_plot(
+        plotter.make_multiscatter_plot(
             data_df = sliced_df,
             run_name = Picasso.run_name,
             base_path = Picasso.task_path,
@@ -235,7 +280,7 @@ def summarise_all_assays_task(
             file_name = "multi_scatter_std",
             opacity = 0.5,
         )
-        utilities.make_multiscatter_plot(
+        plotter.make_multiscatter_plot(
             data_df = full_df,
             run_name = Picasso.run_name,
             base_path = Picasso.task_path,
@@ -244,7 +289,7 @@ def summarise_all_assays_task(
             file_name = "multi_scatter",
             opacity = 0.5,
         )
-        utilities.make_multiscatter_plot(
+        plotter.make_multiscatter_plot(
             data_df = full_df,
             run_name = Picasso.run_name,
             base_path = Picasso.task_path,
@@ -254,7 +299,7 @@ def summarise_all_assays_task(
             color_var = "Has Moved",
             opacity = 0.5,
         )
-        utilities.make_multiscatter_plot(
+        plotter.make_multiscatter_plot(
             data_df = full_df,
             run_name = Picasso.run_name,
             base_path = Picasso.task_path,
@@ -264,7 +309,7 @@ def summarise_all_assays_task(
             color_var = "Run ID",
             opacity = 0.5,
         )
-        utilities.make_multiscatter_plot(
+        plotter.make_multiscatter_plot(
             data_df = full_df,
             run_name = Picasso.run_name,
             base_path = Picasso.task_path,
@@ -276,6 +321,9 @@ def summarise_all_assays_task(
             opacity = 0.5,
         )
 
+        plotter.wait()
+        dashboard.write_dashboard(Picasso.task_path, Picasso.run_name, all_measurements)
+
 def join_assay_data(
                     Leonardo: RM.RunManager,
                     assay_list: list[str],
@@ -285,32 +333,50 @@ def join_assay_data(
         pass
         raise RuntimeError("Only call the joiner task after the read all assays task has successfully completed")
 
-    with Leonardo.handle_task("join_assays", drop_old_data=True, loop_iterations = len(assay_list)) as Gustavo:
+    with Leonardo.handle_task("join_assays", drop_old_data=True, loop_iterations = len(assay_list)) as Gustavo, progress.TaskProgress(Gustavo, len(assay_list)), background_writer.BackgroundWriter():
         merged_df = None
-        merged_measurements = None
+        merged_sketches = quantile_sketch.new_sketches()
+        merged_cube = aggregate_cube.new_cube()
+        merged_description = None
+        run_ids = []
+        inputs = []
 
+        assay_directories = []
         for assay in assay_list:
             assay_run_dir = Leonardo.path_directory.parent / assay
             Bob = RM.RunManager(assay_run_dir)
             if not Bob.task_completed("read_mitometer"):
                 logger.error(f"The read mitometer task has not completed for run {assay}")
                 continue
+            assay_directories += [Bob.data_directory]
 
-            assay_df = pandas.read_csv(Bob.data_directory / "all_data.csv")
+        # Plan the join from the manifests of the assays, before reading their data
+        join_plan = run_manifest.plan_join(assay_directories, logger)
+        merged_measurements = join_plan["measurements"]
+        if join_plan["rows"] is not None:
+            logger.info(f"Joining {join_plan['rows']} rows from {len(assay_directories)} assays, needing about {join_plan['memory']/1024/1024:.1f} MB")
 
-            with open(Bob.data_directory/"all_measurements.pkl", 'rb') as pickle_file:
-                assay_measurements = pickle.load(pickle_file)
+        for assay_directory in assay_directories:
+            assay_df = pandas.read_csv(assay_directory / "all_data.csv")
+            progress.count_read(len(assay_df), assay_directory / "all_data.csv")
+
+            assay_description, assay_run_ids, assay_input = run_manifest.describe_child(assay_directory, assay_df, logger)
+            merged_description = run_manifest.merge_descriptions(merged_description, assay_description)
+            run_ids += assay_run_ids
+            inputs += [assay_input]
+
+            assay_sketches = quantile_sketch.load_sketches(assay_directory, logger)
+            if assay_sketches is not None:
+                quantile_sketch.merge_sketches(merged_sketches, assay_sketches)
+
+            assay_cube = aggregate_cube.load_cube(assay_directory, logger)
+            if assay_cube is not None:
+                aggregate_cube.merge_cube(merged_cube, assay_cube)
 
             if merged_df is None:
                 merged_df = assay_df
-                merged_measurements = assay_measurements
             else:
                 merged_df = pandas.concat([merged_df, assay_df])
-                previous_measurements = merged_measurements
-                merged_measurements = []
-                for measurement in previous_measurements:
-                    if measurement in assay_measurements:
-                        merged_measurements += [measurement]
 
             Gustavo.loop_tick()
 
@@ -319,10 +385,100 @@ def join_assay_data(
 
         if not Gustavo.data_directory.exists():
             Gustavo.data_directory.mkdir()
-        merged_df.to_csv(Gustavo.data_directory/"all_data.csv")
+        utilities.write_partitions(merged_df, Gustavo.data_directory)
+        # The runs joined by older versions also hold the joined data in all_data.csv
+        (Gustavo.data_directory/"all_data.csv").unlink(missing_ok = True)
+
+        quantile_sketch.save_sketches(merged_sketches, Gustavo.data_directory)
+        quantile_sketch.write_quantile_summary(merged_sketches, Gustavo.data_directory)
+        aggregate_cube.save_cube(merged_cube, Gustavo.data_directory)
+        aggregate_cube.write_cube_summary(merged_cube, Gustavo.data_directory)
 
-        with open(Gustavo.data_directory/"all_measurements.pkl", 'wb') as pickle_file:
-            pickle.dump(merged_measurements, pickle_file)
+        run_manifest.write_manifest(
+            data_directory = Gustavo.data_directory,
+            run_name = Gustavo.run_name,
+            level = "assays",
+            measurements = merged_measurements,
+            description = merged_description,
+            run_ids = run_ids,
+            inputs = inputs,
+        )
+
+def append_assay_data(
+                    Leonardo: RM.RunManager,
+                    assay_list: list[str],
+                    logger: logging.Logger,
+                    ):
+    if not Leonardo.task_completed("join_assays"):
+        raise RuntimeError("Only call the incremental joiner task after the joiner task has successfully completed")
+
+    merged_manifest = run_manifest.load_manifest(Leonardo.data_directory)
+    if merged_manifest is None:
+        raise RuntimeError("The joined data has no manifest, it can not be appended to")
+    if merged_manifest.get("preview") != preview.get_preview():
+        raise RuntimeError("The joined data and the new assays were not read with the same preview sample, the assays must be joined again")
+    merged_measurements = merged_manifest["measurements"]
+    merged_description = merged_manifest["data"]
+    run_ids = merged_manifest["run_ids"]
+    inputs = merged_manifest["inputs"]
+
+    merged_sketches = quantile_sketch.load_sketches(Leonardo.data_directory, logger)
+    if merged_sketches is None:
+        merged_sketches = quantile_sketch.new_sketches()
+
+    merged_cube = aggregate_cube.load_cube(Leonardo.data_directory, logger)
+    if merged_cube is None:
+        merged_cube = aggregate_cube.new_cube()
+
+    # The assays are written as new partitions next to the partitions of the joined data
+    if utilities.list_partitions(Leonardo.data_directory) is None:
+        raise RuntimeError("The joined data was not written as partitions, the assays must be joined again")
+    output_columns = utilities.read_data_columns(Leonardo.data_directory)
+
+    with Leonardo.handle_task("join_assays", drop_old_data=True, loop_iterations = len(assay_list)) as Gustavo, progress.TaskProgress(Gustavo, len(assay_list)), background_writer.BackgroundWriter():
+        for assay in assay_list:
+            assay_run_dir = Leonardo.path_directory.parent / assay
+            Bob = RM.RunManager(assay_run_dir)
+            if not Bob.task_completed("read_mitometer"):
+                logger.error(f"The read mitometer task has not completed for run {assay}")
+                continue
+
+            assay_df = pandas.read_csv(Bob.data_directory / "all_data.csv")
+            progress.count_read(len(assay_df), Bob.data_directory / "all_data.csv")
+
+            assay_description, assay_run_ids, assay_input = run_manifest.describe_child(Bob.data_directory, assay_df, logger)
+            merged_description = run_manifest.merge_descriptions(merged_description, assay_description)
+            run_ids += assay_run_ids
+            inputs += [assay_input]
+            merged_measurements = run_manifest.intersect_measurements([merged_measurements, run_manifest.load_measurements(Bob.data_directory, logger)])
+
+            assay_sketches = quantile_sketch.load_sketches(Bob.data_directory, logger)
+            if assay_sketches is not None:
+                quantile_sketch.merge_sketches(merged_sketches, assay_sketches)
+
+            assay_cube = aggregate_cube.load_cube(Bob.data_directory, logger)
+            if assay_cube is not None:
+                aggregate_cube.merge_cube(merged_cube, assay_cube)
+
+            assay_df = assay_df.reindex(columns = output_columns)
+            utilities.write_partitions(assay_df, Gustavo.data_directory, replace = False)
+
+            Gustavo.loop_tick()
+
+        quantile_sketch.save_sketches(merged_sketches, Gustavo.data_directory)
+        quantile_sketch.write_quantile_summary(merged_sketches, Gustavo.data_directory)
+        aggregate_cube.save_cube(merged_cube, Gustavo.data_directory)
+        aggregate_cube.write_cube_summary(merged_cube, Gustavo.data_directory)
+
+        run_manifest.write_manifest(
+            data_directory = Gustavo.data_directory,
+            run_name = Gustavo.run_name,
+            level = "assays",
+            measurements = merged_measurements,
+            description = merged_description,
+            run_ids = run_ids,
+            inputs = inputs,
+        )
 
 def read_assays_task(
                     Leonardo: RM.RunManager,
@@ -330,50 +486,276 @@ def read_assays_task(
                     logger: logging.Logger,
                     marginal_type: str = "rug",
                     disable_plots: bool = False,
+                    memory_budget: float = None,
+                    catalog: dict = None,
                     ):
-    dir_list = []
-    for dir_path in mitometer_path.iterdir():
-        if dir_path.is_dir():
-            dir_list += [dir_path]
-    del dir_path
+    if catalog is None:
+        catalog = input_catalog.build_catalog(mitometer_path, depth = 1, cache_directory = Leonardo.path_directory.parent, logger = logger)
+    dir_list = catalog["directories"]
 
-    with Leonardo.handle_task("read_all_assays", drop_old_data=True, loop_iterations = len(dir_list)) as Matt:
+    with Leonardo.handle_task("read_all_assays", drop_old_data=True, loop_iterations = len(dir_list)) as Matt, progress.TaskProgress(Matt, len(dir_list)):
         run_list = []
-        for dir_path in dir_list:
+        for dir_node in dir_list:
             read_mitometer_file(
-                mitometer_path = dir_path,
-                run_name = mitometer_path.name + "_" + dir_path.name,
+                mitometer_path = Path(dir_node["path"]),
+                run_name = get_assay_run_name(catalog, dir_node),
                 output_path = Leonardo.path_directory.parent,
                 marginal_type = marginal_type,
                 disable_plots = disable_plots,
+                memory_budget = memory_budget,
+                catalog = dir_node,
             )
 
-            run_list += [mitometer_path.name + "_" + dir_path.name]
+            run_list += [get_assay_run_name(catalog, dir_node)]
             #if Matt.processed_iterations == 13:
             #    break
             Matt.loop_tick()
 
         return run_list
 
+def distribute_assays_task(
+                    Leonardo: RM.RunManager,
+                    mitometer_path: Path,
+                    logger: logging.Logger,
+                    marginal_type: str = "rug",
+                    disable_plots: bool = False,
+                    memory_budget: float = None,
+                    catalog: dict = None,
+                    local_workers: int = 0,
+                    lease_time: float = work_queue.default_lease_time,
+                    max_attempts: int = work_queue.default_max_attempts,
+                    ):
+    # The assays are published as jobs in a work queue in the run directory, which is read by worker processes on
+    # any node with access to it (work_queue.py), and this waits for them before the assays are joined
+    if catalog is None:
+        catalog = input_catalog.build_catalog(mitometer_path, depth = 1, cache_directory = Leonardo.path_directory.parent, logger = logger)
+    dir_list = catalog["directories"]
+    queue_directory = Leonardo.path_directory / "work_queue"
+
+    with Leonardo.handle_task("read_all_assays", drop_old_data=True, loop_iterations = len(dir_list)) as Matt, progress.TaskProgress(Matt, len(dir_list)):
+        work_queue.create_queue(queue_directory)
+        for dir_node in dir_list:
+            run_name = get_assay_run_name(catalog, dir_node)
+            work_queue.publish_job(queue_directory, run_name, {
+                "mitometer_path": dir_node["path"],
+                "run_name": run_name,
+                "output_path": str(Leonardo.path_directory.parent),
+                "marginal_type": marginal_type,
+                "disable_plots": disable_plots,
+                "memory_budget": memory_budget,
+                "catalog": dir_node,
+                "plot_assets": work_queue.get_plot_assets(),
+                "plot_spec": plot_spec.get_plot_spec(),
+                "preview": preview.get_preview(),
+                "progress_interval": progress.get_report_interval(),
+            })
+        work_queue.close_queue(queue_directory)
+        logger.info(f"Published {len(dir_list)} assay jobs, start workers with: python work_queue.py --queue {queue_directory}")
+
+        workers = work_queue.start_local_workers(queue_directory, local_workers, lease_time, max_attempts)
+        # The failed assays are ticked too, so the task completes and the assays which were read are joined
+        run_list = []
+        for job_id, done in work_queue.iter_finished_jobs(queue_directory, max_attempts, lease_time = lease_time, local_workers = workers, logger = logger):
+            if done:
+                logger.info(f"Assay {job_id} was read")
+                run_list += [job_id]
+            else:
+                logger.error(f"Reading assay {job_id} failed, it is not joined")
+            Matt.loop_tick()
+        for worker in workers:
+            worker.wait()
+
+    return sorted(run_list)
+
+def get_assay_run_name(catalog: dict, dir_node: dict):
+    # Assays and experiments can be archives, so the run names come from the catalog names which have the archive suffix removed
+    return catalog["name"] + "_" + dir_node["name"]
+
+def get_assay_signature(dir_node: dict):
+    # The measurement files of an assay with their size and modification time (the archive's for the files inside archives)
+    return tuple((file["name"], file["size"], file["mtime_ns"]) for file in dir_node["files"] if input_catalog.is_measurement_file(file["name"]))
+
+def read_new_assays_task(
+                    Leonardo: RM.RunManager,
+                    catalog: dict,
+                    dir_list: list[dict],
+                    logger: logging.Logger,
+                    marginal_type: str = "rug",
+                    disable_plots: bool = False,
+                    memory_budget: float = None,
+                    ):
+    # An assay which can not be read does not stop the others, the run names of the assays which failed are returned with the runs read
+    with Leonardo.handle_task("read_new_assays", drop_old_data=True, loop_iterations = len(dir_list)) as Matt, progress.TaskProgress(Matt, len(dir_list)):
+        run_list = []
+        failed_runs = []
+        for dir_node in dir_list:
+            run_name = get_assay_run_name(catalog, dir_node)
+            try:
+                read_mitometer_file(
+                    mitometer_path = Path(dir_node["path"]),
+                    run_name = run_name,
+                    output_path = Leonardo.path_directory.parent,
+                    marginal_type = marginal_type,
+                    disable_plots = disable_plots,
+                    memory_budget = memory_budget,
+                    catalog = dir_node,
+                )
+            except Exception:
+                logger.exception(f"Unable to read the assay in {dir_node['path']}, it is skipped until its files change")
+                failed_runs += [run_name]
+            else:
+                run_list += [run_name]
+            Matt.loop_tick()
+
+        return run_list, failed_runs
+
+def watch_assays(
+                    Leonardo: RM.RunManager,
+                    mitometer_path: Path,
+                    run_list: list[str],
+                    logger: logging.Logger,
+                    marginal_type: str = "rug",
+                    disable_plots: bool = False,
+                    memory_budget: float = None,
+                    poll_interval: float = 30,
+                    settle_time: float = 120,
+                    plot_workers: int = plot_pool.default_plot_workers,
+                    ):
+    known_runs = set(run_list)
+    # For each candidate assay (by run name), the signature seen and the time it was first seen unchanged
+    pending = {}
+    # The signature of the assays which could not be read, they are retried once their files change
+    failed = {}
+
+    logger.info(f"Watching {mitometer_path} for new assays, press Ctrl+C to stop")
+    try:
+        while True:
+            now = time.monotonic()
+            # The new assays are found in the catalog, as in the first pass, so archived and compressed assays are
+            # picked up too and get the same run names. Archives still being written can not be listed yet, and the
+            # files are stat'ed on every poll to see the files still growing
+            catalog = input_catalog.build_catalog(mitometer_path, depth = 1, cache_directory = Leonardo.path_directory.parent, logger = logger, skip_unreadable_archives = True, verify_files = True)
+            ready_dirs = []
+            for dir_node in catalog["directories"]:
+                run_name = get_assay_run_name(catalog, dir_node)
+                if run_name in known_runs:
+                    continue
+
+                signature = get_assay_signature(dir_node)
+                if len(signature) == 0:
+                    continue
+                if failed.get(run_name) == signature:
+                    continue
+
+                # Debounce: only pick up assays whose files did not change during the settle time
+                if run_name not in pending or pending[run_name][0] != signature:
+                    pending[run_name] = (signature, now)
+                    logger.info(f"Found new or changed assay {dir_node['name']}, waiting for it to settle")
+                elif now - pending[run_name][1] >= settle_time:
+                    ready_dirs += [dir_node]
+
+            if len(ready_dirs) > 0:
+                logger.info(f"Ingesting {len(ready_dirs)} new assays: {', '.join(dir_node['name'] for dir_node in ready_dirs)}")
+                new_runs, failed_runs = read_new_assays_task(
+                    Leonardo = Leonardo,
+                    catalog = catalog,
+                    dir_list = ready_dirs,
+                    logger = logger,
+                    marginal_type = marginal_type,
+                    disable_plots = disable_plots,
+                    memory_budget = memory_budget,
+                )
+                for dir_node in ready_dirs:
+                    run_name = get_assay_run_name(catalog, dir_node)
+                    if run_name in failed_runs:
+                        failed[run_name] = pending[run_name][0]
+                    else:
+                        failed.pop(run_name, None)
+                    del pending[run_name]
+                if len(new_runs) == 0:
+                    time.sleep(poll_interval)
+                    continue
+                known_runs.update(new_runs)
+                run_list += new_runs
+
+                # A failure while joining or plotting is reported and the watch goes on, the next new assays
+                # are joined again from scratch
+                try:
+                    if Leonardo.task_completed("join_assays") and utilities.list_partitions(Leonardo.data_directory) is not None:
+                        append_assay_data(
+                            Leonardo = Leonardo,
+                            assay_list = new_runs,
+                            logger = logger,
+                        )
+                    else:
+                        join_assay_data(
+                            Leonardo = Leonardo,
+                            assay_list = run_list,
+                            logger = logger,
+                        )
+
+                    # The plots of the new assays are made while reading them and only the partitions of the new
+                    # assays are written when appending, but every summary plot shows all the assays, so all of them are refreshed
+                    if not disable_plots:
+                        summarise_all_assays_task(
+                            Leonardo = Leonardo,
+                            logger = logger,
+                            marginal_type = marginal_type,
+                            memory_budget = memory_budget,
+                            plot_workers = plot_workers,
+                        )
+                except Exception:
+                    logger.exception(f"Unable to join or summarise the new assays {', '.join(new_runs)}, waiting for the next assays")
+
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching for new assays")
+
 def script_main(
                 mitometer_path: Path,
                 run_name: str,
                 output_path: Path,
                 marginal_type: str = "rug",
                 disable_plots: bool = False,
+                memory_budget: float = None,
+                watch: bool = False,
+                poll_interval: float = 30,
+                settle_time: float = 120,
+                catalog: dict = None,
+                distributed: bool = False,
+                local_workers: int = 0,
+                lease_time: float = work_queue.default_lease_time,
+                max_attempts: int = work_queue.default_max_attempts,
+                plot_workers: int = plot_pool.default_plot_workers,
                 ):
     logger = logging.getLogger('process_all_assays')
 
-    with RM.RunManager(output_path / run_name) as Leonardo:
+    with run_lock.RunLock(output_path / run_name, logger), RM.RunManager(output_path / run_name) as Leonardo:
         Leonardo.create_run(raise_error=False)
 
-        run_list = read_assays_task(
-                         Leonardo = Leonardo,
-                         mitometer_path = mitometer_path,
-                         logger = logger,
-                         marginal_type = marginal_type,
-                         disable_plots = disable_plots,
-                         )
+        if distributed:
+            run_list = distribute_assays_task(
+                             Leonardo = Leonardo,
+                             mitometer_path = mitometer_path,
+                             logger = logger,
+                             marginal_type = marginal_type,
+                             disable_plots = disable_plots,
+                             memory_budget = memory_budget,
+                             catalog = catalog,
+                             local_workers = local_workers,
+                             lease_time = lease_time,
+                             max_attempts = max_attempts,
+                             )
+        else:
+            run_list = read_assays_task(
+                             Leonardo = Leonardo,
+                             mitometer_path = mitometer_path,
+                             logger = logger,
+                             marginal_type = marginal_type,
+                             disable_plots = disable_plots,
+                             memory_budget = memory_budget,
+                             catalog = catalog,
+                             )
 
         join_assay_data(
             Leonardo = Leonardo,
@@ -386,6 +768,22 @@ def script_main(
                 Leonardo = Leonardo,
                 logger = logger,
                 marginal_type = marginal_type,
+                memory_budget = memory_budget,
+                plot_workers = plot_workers,
+            )
+
+        if watch:
+            watch_assays(
+                Leonardo = Leonardo,
+                mitometer_path = mitometer_path,
+                run_list = run_list,
+                logger = logger,
+                marginal_type = marginal_type,
+                disable_plots = disable_plots,
+                memory_budget = memory_budget,
+                poll_interval = poll_interval,
+                settle_time = settle_time,
+                plot_workers = plot_workers,
             )
 
 if __name__ == "__main__":
@@ -440,6 +838,121 @@ if __name__ == "__main__":
         action = 'store_true',
         dest = 'disable_plots',
     )
+    parser.add_argument(
+        '--memoryBudget',
+        metavar = 'MB',
+        type = float,
+        help = 'If set, the measurement files of each assay are read in chunks of mitochondria and written to disk incrementally, keeping the memory used while reading below roughly this many MB. The summary plots of joined data larger than this are made from histograms, quantile sketches and a random sample accumulated while reading the data in chunks',
+        default = None,
+        dest = 'memory_budget',
+    )
+    parser.add_argument(
+        '--preview',
+        metavar = 'N',
+        type = int,
+        help = 'If set, only a random sample of N mitochondria of each assay is read, the same in all the measurement files of the assay, for a quick look at the results. The outputs are labelled as a preview',
+        default = None,
+        dest = 'preview_rows',
+    )
+    parser.add_argument(
+        '--previewSeed',
+        metavar = 'SEED',
+        type = int,
+        help = 'Seed of the random sample of the mitochondria with --preview, the same seed samples the same mitochondria. Default: 0',
+        default = 0,
+        dest = 'preview_seed',
+    )
+    parser.add_argument(
+        '--progressInterval',
+        metavar = 'SECONDS',
+        type = float,
+        help = 'If set, a structured log line with the throughput (rows parsed, MB read, figures rendered and MB written per second) and the estimated time remaining of the running task and of the whole run is logged every SECONDS seconds, whatever the log level',
+        default = None,
+        dest = 'progress_interval',
+    )
+    parser.add_argument(
+        '--plotWorkers',
+        metavar = 'N',
+        type = int,
+        help = 'Number of worker processes making the summary plots of the joined data, which share the data through memory mapped files instead of copying it. Default: 0, the plots are made in the main process',
+        default = plot_pool.default_plot_workers,
+        dest = 'plot_workers',
+    )
+    parser.add_argument(
+        '-w',
+        '--watch',
+        help = 'If set, after processing the existing assays the script keeps watching the mitometer path and ingests new assay directories as they appear',
+        action = 'store_true',
+        dest = 'watch',
+    )
+    parser.add_argument(
+        '--pollInterval',
+        metavar = 'SECONDS',
+        type = float,
+        help = 'Time between checks for new assay directories in watch mode. Default: 30',
+        default = 30,
+        dest = 'poll_interval',
+    )
+    parser.add_argument(
+        '--settleTime',
+        metavar = 'SECONDS',
+        type = float,
+        help = 'Time the contents of a new assay directory must remain unchanged before it is ingested in watch mode. Default: 120',
+        default = 120,
+        dest = 'settle_time',
+    )
+    parser.add_argument(
+        '--distributed',
+        help = 'If set, the assays are published as jobs in a work queue in the run directory and read by worker processes (work_queue.py) on any node with access to the output directory, the assays are joined once all the jobs are done',
+        action = 'store_true',
+        dest = 'distributed',
+    )
+    parser.add_argument(
+        '--localWorkers',
+        metavar = 'N',
+        type = int,
+        help = 'Number of worker processes to start on this node in distributed mode. Default: 0',
+        default = 0,
+        dest = 'local_workers',
+    )
+    parser.add_argument(
+        '--leaseTime',
+        metavar = 'SECONDS',
+        type = float,
+        help = 'Time without renewal after which the claim of a worker on a job is considered stale and the job is retried, in distributed mode. Default: 300',
+        default = work_queue.default_lease_time,
+        dest = 'lease_time',
+    )
+    parser.add_argument(
+        '--maxAttempts',
+        metavar = 'N',
+        type = int,
+        help = 'Number of times the job of an assay is attempted before giving up on it, in distributed mode. Default: 3',
+        default = work_queue.default_max_attempts,
+        dest = 'max_attempts',
+    )
+    parser.add_argument(
+        '--plotSpec',
+        metavar = 'PATH',
+        type = Path,
+        help = 'Path to a json plot spec selecting the measurements, statistics, groupings and kinds of the plots made at each level. Default: all the plots are made',
+        default = None,
+        dest = 'plot_spec',
+    )
+    parser.add_argument(
+        '--offlinePlots',
+        help = 'If set, the plots load plotly.js from a copy written in the output directory instead of from the internet',
+        action = 'store_true',
+        dest = 'offline_plots',
+    )
+    parser.add_argument(
+        '--mathjaxPath',
+        metavar = 'PATH',
+        type = Path,
+        help = 'Path to the MathJax.js file of a local MathJax installation, used by the plots with --offlinePlots. Without it the LaTeX in the plot labels is not rendered offline',
+        default = None,
+        dest = 'mathjax_path',
+    )
     parser.add_argument(
         '-l',
         '--log-level',
@@ -487,8 +1000,38 @@ if __name__ == "__main__":
         exit(1)
     output_path = output_path.absolute()
 
+    if args.plot_spec is not None:
+        if not args.plot_spec.is_file():
+            logging.error("You must define a valid plot spec path")
+            exit(1)
+        try:
+            plot_spec.load_plot_spec(args.plot_spec)
+        except RuntimeError as error:
+            logging.error(f"You must define a valid plot spec: {error}")
+            exit(1)
+
+    if args.offline_plots:
+        mathjax_path: Path = args.mathjax_path
+        if mathjax_path is not None and not mathjax_path.is_file():
+            logging.error("You must define a valid MathJax path")
+            exit(1)
+        utilities.setup_offline_plot_assets(output_path, logging.getLogger("plot_assets"), mathjax_path)
+
     marginal_type: str = args.marginal_type
     if marginal_type == "None":
         marginal_type = None
 
-    script_main(mitometer_path, args.run_name, output_path, marginal_type, args.disable_plots)
\ No newline at end of file
+    if args.preview_rows is not None:
+        if args.preview_rows <= 0:
+            logging.error("You must define a positive number of mitochondria to preview")
+            exit(1)
+        preview.set_preview(args.preview_rows, args.preview_seed)
+        logging.warning(preview.get_preview_label())
+
+    if args.progress_interval is not None:
+        if args.progress_interval <= 0:
+            logging.error("You must define a positive progress interval")
+            exit(1)
+        progress.set_report_interval(args.progress_interval)
+
+    script_main(mitometer_path, args.run_name, output_path, marginal_type, args.disable_plots, args.memory_budget, args.watch, args.poll_interval, args.settle_time, None, args.distributed, args.local_workers, args.lease_time, args.max_attempts, args.plot_workers)
\ No newline at end of file
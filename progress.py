@@ -0,0 +1,228 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+from pathlib import Path
+import threading
+import logging
+import json
+import time
+import io
+
+import lip_pps_run_manager as RM
+
+# Throughput and time remaining of the tasks, on top of the loop_tick progress of the run manager. A progress is
+# opened together with each task, right after handle_task in the same with statement (before the background writer,
+# so the pending outputs are counted in the task), with the same number of iterations as the task:
+#   with Tiago.handle_task(..., loop_iterations = N) as Joana, progress.TaskProgress(Joana, N), background_writer.BackgroundWriter():
+# The code doing the work counts what it does with count(metric, amount): the rows parsed, the bytes read, the
+# figures rendered and the bytes written. The counts go to all the open progresses, so the outer tasks of the
+# experiment -> assays -> assay hierarchy (which call the scripts of the inner levels) include the work of the inner
+# tasks. The time remaining of the whole hierarchy is estimated from the fraction done of the outermost task, each
+# task adding the fraction done of its current iteration from the task nested in it.
+# With a report interval, a structured log line (a json object after "progress ") is logged every interval seconds
+# for the innermost task, and a final one when each task ends, on the "progress" logger
+metrics = ["rows", "bytes_read", "figures", "bytes_written"]
+
+_report_interval = None
+_logger = logging.getLogger("progress")
+
+_active_counters = []
+_active_lock = threading.Lock()
+_reporter = None
+
+def set_report_interval(interval: float):
+    # None disables the reports, the counts are still kept
+    global _report_interval
+    if interval is not None and interval <= 0:
+        raise RuntimeError("The interval of the progress reports must be positive")
+    _report_interval = interval
+    if interval is not None:
+        _logger.setLevel(logging.INFO)
+
+def get_report_interval():
+    return _report_interval
+
+def count(metric: str, amount: int = 1):
+    with _active_lock:
+        for counters in _active_counters:
+            counters.add(metric, amount)
+
+def add_counts(totals: dict):
+    # Adds the totals counted in another process, i.e. by a plotting worker
+    for metric, amount in totals.items():
+        count(metric, amount)
+
+def count_read(rows: int, path: Path = None):
+    # For the csv files read whole by pandas, the bytes read are the size of the file
+    count("rows", rows)
+    if path is not None:
+        count("bytes_read", path.stat().st_size)
+
+class _CountingInput(io.RawIOBase):
+    def __init__(self, in_file):
+        self._in_file = in_file
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self._in_file.readinto(buffer)
+        count("bytes_read", size)
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._in_file.close()
+        super().close()
+
+def counting_input(in_file):
+    # Wraps a binary file opened for reading, counting the (decompressed) bytes read from it
+    return io.BufferedReader(_CountingInput(in_file))
+
+class ProgressCounters:
+    # The counts of the work done while the with statement is open
+    def __init__(self):
+        self.totals = {metric: 0 for metric in metrics}
+        self._lock = threading.Lock()
+
+    def add(self, metric: str, amount: int):
+        with self._lock:
+            self.totals[metric] += amount
+
+    def get_totals(self):
+        with self._lock:
+            return dict(self.totals)
+
+    def __enter__(self):
+        with _active_lock:
+            _active_counters.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with _active_lock:
+            _active_counters.remove(self)
+        return False
+
+class TaskProgress(ProgressCounters):
+    def __init__(
+                    self,
+                    task: RM.TaskManager,
+                    loop_iterations: int = None,
+                    ):
+        # loop_iterations is the value given to handle_task, the run manager has no public getter for it
+        super().__init__()
+        self.task = task
+        self.loop_iterations = loop_iterations
+        self.start_time = None
+
+    def get_fraction_done(self, inner_fraction: float = 0):
+        # The fraction of the task done, inner_fraction being the fraction done of the current iteration
+        loop_iterations = self.loop_iterations
+        if loop_iterations is None or loop_iterations == 0:
+            return None
+        processed = self.task.processed_iterations or 0
+        return min(1, (processed + min(inner_fraction, 1)) / loop_iterations)
+
+    def get_report(self, hierarchy: list = None):
+        elapsed = time.monotonic() - self.start_time
+        totals = self.get_totals()
+        report = {
+            "run": self.task.run_name,
+            "task": self.task.task_name,
+            "iterations": self.task.processed_iterations or 0,
+            "loop_iterations": self.loop_iterations,
+            "elapsed": round(elapsed, 1),
+            "rows": totals["rows"],
+            "rows_per_second": round(totals["rows"] / elapsed, 1) if elapsed > 0 else None,
+            "MB_read": round(totals["bytes_read"] / 1024 / 1024, 3),
+            "MB_read_per_second": round(totals["bytes_read"] / 1024 / 1024 / elapsed, 3) if elapsed > 0 else None,
+            "figures": totals["figures"],
+            "figures_per_second": round(totals["figures"] / elapsed, 3) if elapsed > 0 else None,
+            "MB_written": round(totals["bytes_written"] / 1024 / 1024, 3),
+            "MB_written_per_second": round(totals["bytes_written"] / 1024 / 1024 / elapsed, 3) if elapsed > 0 else None,
+            "eta": _get_time_remaining(elapsed, self.get_fraction_done()),
+        }
+
+        if hierarchy is not None and len(hierarchy) > 1:
+            # The fraction done of each task includes the fraction done of the task nested in it
+            fraction = 0
+            for counters in reversed(hierarchy):
+                task_fraction = counters.get_fraction_done(fraction)
+                fraction = task_fraction if task_fraction is not None else fraction
+            outermost = hierarchy[0]
+            report["hierarchy"] = [f'{counters.task.run_name}/{counters.task.task_name}' for counters in hierarchy]
+            report["total_elapsed"] = round(time.monotonic() - outermost.start_time, 1)
+            report["total_eta"] = _get_time_remaining(report["total_elapsed"], fraction)
+
+        return report
+
+    def __enter__(self):
+        self.start_time = time.monotonic()
+        super().__enter__()
+        if _report_interval is not None:
+            _start_reporter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if _report_interval is not None and exc_type is None:
+            report = self.get_report()
+            report["eta"] = 0
+            _log_report(report)
+        super().__exit__(exc_type, exc_value, traceback)
+        return False
+
+def _get_time_remaining(elapsed: float, fraction: float):
+    if fraction is None or fraction <= 0:
+        return None
+    return round(elapsed * (1 - fraction) / fraction, 1)
+
+def _log_report(report: dict):
+    _logger.info("progress " + json.dumps(report))
+
+def _get_hierarchy():
+    with _active_lock:
+        return [counters for counters in _active_counters if isinstance(counters, TaskProgress)]
+
+def _report():
+    # Reports the innermost task every interval, until no task is open
+    global _reporter
+    while True:
+        time.sleep(_report_interval)
+        hierarchy = _get_hierarchy()
+        if len(hierarchy) == 0:
+            with _active_lock:
+                if len(_active_counters) == 0:
+                    _reporter = None
+                    return
+            continue
+        _log_report(hierarchy[-1].get_report(hierarchy))
+
+def _start_reporter():
+    global _reporter
+    with _active_lock:
+        if _reporter is None:
+            _reporter = threading.Thread(target = _report, daemon = True)
+            _reporter.start()
+
+if __name__ == "__main__":
+    raise RuntimeError("Do not try to run this file, it is not a standalone script. It contains the progress reports used by the other scripts")
@@ -0,0 +1,225 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+from pathlib import Path
+import logging
+import math
+import json
+
+import numpy
+import pandas
+
+import background_writer
+
+class QuantileSketch:
+    # Mergeable quantile sketch with relative error guarantees (DDSketch style). The values are counted in
+    # logarithmically spaced bins, so the memory is bounded by the dynamic range of the data and not by the
+    # number of values, and two sketches are merged by adding the counts of their bins
+    def __init__(self, relative_accuracy: float = 0.01, min_value: float = 1e-12):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self._log_gamma = math.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        self.positive: dict[int, int] = {}
+        self.negative: dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _add_to_store(self, store: dict[int, int], values: numpy.ndarray):
+        indices, counts = numpy.unique(numpy.ceil(numpy.log(values) / self._log_gamma).astype(numpy.int64), return_counts = True)
+        for index, count in zip(indices.tolist(), counts.tolist()):
+            store[index] = store.get(index, 0) + count
+
+    def add(self, values):
+        values = numpy.asarray(values, dtype = float).ravel()
+        values = values[~numpy.isnan(values)]
+        if len(values) == 0:
+            return
+
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        positive = values > self.min_value
+        negative = values < -self.min_value
+        self.zero_count += int(len(values) - positive.sum() - negative.sum())
+        self._add_to_store(self.positive, values[positive])
+        self._add_to_store(self.negative, -values[negative])
+
+    def merge(self, other: "QuantileSketch"):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise RuntimeError("Only sketches with the same relative accuracy can be merged")
+        for store, other_store in [(self.positive, other.positive), (self.negative, other.negative)]:
+            for index, count in other_store.items():
+                store[index] = store.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def _bin_value(self, index: int):
+        return 2 * math.exp(index * self._log_gamma) / (1 + math.exp(self._log_gamma))
+
+    def quantile(self, q: float):
+        if self.count == 0:
+            return math.nan
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse = True):
+            seen += self.negative[index]
+            if seen > rank:
+                return max(-self._bin_value(index), self.min)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return min(self._bin_value(index), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "min_value": self.min_value,
+            "positive": {str(index): count for index, count in self.positive.items()},
+            "negative": {str(index): count for index, count in self.negative.items()},
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "min": self.min if self.count > 0 else None,
+            "max": self.max if self.count > 0 else None,
+        }
+
+    @classmethod
+    def from_dict(cls, sketch_dict: dict):
+        sketch = cls(sketch_dict["relative_accuracy"], sketch_dict["min_value"])
+        sketch.positive = {int(index): count for index, count in sketch_dict["positive"].items()}
+        sketch.negative = {int(index): count for index, count in sketch_dict["negative"].items()}
+        sketch.zero_count = sketch_dict["zero_count"]
+        sketch.count = sketch_dict["count"]
+        if sketch.count > 0:
+            sketch.min = sketch_dict["min"]
+            sketch.max = sketch_dict["max"]
+        return sketch
+
+# The sketches of a data product are kept in a dictionary with the sketches of all the data under "all" and
+# the sketches of each Run Type under "Run Type", each being a dictionary of column name to sketch
+
+def new_sketches():
+    return {"all": {}, "Run Type": {}}
+
+def _update_group(group_sketches: dict[str, QuantileSketch], data_df: pandas.DataFrame, columns: list[str]):
+    for column in columns:
+        if column not in data_df.columns:
+            continue
+        if column not in group_sketches:
+            group_sketches[column] = QuantileSketch()
+        group_sketches[column].add(data_df[column].to_numpy(dtype = float))
+
+def update_sketches(
+                    sketches: dict,
+                    run_df: pandas.DataFrame,
+                    measurements: list[str],
+                    summary_columns: list[str],
+                    ):
+    # The raw measurements are sketched with all the rows, the summary columns with one row per mitochondria
+    run_df = run_df.reset_index()
+    sliced_df = run_df[~run_df.duplicated(subset = ["Run ID", "Mitochondria"], keep = 'last')]
+
+    _update_group(sketches["all"], run_df, measurements)
+    _update_group(sketches["all"], sliced_df, summary_columns)
+
+    if "Run Type" in run_df.columns:
+        for run_type, type_df in run_df.groupby("Run Type", sort = True):
+            type_sketches = sketches["Run Type"].setdefault(str(run_type), {})
+            _update_group(type_sketches, type_df, measurements)
+            _update_group(type_sketches, sliced_df.loc[sliced_df["Run Type"] == run_type], summary_columns)
+
+def merge_sketches(sketches: dict, other_sketches: dict):
+    for column, sketch in other_sketches["all"].items():
+        if column not in sketches["all"]:
+            sketches["all"][column] = QuantileSketch(sketch.relative_accuracy, sketch.min_value)
+        sketches["all"][column].merge(sketch)
+    for run_type, type_sketches in other_sketches["Run Type"].items():
+        merged_type_sketches = sketches["Run Type"].setdefault(run_type, {})
+        for column, sketch in type_sketches.items():
+            if column not in merged_type_sketches:
+                merged_type_sketches[column] = QuantileSketch(sketch.relative_accuracy, sketch.min_value)
+            merged_type_sketches[column].merge(sketch)
+
+def save_sketches(sketches: dict, data_directory: Path):
+    sketches_dict = {
+        "all": {column: sketch.to_dict() for column, sketch in sketches["all"].items()},
+        "Run Type": {
+            run_type: {column: sketch.to_dict() for column, sketch in type_sketches.items()}
+            for run_type, type_sketches in sketches["Run Type"].items()
+        },
+    }
+    background_writer.write_file(data_directory/"quantile_sketches.json", json.dumps(sketches_dict))
+
+def load_sketches(data_directory: Path, logger: logging.Logger = None):
+    sketch_file = data_directory/"quantile_sketches.json"
+    if not sketch_file.is_file():
+        if logger is not None:
+            logger.warning(f"There are no quantile sketches in {data_directory}")
+        return None
+
+    with open(sketch_file, 'r') as json_file:
+        sketches_dict = json.load(json_file)
+    return {
+        "all": {column: QuantileSketch.from_dict(sketch) for column, sketch in sketches_dict["all"].items()},
+        "Run Type": {
+            run_type: {column: QuantileSketch.from_dict(sketch) for column, sketch in type_sketches.items()}
+            for run_type, type_sketches in sketches_dict["Run Type"].items()
+        },
+    }
+
+def write_quantile_summary(
+                            sketches: dict,
+                            data_directory: Path,
+                            quantiles: list[float] = (0.05, 0.25, 0.5, 0.75, 0.95),
+                            ):
+    rows = []
+    groups = [("all", sketches["all"])] + sorted(sketches["Run Type"].items())
+    for group, group_sketches in groups:
+        for column, sketch in sorted(group_sketches.items()):
+            row = {
+                "Run Type": group,
+                "Column": column,
+                "Count": sketch.count,
+                "Min": sketch.min if sketch.count > 0 else math.nan,
+                "Max": sketch.max if sketch.count > 0 else math.nan,
+            }
+            for q in quantiles:
+                row[f'P{q*100:g}'] = sketch.quantile(q)
+            rows += [row]
+    background_writer.write_output(data_directory/"quantile_summary.csv", pandas.DataFrame(rows).to_csv(index = False))
+
+if __name__ == "__main__":
+    raise RuntimeError("Do not try to run this file, it is not a standalone script. It contains the quantile sketches used by the other scripts")
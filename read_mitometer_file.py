@@ -23,11 +23,26 @@
 from pathlib import Path
 import logging
 import pandas
-import pickle
+import math
+import os
+import collections
+import concurrent.futures
 
 import lip_pps_run_manager as RM
 
 import utilities
+import background_writer
+import run_lock
+import preview
+import progress
+import dashboard
+import plot_spec
+import input_catalog
+import motility
+import quantile_sketch
+import aggregate_cube
+import run_manifest
+import backup_store
 
 def plot_summary_task(
                         Tiago: RM.RunManager,
@@ -38,11 +53,11 @@ def plot_summary_task(
     if not Tiago.task_completed("read_mitometer"):
         raise RuntimeError("Only call the plotter task after the read mitometer task has successfully completed")
     else:
-        with open(Tiago.data_directory/"all_measurements.pkl", 'rb') as pickle_file:
-            all_measurements = pickle.load(pickle_file)
+        all_measurements = run_manifest.load_measurements(Tiago.data_directory, logger)
 
-        with Tiago.handle_task(task_name, drop_old_data=True, loop_iterations = len(all_measurements)) as Monet:
+        with Tiago.handle_task(task_name, drop_old_data=True, loop_iterations = len(all_measurements)) as Monet, progress.TaskProgress(Monet, len(all_measurements)), background_writer.BackgroundWriter(), plot_spec.PlotLevel("assay"):
             run_df = pandas.read_csv(Tiago.data_directory/"all_data.csv")
+            progress.count_read(len(run_df), Tiago.data_directory/"all_data.csv")
 
             # Get sliced df with a single value for each of the summary values
             run_df.set_index("Mitochondria", inplace=True)
@@ -116,6 +131,21 @@ def plot_summary_task(
 
                 Monet.loop_tick()
 
+            for column in motility.get_motility_columns(all_measurements):
+                if column not in sliced_df.columns:
+                    continue
+                utilities.make_histogram_plot(
+                    data_df = sliced_df,
+                    x_var = column,
+                    base_path = Monet.task_path,
+                    file_name = column.replace(" ", "_"),
+                    run_name = Monet.run_name,
+                    nbins = 100,
+                    logy = True,
+                    x_label = motility.motility_labels[column],
+                    marginal_type = marginal_type,
+                )
+
             mean_measurements = []
             median_measurements = []
             std_measurements = []
@@ -185,89 +215,286 @@ def plot_summary_task(
                 opacity = 0.5,
             )
 
+            dashboard.write_dashboard(Monet.task_path, Monet.run_name, all_measurements)
+
+# Number of measurement files read (and decompressed) in parallel
+default_read_workers = min(4, os.cpu_count())
+
+def build_measurement_df(
+                        file_df: pandas.DataFrame,
+                        measurement_name: str,
+                        ):
+    summary_df = pandas.DataFrame(index = file_df.index)
+
+    # Get measurements
+    measurements = file_df.columns
+
+    # Get means/medians
+    summary_df[f'{measurement_name} Mean'] = file_df[measurements].mean(axis = 1)
+    summary_df[f'{measurement_name} Standard Deviation'] = file_df[measurements].std(axis = 1)
+    summary_df[f'{measurement_name} Median'] = file_df[measurements].median(axis = 1)
+
+    # Get the motility summaries, computed for all the tracks at once
+    motility_df = motility.motility_summary(file_df[measurements], measurement_name)
+    for col in motility_df.columns:
+        summary_df[col] = motility_df[col]
+
+    # Create Mitochondria index
+    file_df = file_df.reset_index()
+    file_df.rename(columns={"index": "Mitochondria"}, inplace=True)
+    summary_df = summary_df.reset_index()
+    summary_df.rename(columns={"index": "Mitochondria"}, inplace=True)
+    summary_df.set_index("Mitochondria", inplace = True)
+
+    # Reorganise data into rows for each measurement
+    file_df = file_df.melt(id_vars=["Mitochondria"], var_name="Measurement", value_name=measurement_name)
+    file_df.set_index(["Mitochondria", "Measurement"], inplace = True)
+    file_df.sort_index(inplace=True)
+
+    # Drop empty rows?
+    file_df.dropna(inplace=True)
+
+    # Add summary columns
+    file_df.reset_index(level='Measurement', inplace=True)
+    for col in summary_df.columns:
+        file_df[col] = summary_df[col]
+    file_df.reset_index(inplace=True)
+    file_df.set_index(["Mitochondria", "Measurement"], inplace = True)
+
+    return file_df
+
+def add_run_columns(
+                    run_df: pandas.DataFrame,
+                    run_name: str,
+                    ):
+    ## Add some utility columns
+    # Add the run info
+    run_df["Run ID"] = run_name
+    if len(run_name.split("_")) == 2:
+        run_df["Run Type"] = run_name.split("_")[0]
+        run_df["Run Number"] = run_name.split("_")[1]
+
+    # Create category for no movement
+    run_df["Has Moved"] = (~(run_df["displacement"] == 0))
+
+def get_measurement_name(file: Path):
+    return input_catalog.parse_measurement_name(file.name)
+
+def count_file_rows(file: Path):
+    rows = 0
+    with input_catalog.open_input(file) as in_file:
+        for block in iter(lambda: in_file.read(1024*1024), b''):
+            rows += block.count(b'\n')
+    return rows
+
+def count_file_columns(file: Path):
+    with input_catalog.open_input(file) as in_file:
+        return len(in_file.readline().split(b","))
+
+def read_measurement_file(
+                            file: Path,
+                            sample_key: str = None,
+                            ):
+    # In preview mode only the mitochondria sampled for the assay (identified by sample_key) are read
+    if preview.get_preview() is not None:
+        file_df = preview.read_sampled_file(file, sample_key)
+    else:
+        with input_catalog.open_input(file) as in_file:
+            file_df = pandas.read_csv(in_file, header=None)
+    progress.count("rows", len(file_df))
+    return file_df
+
+def iter_measurement_files(
+                            file_list: list[Path],
+                            read_workers: int,
+                            sample_key: str = None,
+                            ):
+    # Read (and decompress) the files in parallel threads, yielding them in order with at most read_workers files in flight
+    with concurrent.futures.ThreadPoolExecutor(max_workers = read_workers) as executor:
+        futures = collections.deque()
+        for file in file_list:
+            futures.append(executor.submit(read_measurement_file, file, sample_key))
+            if len(futures) >= read_workers:
+                yield futures.popleft().result()
+        while len(futures) > 0:
+            yield futures.popleft().result()
+
+def estimate_chunk_rows(
+                        file_list: list[Path],
+                        memory_budget: float,
+                        ):
+    # Rough upper bound of the bytes needed per mitochondria (i.e. per row of the txt files):
+    #  - the wide chunk of each file (float64 per frame)
+    #  - the melted long form of each file (value + 2 index levels per frame), plus the summary columns
+    #  - the joined chunk, with 4 columns per measurement plus the run columns, for each frame
+    # The factor 2 accounts for the temporary copies pandas makes while melting, sorting and writing
+    frames = max(count_file_columns(file) for file in file_list)
+    measurements = len(file_list)
+    bytes_per_row = 2 * frames * 8 * (measurements * (1 + 3 + 3) + 4 * measurements + 6)
+
+    return max(1, int(memory_budget * 1024 * 1024 / bytes_per_row))
+
+def read_mitometer_chunked(
+                            Joana: RM.TaskManager,
+                            file_list: list[Path],
+                            chunk_rows: int,
+                            output_file: Path,
+                            logger: logging.Logger,
+                            read_workers: int = default_read_workers,
+                            ):
+    all_measurements = []
+    input_files = []
+    readers = []
+    for file in file_list:
+        measurement_name = get_measurement_name(file)
+
+        # Skip measurement types we do not care about
+        if measurement_name in ["fission", "fusion"]:
+            continue
+        all_measurements += [measurement_name]
+        input_files += [input_catalog.open_input(file)]
+        readers += [pandas.read_csv(input_files[-1], header=None, chunksize=chunk_rows)]
+
+    summary_columns = utilities.get_summary_columns(all_measurements)
+    sketches = quantile_sketch.new_sketches()
+    cube = aggregate_cube.new_cube()
+    description = None
+
+    # The rows of the first measurement define the rows of the output, the same way the
+    # full read uses the first file as the base dataframe
+    output_columns = None
+    # The readers and the input files are closed even if parsing a chunk fails
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers = read_workers) as executor:
+            while True:
+                # Read (and decompress) the next chunk of every file in parallel
+                file_chunks = list(executor.map(lambda reader: next(reader, None), readers))
+                if file_chunks[0] is None:
+                    break
+
+                chunk_df = None
+                for measurement_name, file_chunk in zip(all_measurements, file_chunks):
+                    if file_chunk is None:
+                        logger.warning(f"The file for measurement {measurement_name} has fewer rows than the first measurement file")
+                        continue
+                    progress.count("rows", len(file_chunk))
+
+                    file_df = build_measurement_df(file_chunk, measurement_name)
+
+                    if chunk_df is None:
+                        chunk_df = file_df
+                    else:
+                        for col in file_df:
+                            chunk_df[col] = file_df[col]
+
+                add_run_columns(chunk_df, Joana.run_name)
+                quantile_sketch.update_sketches(sketches, chunk_df, all_measurements, summary_columns)
+                aggregate_cube.update_cube(cube, chunk_df, all_measurements, summary_columns)
+                description = run_manifest.merge_descriptions(description, run_manifest.describe_data(chunk_df, all_measurements))
+
+                # Spill the chunk to disk, keeping the column order of the first chunk
+                if output_columns is None:
+                    output_columns = list(chunk_df.columns)
+                    chunk_df.to_csv(output_file)
+                else:
+                    chunk_df = chunk_df.reindex(columns = output_columns)
+                    chunk_df.to_csv(output_file, mode = 'a', header = False)
+
+                del chunk_df
+                Joana.loop_tick()
+    finally:
+        for reader in readers:
+            reader.close()
+        for input_file in input_files:
+            input_file.close()
+
+    return all_measurements, sketches, cube, description
+
 def read_mitometer_task(
                         Tiago: RM.RunManager,
                         mitometer_path: Path,
                         logger: logging.Logger,
+                        memory_budget: float = None,
+                        catalog: dict = None,
+                        input_hashes: dict[Path, str] = None,
+                        read_workers: int = default_read_workers,
                         ):
-    file_list = utilities.get_sorted_measurements_from_path(mitometer_path, logger, first_measurements = ["distance", "displacement"])
+    file_list = utilities.get_sorted_measurements_from_path(mitometer_path, logger, first_measurements = ["distance", "displacement"], catalog = catalog)
+
+    # The sample of a preview is small, it is always read at once
+    chunked = memory_budget is not None and preview.get_preview() is None
+    if chunked:
+        chunk_rows = estimate_chunk_rows(file_list, memory_budget)
+        loop_iterations = max(1, math.ceil(count_file_rows(file_list[0]) / chunk_rows))
+        logger.info(f"Reading the measurement files in chunks of {chunk_rows} mitochondria to stay within {memory_budget} MB")
+    else:
+        loop_iterations = len(file_list)
 
-    with Tiago.handle_task("read_mitometer", drop_old_data=True, loop_iterations = len(file_list)) as Joana:
-        run_df = None
-        all_measurements = []
-        for file in file_list:
-            # Get Measurement name
-            file_name: str = file.name
-            measurement_index = file_name.find(".tif_")
-            if measurement_index >= 0:
-                measurement_name = file_name[measurement_index+5:-4]
-            else:
-                measurement_name = file_name
+    with Tiago.handle_task("read_mitometer", drop_old_data=True, loop_iterations = loop_iterations) as Joana, progress.TaskProgress(Joana, loop_iterations), background_writer.BackgroundWriter():
+        if not Joana.data_directory.exists():
+            Joana.data_directory.mkdir()
 
+        if chunked:
+            # The chunks are appended to a temporary file which only replaces all_data.csv once complete
+            with background_writer.AtomicFile(Joana.data_directory/"all_data.csv") as output_file:
+                all_measurements, sketches, cube, description = read_mitometer_chunked(Joana, file_list, chunk_rows, output_file, logger, read_workers)
+        else:
             # Skip measurement types we do not care about
-            if measurement_name in ["fission", "fusion"]:
+            measurement_files = [file for file in file_list if get_measurement_name(file) not in ["fission", "fusion"]]
+            Joana.loop_tick(len(file_list) - len(measurement_files))
+
+            run_df = None
+            all_measurements = []
+            for file, file_df in zip(measurement_files, iter_measurement_files(measurement_files, read_workers, Joana.run_name)):
+                # Get Measurement name
+                measurement_name = get_measurement_name(file)
+                all_measurements += [measurement_name]
+
+                # Get base dataframes
+                file_df = build_measurement_df(file_df, measurement_name)
+
+                if run_df is None:
+                    run_df = file_df
+                else:
+                    for col in file_df:
+                        run_df[col] = file_df[col]
+
                 Joana.loop_tick()
-                continue
-            all_measurements += [measurement_name]
-
-            # Get base dataframes
-            file_df = pandas.read_csv(file, header=None)
-            summary_df = pandas.DataFrame()
-
-            # Get measurements
-            measurements = file_df.columns
-
-            # Get means/medians
-            summary_df[f'{measurement_name} Mean'] = file_df[measurements].mean(axis = 1)
-            summary_df[f'{measurement_name} Standard Deviation'] = file_df[measurements].std(axis = 1)
-            summary_df[f'{measurement_name} Median'] = file_df[measurements].median(axis = 1)
-
-            # Create Mitochondria index
-            file_df = file_df.reset_index()
-            file_df.rename(columns={"index": "Mitochondria"}, inplace=True)
-            summary_df = summary_df.reset_index()
-            summary_df.rename(columns={"index": "Mitochondria"}, inplace=True)
-            summary_df.set_index("Mitochondria", inplace = True)
-
-            # Reorganise data into rows for each measurement
-            file_df = file_df.melt(id_vars=["Mitochondria"], var_name="Measurement", value_name=measurement_name)
-            file_df.set_index(["Mitochondria", "Measurement"], inplace = True)
-            file_df.sort_index(inplace=True)
-
-            # Drop empty rows?
-            file_df.dropna(inplace=True)
-
-            # Add summary columns
-            file_df.reset_index(level='Measurement', inplace=True)
-            for col in summary_df.columns:
-                file_df[col] = summary_df[col]
-            file_df.reset_index(inplace=True)
-            file_df.set_index(["Mitochondria", "Measurement"], inplace = True)
-
-            if run_df is None:
-                run_df = file_df
-            else:
-                for col in file_df:
-                    run_df[col] = file_df[col]
-
-            Joana.loop_tick()
-
-        ## Add some utility columns
-        # Add the run info
-        run_df["Run ID"] = Joana.run_name
-        if len(Joana.run_name.split("_")) == 2:
-            run_df["Run Type"] = Joana.run_name.split("_")[0]
-            run_df["Run Number"] = Joana.run_name.split("_")[1]
-
-        # Create category for no movement
-        run_df["Has Moved"] = (~(run_df["displacement"] == 0))
 
-        if not Joana.data_directory.exists():
-            Joana.data_directory.mkdir()
-        run_df.to_csv(Joana.data_directory/"all_data.csv")
+            add_run_columns(run_df, Joana.run_name)
+
+            background_writer.write_csv(Joana.data_directory/"all_data.csv", run_df)
 
-        with open(Joana.data_directory/"all_measurements.pkl", 'wb') as pickle_file:
-            pickle.dump(all_measurements, pickle_file)
+            sketches = quantile_sketch.new_sketches()
+            quantile_sketch.update_sketches(sketches, run_df, all_measurements, utilities.get_summary_columns(all_measurements))
+            cube = aggregate_cube.new_cube()
+            aggregate_cube.update_cube(cube, run_df, all_measurements, utilities.get_summary_columns(all_measurements))
+            description = run_manifest.describe_data(run_df, all_measurements)
+
+        quantile_sketch.save_sketches(sketches, Joana.data_directory)
+        quantile_sketch.write_quantile_summary(sketches, Joana.data_directory)
+        aggregate_cube.save_cube(cube, Joana.data_directory)
+        aggregate_cube.write_cube_summary(cube, Joana.data_directory)
+
+        inputs = []
+        for file in file_list:
+            if get_measurement_name(file) not in all_measurements:
+                continue
+            inputs += [{
+                "path": str(file),
+                "size": input_catalog.get_input_stat(file).st_size,
+                "sha256": input_hashes[file] if input_hashes is not None and file in input_hashes else run_manifest.file_sha256(file),
+            }]
+
+        run_manifest.write_manifest(
+            data_directory = Joana.data_directory,
+            run_name = Joana.run_name,
+            level = "assay",
+            measurements = all_measurements,
+            description = description,
+            run_ids = [Joana.run_name],
+            inputs = inputs,
+        )
 
 def script_main(
                 mitometer_path: Path,
@@ -275,21 +502,26 @@ def script_main(
                 output_path: Path,
                 marginal_type: str = "rug",
                 disable_plots: bool = False,
+                memory_budget: float = None,
+                catalog: dict = None,
                 ):
     logger = logging.getLogger('read_mitometer_files')
 
-    with RM.RunManager(output_path / run_name) as Tiago:
+    if catalog is None:
+        catalog = input_catalog.build_catalog(mitometer_path, depth = 0, cache_directory = output_path, logger = logger)
+
+    with run_lock.RunLock(output_path / run_name, logger), RM.RunManager(output_path / run_name) as Tiago:
         Tiago.create_run(raise_error=False)
 
-        # Backup files for later reference
-        for file in mitometer_path.iterdir():
-            if not file.is_file():
-                continue
-            if file.suffix != ".txt":
-                continue
-            Tiago.backup_file(file)
+        # Backup files for later reference, each unique file is stored once in the store shared by the runs in the output path
+        input_hashes = backup_store.backup_files(
+            Tiago,
+            input_catalog.get_file_paths(catalog),
+            store_directory = output_path / backup_store.store_directory_name,
+            logger = logger,
+        )
 
-        read_mitometer_task(Tiago, mitometer_path, logger)
+        read_mitometer_task(Tiago, mitometer_path, logger, memory_budget, catalog, input_hashes)
         if not disable_plots:
             plot_summary_task(Tiago, logger, marginal_type)
 
@@ -345,6 +577,60 @@ if __name__ == "__main__":
         action = 'store_true',
         dest = 'disable_plots',
     )
+    parser.add_argument(
+        '--memoryBudget',
+        metavar = 'MB',
+        type = float,
+        help = 'If set, the measurement files of each assay are read in chunks of mitochondria and written to disk incrementally, keeping the memory used while reading below roughly this many MB',
+        default = None,
+        dest = 'memory_budget',
+    )
+    parser.add_argument(
+        '--preview',
+        metavar = 'N',
+        type = int,
+        help = 'If set, only a random sample of N mitochondria of each assay is read, the same in all the measurement files of the assay, for a quick look at the results. The outputs are labelled as a preview',
+        default = None,
+        dest = 'preview_rows',
+    )
+    parser.add_argument(
+        '--previewSeed',
+        metavar = 'SEED',
+        type = int,
+        help = 'Seed of the random sample of the mitochondria with --preview, the same seed samples the same mitochondria. Default: 0',
+        default = 0,
+        dest = 'preview_seed',
+    )
+    parser.add_argument(
+        '--progressInterval',
+        metavar = 'SECONDS',
+        type = float,
+        help = 'If set, a structured log line with the throughput (rows parsed, MB read, figures rendered and MB written per second) and the estimated time remaining of the running task and of the whole run is logged every SECONDS seconds, whatever the log level',
+        default = None,
+        dest = 'progress_interval',
+    )
+    parser.add_argument(
+        '--plotSpec',
+        metavar = 'PATH',
+        type = Path,
+        help = 'Path to a json plot spec selecting the measurements, statistics, groupings and kinds of the plots made at each level. Default: all the plots are made',
+        default = None,
+        dest = 'plot_spec',
+    )
+    parser.add_argument(
+        '--offlinePlots',
+        help = 'If set, the plots load plotly.js from a copy written in the output directory instead of from the internet',
+        action = 'store_true',
+        dest = 'offline_plots',
+    )
+    parser.add_argument(
+        '--mathjaxPath',
+        metavar = 'PATH',
+        type = Path,
+        help = 'Path to the MathJax.js file of a local MathJax installation, used by the plots with --offlinePlots. Without it the LaTeX in the plot labels is not rendered offline',
+        default = None,
+        dest = 'mathjax_path',
+    )
     parser.add_argument(
         '-l',
         '--log-level',
@@ -392,8 +678,38 @@ if __name__ == "__main__":
         exit(1)
     output_path = output_path.absolute()
 
+    if args.plot_spec is not None:
+        if not args.plot_spec.is_file():
+            logging.error("You must define a valid plot spec path")
+            exit(1)
+        try:
+            plot_spec.load_plot_spec(args.plot_spec)
+        except RuntimeError as error:
+            logging.error(f"You must define a valid plot spec: {error}")
+            exit(1)
+
+    if args.offline_plots:
+        mathjax_path: Path = args.mathjax_path
+        if mathjax_path is not None and not mathjax_path.is_file():
+            logging.error("You must define a valid MathJax path")
+            exit(1)
+        utilities.setup_offline_plot_assets(output_path, logging.getLogger("plot_assets"), mathjax_path)
+
     marginal_type: str = args.marginal_type
     if marginal_type == "None":
         marginal_type = None
 
-    script_main(mitometer_path, args.run_name, output_path, marginal_type, args.disable_plots)
\ No newline at end of file
+    if args.preview_rows is not None:
+        if args.preview_rows <= 0:
+            logging.error("You must define a positive number of mitochondria to preview")
+            exit(1)
+        preview.set_preview(args.preview_rows, args.preview_seed)
+        logging.warning(preview.get_preview_label())
+
+    if args.progress_interval is not None:
+        if args.progress_interval <= 0:
+            logging.error("You must define a positive progress interval")
+            exit(1)
+        progress.set_report_interval(args.progress_interval)
+
+    script_main(mitometer_path, args.run_name, output_path, marginal_type, args.disable_plots, args.memory_budget)
\ No newline at end of file
@@ -0,0 +1,183 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+from pathlib import Path
+import numbers
+
+import pandas
+
+import run_manifest
+import utilities
+
+# Lazy access to the data of a run made by any of the scripts, for instance:
+#   dataset = run_dataset.open_run(Path("output/processed_Ctrl"))
+#   volume_df = dataset.select(["Run Number", "Mitochondria", "Volume"]).filter({"Has Moved": True, "Run Number": [1, 2]}).to_pandas()
+# Nothing is read until the data is asked for. The filters are then pushed down to the storage: partitions which
+# do not match the filters on their keys are not opened, filters outside the min/max of a column in the manifest
+# do not read anything, only the selected and filtered columns are parsed and the rows are filtered chunk by chunk,
+# so only the requested rows and columns are ever held in memory
+default_chunk_rows = 100000
+
+def _as_values(values):
+    if isinstance(values, (list, tuple, set)):
+        return list(values)
+    return [values]
+
+def _is_number(value):
+    return isinstance(value, numbers.Number) and not isinstance(value, bool)
+
+class RunDataset:
+    def __init__(
+                    self,
+                    data_directory: Path,
+                    columns: list[str] = None,
+                    filters: dict = None,
+                    ):
+        self.data_directory = data_directory
+        self.manifest = run_manifest.load_manifest(data_directory)
+        self._columns = columns
+        self._filters = dict(filters) if filters is not None else {}
+
+    @property
+    def all_columns(self):
+        if self.manifest is not None:
+            return list(self.manifest["data"]["columns"])
+        return utilities.read_data_columns(self.data_directory)
+
+    @property
+    def columns(self):
+        if self._columns is None:
+            return self.all_columns
+        return list(self._columns)
+
+    @property
+    def filters(self):
+        return dict(self._filters)
+
+    @property
+    def measurements(self):
+        return run_manifest.load_measurements(self.data_directory)
+
+    def _check_columns(self, columns: list[str]):
+        all_columns = self.all_columns
+        for column in columns:
+            if column not in all_columns:
+                raise RuntimeError(f"There is no column {column} in the data of {self.data_directory}")
+
+    def select(self, columns: list[str]):
+        # A new dataset with only these columns
+        self._check_columns(columns)
+        return RunDataset(self.data_directory, list(columns), self._filters)
+
+    def filter(self, filters: dict):
+        # A new dataset with only the rows where each column has the value (or one of the list of values) in filters,
+        # filtering again on a column keeps the values in both filters
+        self._check_columns(list(filters))
+        merged_filters = dict(self._filters)
+        for column, values in filters.items():
+            values = _as_values(values)
+            if column in merged_filters:
+                kept = {str(value) for value in merged_filters[column]}
+                values = [value for value in values if str(value) in kept]
+            merged_filters[column] = values
+        return RunDataset(self.data_directory, self._columns, merged_filters)
+
+    def _is_empty(self):
+        # Filter values outside the range of a column in the manifest can not match any row
+        if self.manifest is None:
+            return False
+        for column, values in self._filters.items():
+            description = self.manifest["data"]["columns"].get(column, {})
+            min_value = description.get("min")
+            max_value = description.get("max")
+            if not _is_number(min_value) or not _is_number(max_value):
+                continue
+            if all(_is_number(value) and (value < min_value or value > max_value) for value in values):
+                return True
+        return False
+
+    def _get_sources(self):
+        # The csv files to read, with the filters which still have to be applied to their rows
+        partitions = utilities.list_partitions(self.data_directory)
+        if partitions is None:
+            return [(self.data_directory/"all_data.csv", self._filters)]
+
+        sources = []
+        for partition in partitions:
+            remaining_filters = {}
+            matches = True
+            for column, values in self._filters.items():
+                if column in partition:
+                    matches = matches and partition[column] in {str(value) for value in values}
+                else:
+                    remaining_filters[column] = values
+            if matches:
+                sources += [(partition["path"], remaining_filters)]
+        return sources
+
+    def iter_chunks(self, chunk_rows: int = default_chunk_rows):
+        # Yields the selected columns of the rows matching the filters, a chunk of at most chunk_rows read rows at a time
+        columns = self.columns
+        if self._is_empty():
+            return
+
+        use_columns = set(columns) | set(self._filters)
+        for source, filters in self._get_sources():
+            for chunk_df in pandas.read_csv(source, usecols = lambda column: column in use_columns, chunksize = chunk_rows):
+                for column, values in filters.items():
+                    chunk_df = chunk_df.loc[chunk_df[column].astype(str).isin({str(value) for value in values})]
+                if len(chunk_df) > 0:
+                    yield chunk_df[columns]
+
+    def to_pandas(self, chunk_rows: int = default_chunk_rows):
+        chunk_dfs = list(self.iter_chunks(chunk_rows))
+        if len(chunk_dfs) == 0:
+            return pandas.DataFrame(columns = self.columns)
+        return pandas.concat(chunk_dfs, ignore_index = True)
+
+    def count(self, chunk_rows: int = default_chunk_rows):
+        # The number of rows matching the filters, the rows of the manifest if there are no filters
+        if len(self._filters) == 0 and self.manifest is not None:
+            return self.manifest["data"]["rows"]
+        # Only the filtered columns are read
+        dataset = RunDataset(self.data_directory, list(self._filters) or self.all_columns[:1], self._filters)
+        return sum(len(chunk_df) for chunk_df in dataset.iter_chunks(chunk_rows))
+
+    def __repr__(self):
+        return f'RunDataset({self.data_directory}, columns = {self._columns}, filters = {self._filters})'
+
+def find_data_directory(run_path: Path):
+    # The data directory of a run, accepting either the run directory or its data directory
+    for directory in [run_path/"data", run_path]:
+        if utilities.has_data(directory):
+            return directory
+    return None
+
+def open_run(run_path: Path):
+    data_directory = find_data_directory(Path(run_path))
+    if data_directory is None:
+        raise RuntimeError(f"There is no run data in {run_path}, make sure the data of the run has been read or joined")
+    return RunDataset(data_directory)
+
+if __name__ == "__main__":
+    raise RuntimeError("Do not try to run this file, it is not a standalone script. It contains the query interface to the data of the runs")
@@ -0,0 +1,196 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+from pathlib import Path
+import logging
+import threading
+import socket
+import uuid
+import json
+import time
+import os
+
+# Lock of a run directory, taken by the scripts for as long as they write to the run, so two invocations sharing an
+# output path can not write to the same run at the same time. As for the work queue, the lock is a file created
+# with O_EXCL next to the run directory (.<run name>.lock, so it is not removed together with the run data) and its
+# mtime is a lease renewed while the run is written. A lock whose lease expired, or held by a process of the same
+# host which no longer exists, is stale and taken over. If the lock of a run is taken over while it is still being
+# written, the concurrent writer is detected when the lock is renewed or released and reported as an error
+default_lease_time = 60
+default_wait_interval = 0.1
+
+_held_locks = {}
+_held_locks_lock = threading.Lock()
+
+def get_lock_path(run_path: Path):
+    return run_path.with_name(f'.{run_path.name}.lock')
+
+def _read_lock(lock_path: Path):
+    try:
+        with open(lock_path, 'r') as json_file:
+            return json.load(json_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def _is_process_alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # The process exists but belongs to another user
+        return True
+    return True
+
+def _is_stale(lock_path: Path, lease_time: float):
+    try:
+        if time.time() - os.stat(lock_path).st_mtime > lease_time:
+            return True
+    except FileNotFoundError:
+        return False
+    holder = _read_lock(lock_path)
+    return holder is not None and holder["host"] == socket.gethostname() and not _is_process_alive(holder["pid"])
+
+def _describe_holder(holder: dict):
+    if holder is None:
+        return "another process"
+    acquired = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(holder["acquired"]))
+    return f'process {holder["pid"]} on {holder["host"]} (since {acquired})'
+
+def _break_stale_lock(
+                        lock_path: Path,
+                        lease_time: float,
+                        logger: logging.Logger,
+                        ):
+    # The lock is renamed away, only one of the processes trying to break it succeeds
+    stale_path = lock_path.with_name(f'{lock_path.name}.stale-{uuid.uuid4().hex}')
+    try:
+        os.rename(lock_path, stale_path)
+    except FileNotFoundError:
+        return
+
+    # Another process may have broken the stale lock and taken the run in the meantime, that lock is put back
+    if not _is_stale(stale_path, lease_time):
+        try:
+            os.link(stale_path, lock_path)
+        except FileExistsError:
+            pass
+        stale_path.unlink()
+        return
+
+    holder = _read_lock(stale_path)
+    stale_path.unlink()
+    logger.warning(f"Taking over the stale lock {lock_path} of {_describe_holder(holder)}")
+
+class RunLock:
+    def __init__(
+                    self,
+                    run_path: Path,
+                    logger: logging.Logger = None,
+                    lease_time: float = default_lease_time,
+                    wait: float = 0,
+                    ):
+        # With wait, a lock held by another process is waited for up to wait seconds instead of being an error
+        self.run_path = run_path.absolute()
+        self.lock_path = get_lock_path(self.run_path)
+        self.logger = logger if logger is not None else logging.getLogger('run_lock')
+        self.lease_time = lease_time
+        self.wait = wait
+        self.owner = uuid.uuid4().hex
+        self.lost = False
+        self._stop_event = threading.Event()
+        self._keeper = None
+
+    def owns_lock(self):
+        holder = _read_lock(self.lock_path)
+        return holder is not None and holder["owner"] == self.owner
+
+    def acquire(self):
+        deadline = time.monotonic() + self.wait
+        broken_locks = 0
+        while broken_locks < 3:
+            try:
+                lock_descriptor = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if _is_stale(self.lock_path, self.lease_time):
+                    _break_stale_lock(self.lock_path, self.lease_time, self.logger)
+                    broken_locks += 1
+                    continue
+                if time.monotonic() < deadline:
+                    time.sleep(default_wait_interval)
+                    continue
+                raise RuntimeError(f"The run {self.run_path.name} in {self.run_path.parent} is being written by {_describe_holder(_read_lock(self.lock_path))}, two invocations can not write to the same run at the same time")
+            with os.fdopen(lock_descriptor, 'w') as json_file:
+                json.dump({
+                    "owner": self.owner,
+                    "pid": os.getpid(),
+                    "host": socket.gethostname(),
+                    "acquired": time.time(),
+                }, json_file)
+            return
+        raise RuntimeError(f"Unable to take the lock of run {self.run_path.name} in {self.run_path.parent}")
+
+    def _keep(self):
+        # Renews the lease while the run is written, stopping if another process took the lock over
+        while not self._stop_event.wait(self.lease_time / 3):
+            if not self.owns_lock():
+                self.lost = True
+                self.logger.error(f"The lock of run {self.run_path.name} was taken over by {_describe_holder(_read_lock(self.lock_path))} while it was being written")
+                return
+            os.utime(self.lock_path)
+
+    def release(self):
+        self._stop_event.set()
+        if self._keeper is not None:
+            self._keeper.join()
+        if self.owns_lock():
+            self.lock_path.unlink()
+        else:
+            self.lost = True
+
+    def __enter__(self):
+        # The scripts call each other, a run already locked by this process is not locked again
+        with _held_locks_lock:
+            if self.run_path in _held_locks:
+                _held_locks[self.run_path] += 1
+                return self
+            self.acquire()
+            _held_locks[self.run_path] = 1
+
+        self._keeper = threading.Thread(target = self._keep, daemon = True)
+        self._keeper.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with _held_locks_lock:
+            _held_locks[self.run_path] -= 1
+            if _held_locks[self.run_path] > 0:
+                return False
+            del _held_locks[self.run_path]
+
+        self.release()
+        if self.lost and exc_type is None:
+            raise RuntimeError(f"Another process wrote to run {self.run_path.name} at the same time, its outputs may be inconsistent and should be remade")
+        return False
+
+if __name__ == "__main__":
+    raise RuntimeError("Do not try to run this file, it is not a standalone script. It contains the run directory locks used by the other scripts")
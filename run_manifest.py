@@ -0,0 +1,281 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+from pathlib import Path
+import logging
+import datetime
+import hashlib
+import pickle
+import json
+import math
+
+import numpy
+import pandas
+
+import input_catalog
+import background_writer
+import preview
+
+# The manifest is a json file written in the data directory of every run, describing the data products of the run
+# so that their contents can be discovered and planned for without loading the data
+manifest_version = 1
+manifest_name = "manifest.json"
+
+def file_sha256(file: Path):
+    # The hash is of the contents of the file, i.e. after decompressing compressed files and files inside archives
+    file_hash = hashlib.sha256()
+    with input_catalog.open_input(file) as in_file:
+        for block in iter(lambda: in_file.read(1024*1024), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def _to_json_value(value):
+    if value is None:
+        return None
+    if isinstance(value, (numpy.bool_, bool)):
+        return bool(value)
+    if isinstance(value, (numpy.integer, int)):
+        return int(value)
+    if isinstance(value, (numpy.floating, float)):
+        if math.isnan(value):
+            return None
+        return float(value)
+    return str(value)
+
+def _combine(a, b, function):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return function(a, b)
+
+def describe_data(
+                    data_df: pandas.DataFrame,
+                    measurements: list[str],
+                    ):
+    # Schema, row count and per column min/max of the data, as well as the number of rows and
+    # mitochondria with values for each measurement
+    data_df = data_df.reset_index()
+    description = {
+        "rows": len(data_df),
+        "columns": {},
+        "measurements": {},
+    }
+
+    for column in data_df.columns:
+        non_null = data_df[column].dropna()
+        column_description = {
+            "dtype": str(data_df[column].dtype),
+            "non_null": len(non_null),
+            "min": None,
+            "max": None,
+        }
+        if len(non_null) > 0:
+            try:
+                column_description["min"] = _to_json_value(non_null.min())
+                column_description["max"] = _to_json_value(non_null.max())
+            except TypeError:  # Columns with mixed types, there is no min/max
+                pass
+        description["columns"][str(column)] = column_description
+
+    mitochondria_keys = [key for key in ["Run ID", "Mitochondria"] if key in data_df.columns]
+    for measurement in measurements:
+        if measurement not in data_df.columns:
+            continue
+        measurement_df = data_df.loc[data_df[measurement].notna(), mitochondria_keys]
+        description["measurements"][measurement] = {
+            "rows": len(measurement_df),
+            "mitochondria": len(measurement_df.drop_duplicates()),
+        }
+
+    return description
+
+def merge_descriptions(
+                        description: dict,
+                        other: dict,
+                        ):
+    # Combine the descriptions of disjoint sets of mitochondria (i.e. different chunks, assays or experiments)
+    if description is None:
+        return other
+    if other is None:
+        return description
+
+    merged = {
+        "rows": description["rows"] + other["rows"],
+        "columns": {},
+        "measurements": {},
+    }
+
+    for column in list(description["columns"]) + [column for column in other["columns"] if column not in description["columns"]]:
+        a = description["columns"].get(column)
+        b = other["columns"].get(column)
+        if a is None or b is None:
+            merged["columns"][column] = dict(a if a is not None else b)
+            continue
+        merged["columns"][column] = {
+            "dtype": a["dtype"] if a["dtype"] == b["dtype"] else "object",
+            "non_null": a["non_null"] + b["non_null"],
+            "min": None,
+            "max": None,
+        }
+        try:
+            merged["columns"][column]["min"] = _combine(a["min"], b["min"], min)
+            merged["columns"][column]["max"] = _combine(a["max"], b["max"], max)
+        except TypeError:
+            pass
+
+    for measurement in set(description["measurements"]) | set(other["measurements"]):
+        a = description["measurements"].get(measurement, {"rows": 0, "mitochondria": 0})
+        b = other["measurements"].get(measurement, {"rows": 0, "mitochondria": 0})
+        merged["measurements"][measurement] = {
+            "rows": a["rows"] + b["rows"],
+            "mitochondria": a["mitochondria"] + b["mitochondria"],
+        }
+
+    return merged
+
+def intersect_measurements(measurement_lists: list[list[str]]):
+    # Keep the order of the first list, as done by the joiners
+    if len(measurement_lists) == 0:
+        return []
+    merged_measurements = measurement_lists[0]
+    for measurements in measurement_lists[1:]:
+        merged_measurements = [measurement for measurement in merged_measurements if measurement in measurements]
+    return merged_measurements
+
+def get_output_sizes(data_directory: Path):
+    background_writer.flush_outputs()
+    sizes = {}
+    for file in sorted(data_directory.rglob("*")):
+        if not file.is_file() or file.name == manifest_name:
+            continue
+        sizes[file.relative_to(data_directory).as_posix()] = file.stat().st_size
+    return sizes
+
+def write_manifest(
+                    data_directory: Path,
+                    run_name: str,
+                    level: str,
+                    measurements: list[str],
+                    description: dict,
+                    run_ids: list[str],
+                    inputs: list[dict],
+                    ):
+    manifest = {
+        "manifest_version": manifest_version,
+        "run_name": run_name,
+        "level": level,
+        "created": datetime.datetime.now().isoformat(),
+        "measurements": measurements,
+        "run_ids": sorted(run_ids),
+        "data": description,
+        "inputs": inputs,
+        "outputs": get_output_sizes(data_directory),
+        "preview": preview.get_preview(),
+    }
+
+    background_writer.write_file(data_directory/manifest_name, json.dumps(manifest, indent = 2))
+
+    return manifest
+
+def update_outputs(data_directory: Path):
+    # Refresh the output file sizes after adding data products to an existing manifest
+    manifest = load_manifest(data_directory)
+    if manifest is None:
+        return
+    manifest["outputs"] = get_output_sizes(data_directory)
+    background_writer.write_file(data_directory/manifest_name, json.dumps(manifest, indent = 2))
+
+def load_manifest(data_directory: Path):
+    manifest_file = data_directory/manifest_name
+    if not manifest_file.is_file():
+        return None
+    with open(manifest_file, 'r') as json_file:
+        return json.load(json_file)
+
+def get_input_reference(data_directory: Path):
+    # A joined run references its children through their manifests, which identify the data they contain
+    manifest_file = data_directory/manifest_name
+    return {
+        "path": str(manifest_file),
+        "size": manifest_file.stat().st_size,
+        "sha256": file_sha256(manifest_file),
+    }
+
+def load_measurements(data_directory: Path, logger: logging.Logger = None):
+    manifest = load_manifest(data_directory)
+    if manifest is not None:
+        return manifest["measurements"]
+
+    # Runs processed before the manifests existed only have the pickled list of measurements
+    if logger is not None:
+        logger.warning(f"There is no manifest in {data_directory}, falling back to all_measurements.pkl")
+    with open(data_directory/"all_measurements.pkl", 'rb') as pickle_file:
+        return pickle.load(pickle_file)
+
+def plan_join(
+                data_directories: list[Path],
+                logger: logging.Logger = None,
+                ):
+    # Measurements in common, total rows and a rough estimate of the memory needed to join the data of
+    # several runs, computed from their manifests without reading the data
+    measurement_lists = []
+    rows = 0
+    columns = set()
+    for data_directory in data_directories:
+        manifest = load_manifest(data_directory)
+        if manifest is None:
+            measurement_lists += [load_measurements(data_directory, logger)]
+            rows = None
+            continue
+        measurement_lists += [manifest["measurements"]]
+        columns.update(manifest["data"]["columns"])
+        if rows is not None:
+            rows += manifest["data"]["rows"]
+
+    return {
+        "measurements": intersect_measurements(measurement_lists),
+        "rows": rows,
+        "memory": None if rows is None else rows * len(columns) * 8,
+    }
+
+def describe_child(
+                    data_directory: Path,
+                    data_df: pandas.DataFrame,
+                    logger: logging.Logger = None,
+                    ):
+    # Description, Run IDs and input reference of a run being joined, from its manifest when there is one
+    manifest = load_manifest(data_directory)
+    if manifest is not None:
+        return manifest["data"], manifest["run_ids"], get_input_reference(data_directory)
+
+    measurements = load_measurements(data_directory, logger)
+    input_reference = {
+        "path": str(data_directory/"all_data.csv"),
+        "size": (data_directory/"all_data.csv").stat().st_size,
+        "sha256": None,
+    }
+    return describe_data(data_df, measurements), [str(run_id) for run_id in data_df["Run ID"].unique()], input_reference
+
+if __name__ == "__main__":
+    raise RuntimeError("Do not try to run this file, it is not a standalone script. It contains the run manifest utilities used by the other scripts")
@@ -0,0 +1,185 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+import math
+import itertools
+import concurrent.futures
+
+import numpy
+import pandas
+
+def ks_test(
+            a: numpy.ndarray,
+            b: numpy.ndarray,
+            ):
+    # Two sample Kolmogorov-Smirnov test, with the asymptotic distribution for the p-value
+    a = numpy.sort(a)
+    b = numpy.sort(b)
+    all_values = numpy.concatenate([a, b])
+    cdf_a = numpy.searchsorted(a, all_values, side = 'right') / len(a)
+    cdf_b = numpy.searchsorted(b, all_values, side = 'right') / len(b)
+    statistic = numpy.max(numpy.abs(cdf_a - cdf_b))
+
+    effective_n = len(a) * len(b) / (len(a) + len(b))
+    lam = (math.sqrt(effective_n) + 0.12 + 0.11 / math.sqrt(effective_n)) * statistic
+    if lam < 1e-3:
+        return statistic, 1.0
+    k = numpy.arange(1, 101)
+    p_value = 2 * numpy.sum((-1)**(k - 1) * numpy.exp(-2 * k**2 * lam**2))
+
+    return statistic, float(min(max(p_value, 0), 1))
+
+def mann_whitney_test(
+                        a: numpy.ndarray,
+                        b: numpy.ndarray,
+                        ):
+    # Two sided Mann-Whitney U test, with the normal approximation corrected for ties and continuity
+    n_a = len(a)
+    n_b = len(b)
+    all_values = numpy.concatenate([a, b])
+    ranks = pandas.Series(all_values).rank(method = 'average').to_numpy()
+    statistic = ranks[:n_a].sum() - n_a * (n_a + 1) / 2
+
+    _, tie_counts = numpy.unique(all_values, return_counts = True)
+    n = n_a + n_b
+    tie_term = (tie_counts**3 - tie_counts).sum() / (n * (n - 1))
+    sigma = math.sqrt(n_a * n_b / 12 * ((n + 1) - tie_term))
+    if sigma == 0:
+        return statistic, 1.0
+    z = (abs(statistic - n_a * n_b / 2) - 0.5) / sigma
+    p_value = math.erfc(max(z, 0) / math.sqrt(2))
+
+    return statistic, min(p_value, 1.0)
+
+def bootstrap_statistics(
+                            values: numpy.ndarray,
+                            n_resamples: int,
+                            rng: numpy.random.Generator,
+                            max_batch_elements: int = 10_000_000,
+                            ):
+    # Bootstrap distribution of the mean and median, resampling in batches to bound the memory used
+    batch_size = max(1, min(n_resamples, max_batch_elements // len(values)))
+    means = numpy.empty(n_resamples)
+    medians = numpy.empty(n_resamples)
+
+    for start in range(0, n_resamples, batch_size):
+        stop = min(start + batch_size, n_resamples)
+        samples = values[rng.integers(0, len(values), size = (stop - start, len(values)))]
+        means[start:stop] = samples.mean(axis = 1)
+        medians[start:stop] = numpy.median(samples, axis = 1)
+
+    return means, medians
+
+def compare_column(
+                    column: str,
+                    groups: dict[str, numpy.ndarray],
+                    n_resamples: int,
+                    confidence: float,
+                    seed: numpy.random.SeedSequence,
+                    ):
+    rng = numpy.random.default_rng(seed)
+    quantiles = [(1 - confidence) / 2, (1 + confidence) / 2]
+
+    bootstrap = {}
+    for run_type in groups:
+        bootstrap[run_type] = bootstrap_statistics(groups[run_type], n_resamples, rng)
+
+    results = []
+    for type_a, type_b in itertools.combinations(groups, 2):
+        a = groups[type_a]
+        b = groups[type_b]
+
+        ks_statistic, ks_p_value = ks_test(a, b)
+        mw_statistic, mw_p_value = mann_whitney_test(a, b)
+
+        mean_difference = bootstrap[type_b][0] - bootstrap[type_a][0]
+        median_difference = bootstrap[type_b][1] - bootstrap[type_a][1]
+        mean_ci = numpy.quantile(mean_difference, quantiles)
+        median_ci = numpy.quantile(median_difference, quantiles)
+
+        results += [{
+            "Column": column,
+            "Run Type A": type_a,
+            "Run Type B": type_b,
+            "N A": len(a),
+            "N B": len(b),
+            "Mean A": a.mean(),
+            "Mean B": b.mean(),
+            "Mean Difference": b.mean() - a.mean(),
+            "Mean Difference CI Low": mean_ci[0],
+            "Mean Difference CI High": mean_ci[1],
+            "Median A": numpy.median(a),
+            "Median B": numpy.median(b),
+            "Median Difference": numpy.median(b) - numpy.median(a),
+            "Median Difference CI Low": median_ci[0],
+            "Median Difference CI High": median_ci[1],
+            "KS Statistic": ks_statistic,
+            "KS p-value": ks_p_value,
+            "Mann-Whitney U": mw_statistic,
+            "Mann-Whitney p-value": mw_p_value,
+        }]
+
+    return results
+
+def get_column_groups(
+                        data_df: pandas.DataFrame,
+                        column: str,
+                        group_var: str = "Run Type",
+                        ):
+    groups = {}
+    for group, group_df in data_df.groupby(group_var, sort = True):
+        values = group_df[column].dropna().to_numpy(dtype = float)
+        if len(values) > 0:
+            groups[str(group)] = values
+    return groups
+
+def compare_run_types(
+                        full_df: pandas.DataFrame,
+                        sliced_df: pandas.DataFrame,
+                        measurement_columns: list[str],
+                        summary_columns: list[str],
+                        n_resamples: int = 10000,
+                        confidence: float = 0.95,
+                        workers: int = None,
+                        seed: int = 0,
+                        ):
+    # The raw measurements are compared with all the rows, the summary columns with one row per mitochondria
+    jobs = []
+    for column in measurement_columns:
+        jobs += [(column, get_column_groups(full_df, column))]
+    for column in summary_columns:
+        jobs += [(column, get_column_groups(sliced_df, column))]
+    jobs = [(column, groups) for column, groups in jobs if len(groups) > 1]
+
+    seeds = numpy.random.SeedSequence(seed).spawn(len(jobs))
+
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as executor:
+        futures = [executor.submit(compare_column, column, groups, n_resamples, confidence, job_seed) for (column, groups), job_seed in zip(jobs, seeds)]
+        for future in futures:
+            results += future.result()
+
+    return pandas.DataFrame(results)
+
+if __name__ == "__main__":
+    raise RuntimeError("Do not try to run this file, it is not a standalone script. It contains the statistical comparison used by the other scripts")
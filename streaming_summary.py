@@ -0,0 +1,221 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+from pathlib import Path
+import logging
+import math
+
+import numpy
+import pandas
+
+import quantile_sketch
+import run_manifest
+
+# Out of core summary of a joined data set which does not fit in memory. The data is read in chunks and each chunk
+# is added to histograms with fixed bins (from the min/max in the manifest), quantile sketches for the box plots
+# and a uniform random sample of the rows for the scatter and violin plots, all kept for the finest grouping
+# (Run Type, Run ID, Has Moved) and merged into the groups of each plot when it is made. The memory used depends on
+# the number of groups, bins and sampled rows but not on the number of rows.
+# The plotting functions in utilities accept a StreamedData in place of a dataframe
+group_columns = ["Run Type", "Run ID", "Has Moved"]
+default_bins = 100
+default_sample_size = 10000
+
+def get_bin_edges(column_description: dict, bins: int = default_bins):
+    min_value = column_description.get("min")
+    max_value = column_description.get("max")
+    if min_value is None or max_value is None:
+        return numpy.linspace(0, 1, bins + 1)
+    if min_value == max_value:
+        return numpy.linspace(min_value - 0.5, max_value + 0.5, bins + 1)
+    return numpy.linspace(min_value, max_value, bins + 1)
+
+def get_box_statistics(sketch: quantile_sketch.QuantileSketch):
+    q1 = sketch.quantile(0.25)
+    median = sketch.quantile(0.5)
+    q3 = sketch.quantile(0.75)
+    iqr = q3 - q1
+    return {
+        "q1": q1,
+        "median": median,
+        "q3": q3,
+        "lowerfence": max(sketch.min, q1 - 1.5*iqr),
+        "upperfence": min(sketch.max, q3 + 1.5*iqr),
+        "notchspan": 1.57*iqr/math.sqrt(sketch.count),
+    }
+
+class StreamedData:
+    def __init__(
+                    self,
+                    columns: list[str],
+                    description: dict,
+                    sample_size: int = default_sample_size,
+                    seed: int = 0,
+                    bins: int = default_bins,
+                    ):
+        self.columns = [column for column in columns if column in description["columns"]]
+        self.edges = {column: get_bin_edges(description["columns"][column], bins) for column in self.columns}
+        self.sample_size = sample_size
+        self.rows = 0
+        self.sample = None
+        self._sample_keys = numpy.empty(0)
+        self._rng = numpy.random.default_rng(seed)
+        self._group_columns = []
+        self._histograms = {}
+        self._sketches = {}
+
+    def add(self, data_df: pandas.DataFrame):
+        if len(data_df) == 0:
+            return
+        self.rows += len(data_df)
+        self._group_columns = [column for column in group_columns if column in data_df.columns]
+
+        for key, group_df in data_df.groupby(self._group_columns, sort = False, dropna = False):
+            for column in self.columns:
+                values = group_df[column].to_numpy(dtype = float)
+                values = values[~numpy.isnan(values)]
+                counts, _ = numpy.histogram(values, bins = self.edges[column])
+                if (column, key) not in self._histograms:
+                    self._histograms[(column, key)] = counts
+                    self._sketches[(column, key)] = quantile_sketch.QuantileSketch()
+                else:
+                    self._histograms[(column, key)] += counts
+                self._sketches[(column, key)].add(values)
+
+        self._add_to_sample(data_df[self._group_columns + self.columns])
+
+    def _add_to_sample(self, data_df: pandas.DataFrame):
+        # Reservoir sampling: every row gets a random key and the rows with the smallest keys are kept
+        keys = self._rng.random(len(data_df))
+        if len(data_df) > self.sample_size:
+            keep = numpy.argpartition(keys, self.sample_size)[:self.sample_size]
+            data_df = data_df.iloc[numpy.sort(keep)]
+            keys = keys[numpy.sort(keep)]
+
+        if self.sample is None:
+            self.sample = data_df.reset_index(drop = True)
+            self._sample_keys = keys
+            return
+
+        sample = pandas.concat([self.sample, data_df], ignore_index = True)
+        keys = numpy.concatenate([self._sample_keys, keys])
+        if len(sample) > self.sample_size:
+            keep = numpy.sort(numpy.argpartition(keys, self.sample_size)[:self.sample_size])
+            sample = sample.iloc[keep].reset_index(drop = True)
+            keys = keys[keep]
+        self.sample = sample
+        self._sample_keys = keys
+
+    def _merge_groups(self, column: str, group_vars: list[str], values: dict, merge):
+        # Merge the finest groups into the groups of group_vars, keyed by the tuple of their values
+        indices = [self._group_columns.index(var) for var in group_vars]
+        merged = {}
+        for (value_column, key), value in values.items():
+            if value_column != column:
+                continue
+            if not isinstance(key, tuple):
+                key = (key,)
+            group_key = tuple(key[index] for index in indices)
+            merged[group_key] = merge(merged.get(group_key), value)
+        return dict(sorted(merged.items(), key = lambda item: tuple(str(value) for value in item[0])))
+
+    def get_histograms(self, column: str, group_vars: list[str]):
+        return self._merge_groups(column, group_vars, self._histograms, lambda a, b: b.copy() if a is None else a + b)
+
+    def get_sketches(self, column: str, group_vars: list[str]):
+        def merge(a, b):
+            if a is None:
+                a = quantile_sketch.QuantileSketch(b.relative_accuracy, b.min_value)
+            a.merge(b)
+            return a
+        return self._merge_groups(column, group_vars, self._sketches, merge)
+
+    def get_sample_values(self, column: str, group_vars: list[str], group_key: tuple):
+        sample = self.sample
+        for var, value in zip(group_vars, group_key):
+            sample = sample.loc[sample[var] == value]
+        return sample[column].dropna().to_numpy()
+
+    def get_sample_title(self):
+        return f'Random sample of {len(self.sample)} of {self.rows} rows'
+
+def get_chunk_rows(
+                    data_directory: Path,
+                    memory_budget: float,
+                    ):
+    # Number of rows to read at a time if the data of the run needs more than memory_budget MB, None if it fits
+    if memory_budget is None:
+        return None
+    manifest = run_manifest.load_manifest(data_directory)
+    if manifest is None:
+        return None
+    columns = len(manifest["data"]["columns"])
+    if manifest["data"]["rows"] * columns * 8 <= memory_budget*1024*1024:
+        return None
+    # Parsing needs about twice the memory of the parsed chunk
+    return max(1000, int(memory_budget*1024*1024 / (columns * 8 * 2)))
+
+def stream_summary_data(
+                        data_directory: Path,
+                        measurements: list[str],
+                        summary_columns: list[str],
+                        chunk_rows: int,
+                        logger: logging.Logger = None,
+                        sample_size: int = default_sample_size,
+                        seed: int = 0,
+                        ):
+    # Returns the StreamedData of all the rows (for the measurements) and of one row per mitochondria (for the summary columns)
+    import utilities
+
+    description = run_manifest.load_manifest(data_directory)["data"]
+    full_data = StreamedData(measurements, description, sample_size, seed)
+    sliced_data = StreamedData(summary_columns, description, sample_size, seed + 1)
+
+    key_columns = ["Run ID", "Mitochondria"]
+    use_columns = set(key_columns + group_columns + full_data.columns + sliced_data.columns)
+
+    # The data is sorted by run and mitochondria (and each partition holds whole runs), so the rows of a mitochondria
+    # are contiguous, but they may be split across chunks, so the last row of each chunk is only counted once the next chunk is known
+    pending_row = None
+    chunks = 0
+    for chunk_df in utilities.iter_data_chunks(data_directory, chunk_rows, usecols = lambda column: column in use_columns):
+        full_data.add(chunk_df)
+
+        keys = chunk_df[key_columns]
+        is_last = (keys != keys.shift(-1)).any(axis = 1).to_numpy(copy = True)
+        is_last[-1] = False
+        if pending_row is not None and tuple(pending_row[key_columns].iloc[0]) != tuple(keys.iloc[0]):
+            sliced_data.add(pending_row)
+        sliced_data.add(chunk_df.loc[is_last])
+        pending_row = chunk_df.iloc[[-1]]
+
+        chunks += 1
+        if logger is not None:
+            logger.debug(f"Summarised chunk {chunks} with {full_data.rows} rows so far")
+    if pending_row is not None:
+        sliced_data.add(pending_row)
+
+    return full_data, sliced_data
+
+if __name__ == "__main__":
+    raise RuntimeError("Do not try to run this file, it is not a standalone script. It contains the out of core summary used by the other scripts")
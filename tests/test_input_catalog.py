@@ -0,0 +1,91 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+from pathlib import Path
+import tarfile
+import zipfile
+
+import input_catalog
+
+measurement_files = ["cell.tif_displacement.txt", "cell.tif_distance.txt"]
+
+def make_assays(directory: Path, assays: list[str]):
+    for assay in assays:
+        (directory / assay).mkdir(parents = True)
+        for file_name in measurement_files:
+            (directory / assay / file_name).write_text(f'{assay},1,2\n')
+
+def make_tar(archive_path: Path, source: Path, top_directory: str):
+    with tarfile.open(archive_path, 'w:gz') as archive:
+        archive.add(source, arcname = top_directory)
+
+def get_assays(catalog: dict, experiment: str):
+    experiment_node = next(node for node in catalog["directories"] if node["name"] == experiment)
+    return {node["name"]: [file["name"] for file in node["files"]] for node in experiment_node["directories"]}
+
+def test_experiment_archive_with_one_assay(tmp_path):
+    make_assays(tmp_path / "source" / "Ctrl", ["1"])
+    make_assays(tmp_path / "comparison" / "Plain", ["1"])
+    make_tar(tmp_path / "comparison" / "Ctrl.tar.gz", tmp_path / "source" / "Ctrl", "Ctrl")
+
+    catalog = input_catalog.build_catalog(tmp_path / "comparison", 2)
+
+    assert get_assays(catalog, "Plain") == {"1": measurement_files}
+    assert get_assays(catalog, "Ctrl") == {"1": measurement_files}
+
+def test_experiment_archive_with_several_assays(tmp_path):
+    make_assays(tmp_path / "source" / "Ctrl", ["1", "2"])
+    (tmp_path / "comparison").mkdir()
+    make_tar(tmp_path / "comparison" / "Ctrl.tar.gz", tmp_path / "source" / "Ctrl", "Ctrl")
+
+    catalog = input_catalog.build_catalog(tmp_path / "comparison", 2)
+
+    assert get_assays(catalog, "Ctrl") == {"1": measurement_files, "2": measurement_files}
+
+    experiment_node = catalog["directories"][0]
+    for assay_node in experiment_node["directories"]:
+        for file in input_catalog.get_file_paths(assay_node):
+            with input_catalog.open_input(file) as in_file:
+                assert in_file.read() == f'{assay_node["name"]},1,2\n'.encode()
+
+def test_archive_without_top_directory(tmp_path):
+    make_assays(tmp_path / "source", ["1"])
+    (tmp_path / "experiment").mkdir()
+    with zipfile.ZipFile(tmp_path / "experiment" / "1.zip", 'w') as archive:
+        for file_name in measurement_files:
+            archive.write(tmp_path / "source" / "1" / file_name, arcname = file_name)
+
+    catalog = input_catalog.build_catalog(tmp_path / "experiment", 1)
+
+    assert [node["name"] for node in catalog["directories"]] == ["1"]
+    assert [file["name"] for file in catalog["directories"][0]["files"]] == measurement_files
+
+def test_top_directory_not_named_as_archive(tmp_path):
+    # Only a top directory with the name of the archive is skipped
+    make_assays(tmp_path / "source" / "export", ["1"])
+    (tmp_path / "comparison").mkdir()
+    make_tar(tmp_path / "comparison" / "Ctrl.tar.gz", tmp_path / "source" / "export", "export")
+
+    catalog = input_catalog.build_catalog(tmp_path / "comparison", 2)
+
+    assert list(get_assays(catalog, "Ctrl")) == ["export"]
@@ -0,0 +1,53 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+
+from pathlib import Path
+import subprocess
+import sys
+
+repository = Path(__file__).parent.parent
+own_modules = {path.stem for path in repository.glob("*.py")}
+
+# The import time of the scripts' own modules (without their dependencies) for the data only path, in us
+own_import_budget = 50000
+
+def import_times(statement: str):
+    # The self and cumulative import time in us of each module imported by statement, from python -X importtime
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], cwd = repository, capture_output = True, text = True, check = True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, cumulative_time, module = line[len("import time:"):].split("|")
+        times[module.strip()] = (int(self_time), int(cumulative_time))
+    return times
+
+def test_data_only_path_does_not_import_plotly():
+    times = import_times("import compare_experiments")
+    assert not any(module == "plotly" or module.startswith("plotly.") for module in times)
+
+def test_own_modules_import_budget():
+    times = import_times("import compare_experiments")
+    own_time = sum(self_time for module, (self_time, _) in times.items() if module in own_modules)
+    assert own_time < own_import_budget
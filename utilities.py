@@ -26,12 +26,21 @@ import enum
 import datetime
 import sqlite3
 import hashlib
+import shutil
+import urllib.parse
+import os
 
-import plotly.express as px
-import plotly.graph_objects as go
-
+import numpy
 import pandas
 
+import input_catalog
+import background_writer
+import streaming_summary
+import plot_spec
+import aggregate_cube
+import preview
+import progress
+
 myMeasurementDict = {
     "Volume": {
         "label": r"$\text{Volume }[\mu m^3]$",
@@ -73,36 +82,30 @@ def measurement_to_label(measurement: str):
         raise RuntimeError(f"Unknown measurement: {measurement}")
     return myMeasurementDict[measurement]["label"]
 
-def get_sorted_measurements_from_path(mitometer_path: Path, logger: logging.Logger, first_measurements: list[str] = [], raise_exception: bool = False):
-    file_list = []
-    first_measurement_file = {}
-    for measurement in first_measurements:
-        first_measurement_file[measurement] = None
+def get_summary_columns(all_measurements: list[str]):
+    import motility
 
-    for file in mitometer_path.iterdir():
-        if not file.is_file():
-            continue
-        if file.suffix != ".txt":
-            continue
-        file_list += [file]
+    summary_columns = []
+    for measurement in all_measurements:
+        summary_columns += [f'{measurement} Mean', f'{measurement} Standard Deviation', f'{measurement} Median']
+    return summary_columns + motility.get_motility_columns(all_measurements)
 
-        if len(first_measurements) > 0:
-            file_name: str = file.name
-            measurement_index = file_name.find(".tif_")
-            if measurement_index >= 0:
-                measurement_name = file_name[measurement_index+5:-4]
-            else:
-                measurement_name = file_name
-            if measurement_name in first_measurements:
-                first_measurement_file[measurement_name] = file
+def get_sorted_measurements_from_path(mitometer_path: Path, logger: logging.Logger, first_measurements: list[str] = None, raise_exception: bool = False, catalog: dict = None):
+    if catalog is None:
+        catalog = input_catalog.scan_directory(mitometer_path, depth = 0)
+
+    file_list = input_catalog.get_file_paths(catalog)
 
-    file_list.sort()
+    if first_measurements is not None and len(first_measurements) > 0:
+        measurement_files = {}
+        for file_entry in catalog["files"]:
+            if input_catalog.is_measurement_file(file_entry["name"]):
+                measurement_files[file_entry["measurement"]] = Path(catalog["path"]) / file_entry["name"]
 
-    if len(first_measurements) > 0:
         # Bring forth the first first measurement found, just to guarantee that specific files are processed first
         bring_forth = None
         for measurement in first_measurements:
-            bring_forth = first_measurement_file[measurement]
+            bring_forth = measurement_files.get(measurement)
             if bring_forth is not None:
                 break
 
@@ -113,14 +116,333 @@ def get_sorted_measurements_from_path(mitometer_path: Path, logger: logging.Logg
             else:
                 raise RuntimeError(error_msg)
         else:
-            old_list = file_list
-            file_list = [bring_forth]
-            for file in old_list:
-                if file not in file_list:
-                    file_list += [file]
+            file_list = [bring_forth] + [file for file in file_list if file != bring_forth]
 
     return file_list
 
+partition_keys = ["Run Type", "Run Number"]
+
+def get_partition_path(partition_directory: Path, keys: list[str], values: tuple):
+    path = partition_directory
+    for key, value in zip(keys, values):
+        path = path / f'{key}={urllib.parse.quote(str(value), safe="")}'
+    return path
+
+def write_partitions(
+                        data_df: pandas.DataFrame,
+                        data_directory: Path,
+                        replace: bool = True,
+                        ):
+    # Write the data in a directory per partition (Hive style), i.e. partitions/Run Type=<type>/Run Number=<number>/all_data.csv
+    # The partition columns are kept in the files so each partition reads back exactly as the rows of the joined data
+    # The joined runs are only written as partitions, data without the partition columns is a single partitions/all_data.csv
+    # When replacing, the new partitions are written to a temporary directory which is swapped with the old one once
+    # all of them are written, so the partitions are never seen half written
+    partition_directory = data_directory / "partitions"
+    output_directory = background_writer.get_temporary_path(partition_directory) if replace else partition_directory
+
+    data_df = data_df.reset_index()
+    keys = [key for key in partition_keys if key in data_df.columns]
+
+    if len(keys) > 0 and len(data_df) > 0:
+        for values, partition_df in data_df.groupby(keys, sort = True, dropna = False):
+            path = get_partition_path(output_directory, keys, values)
+            path.mkdir(parents = True, exist_ok = True)
+            background_writer.write_csv(path / "all_data.csv", partition_df, index = False)
+    else:
+        output_directory.mkdir(parents = True, exist_ok = True)
+        background_writer.write_csv(output_directory / "all_data.csv", data_df, index = False)
+
+    if replace:
+        old_directory = background_writer.get_temporary_path(partition_directory)
+        if partition_directory.exists():
+            os.rename(partition_directory, old_directory)
+        if output_directory.exists():
+            os.rename(output_directory, partition_directory)
+        if old_directory.exists():
+            shutil.rmtree(old_directory)
+
+def _partition_sort_key(partition: dict):
+    # Numeric values (i.e. the run numbers) are sorted as numbers
+    return tuple((0, int(value), "") if value.lstrip("-").isdigit() else (1, 0, value) for key, value in partition.items() if key != "path")
+
+def list_partitions(data_directory: Path):
+    # Returns a list with a dictionary for each partition, with the partition key values (as strings) and its path
+    partition_directory = data_directory / "partitions"
+    if not partition_directory.is_dir():
+        return None
+
+    partitions = []
+    for data_file in partition_directory.rglob("all_data.csv"):
+        partition = {}
+        for part in data_file.parent.relative_to(partition_directory).parts:
+            key, value = part.split("=", 1)
+            partition[key] = urllib.parse.unquote(value)
+        partition["path"] = data_file
+        partitions += [partition]
+    return sorted(partitions, key = _partition_sort_key)
+
+def get_data_files(data_directory: Path):
+    # The csv files with the data of a run: the partitions of the joined runs, or all_data.csv of the assays
+    # (and of the runs joined before the joined data was only written as partitions)
+    partitions = list_partitions(data_directory)
+    if partitions is None:
+        return [data_directory / "all_data.csv"]
+    return [partition["path"] for partition in partitions]
+
+def has_data(data_directory: Path):
+    return (data_directory / "all_data.csv").is_file() or (data_directory / "partitions").is_dir()
+
+def read_data_columns(data_directory: Path):
+    return list(pandas.read_csv(get_data_files(data_directory)[0], nrows = 0).columns)
+
+def iter_data_chunks(
+                        data_directory: Path,
+                        chunk_rows: int,
+                        **read_csv_kwargs,
+                        ):
+    # Read all the data of a run, a chunk of at most chunk_rows rows at a time
+    for data_file in get_data_files(data_directory):
+        for chunk_df in pandas.read_csv(data_file, chunksize = chunk_rows, **read_csv_kwargs):
+            progress.count("rows", len(chunk_df))
+            yield chunk_df
+        progress.count("bytes_read", data_file.stat().st_size)
+
+def read_partitioned_data(
+                            data_directory: Path,
+                            filters: dict = None,
+                            partitions: list[dict] = None,
+                            **read_csv_kwargs,
+                            ):
+    # Read only the partitions matching the filters on the partition keys, falling back to reading
+    # and filtering all_data.csv when the data was not written with partitions
+    # The partitions can be given when they were already listed, i.e. to read them a group at a time
+    if filters is None:
+        filters = {}
+    if partitions is None:
+        partitions = list_partitions(data_directory)
+    if partitions is None:
+        data_df = pandas.read_csv(data_directory / "all_data.csv", **read_csv_kwargs)
+        progress.count_read(len(data_df), data_directory / "all_data.csv")
+        for key, value in filters.items():
+            data_df = data_df.loc[data_df[key].astype(str) == str(value)]
+        return data_df
+
+    partition_dfs = []
+    for partition in partitions:
+        if any(key in partition and partition[key] != str(value) for key, value in filters.items()):
+            continue
+        partition_df = pandas.read_csv(partition["path"], **read_csv_kwargs)
+        progress.count_read(len(partition_df), partition["path"])
+        for key, value in filters.items():
+            if key not in partition:
+                partition_df = partition_df.loc[partition_df[key].astype(str) == str(value)]
+        partition_dfs += [partition_df]
+
+    if len(partition_dfs) == 0:
+        return pandas.read_csv(partitions[0]["path"], nrows = 0, **read_csv_kwargs)
+    return pandas.concat(partition_dfs, ignore_index = True)
+
+# Where the plots load plotly.js and MathJax from, either 'cdn', False (not loaded) or the path of a local copy
+plot_assets = {
+    "plotlyjs": 'cdn',
+    "mathjax": 'cdn',
+}
+plot_assets_directory_name = "plot_assets"
+
+def setup_offline_plot_assets(
+                                output_path: Path,
+                                logger: logging.Logger,
+                                mathjax_path: Path = None,
+                                ):
+    # A single copy of plotly.js is written in the output tree and every plot references it with a relative path
+    import plotly
+    import plotly.offline
+
+    assets_directory = output_path / plot_assets_directory_name
+    assets_directory.mkdir(exist_ok = True)
+    plotlyjs_file = assets_directory / f'plotly-{plotly.__version__}.min.js'
+    if not plotlyjs_file.is_file():
+        temporary_file = plotlyjs_file.with_suffix(".tmp")
+        temporary_file.write_text(plotly.offline.get_plotlyjs(), encoding = "utf8")
+        temporary_file.replace(plotlyjs_file)
+    plot_assets["plotlyjs"] = plotlyjs_file
+
+    # MathJax loads its extensions from its own directory, so the local installation is referenced instead of copied
+    if mathjax_path is not None:
+        plot_assets["mathjax"] = mathjax_path.absolute()
+    else:
+        logger.warning("No local MathJax was given, the LaTeX in the plot labels will not be rendered")
+        plot_assets["mathjax"] = False
+
+def get_asset_reference(asset, path: Path):
+    if isinstance(asset, Path):
+        return Path(os.path.relpath(asset, path.parent)).as_posix()
+    return asset
+
+def write_figure(fig, path: Path, full_html: bool):
+    # The plots of a preview are labelled as made from a sample of the mitochondria
+    if preview.get_preview() is not None:
+        fig.add_annotation(
+            text = preview.get_preview_label(),
+            xref = "paper",
+            yref = "paper",
+            x = 1,
+            y = 1.08,
+            xanchor = "right",
+            showarrow = False,
+            font = {"color": "firebrick"},
+        )
+    progress.count("figures")
+    # The html is serialized here and written by the background writer of the task, if there is one
+    background_writer.write_output(
+        path,
+        fig.to_html(
+            full_html = full_html,
+            include_plotlyjs = get_asset_reference(plot_assets["plotlyjs"], path),
+            include_mathjax = get_asset_reference(plot_assets["mathjax"], path),
+        ),
+    )
+
+# Colors and patterns of the groups in the figures made from streamed data, following the plotly express defaults
+group_colors = ["#636efa", "#EF553B", "#00cc96", "#ab63fa", "#FFA15A", "#19d3f3", "#FF6692", "#B6E880", "#FF97FF", "#FECB52"]
+group_patterns = ["", "/", "\\", "x", "-", "|", "+", "."]
+
+def get_group_styles(groups: list[tuple], group_var: str, pattern_shape_var: str):
+    # Returns the name, color and pattern of each group, the color given by the group_var value and the pattern by the pattern_shape_var value
+    color_values = sorted({str(group[0]) for group in groups}) if group_var is not None else []
+    pattern_values = sorted({str(group[-1]) for group in groups}) if pattern_shape_var is not None else []
+    styles = {}
+    for group in groups:
+        color = group_colors[color_values.index(str(group[0])) % len(group_colors)] if group_var is not None else group_colors[0]
+        pattern = group_patterns[pattern_values.index(str(group[-1])) % len(group_patterns)] if pattern_shape_var is not None else ""
+        styles[group] = (", ".join(str(value) for value in group), color, pattern)
+    return styles
+
+def make_binned_histogram_figure(
+    data: streaming_summary.StreamedData,
+    x_var: str,
+    hist_type: str,
+    group_var: str = None,
+    pattern_shape_var: str = None,
+    marginal_type: str = None,
+    logy: bool = False,
+    opacity: float = 1,
+    range_x: list[float] = None,
+    ):
+    import plotly.graph_objects as go
+
+    group_vars = [var for var in [group_var, pattern_shape_var] if var is not None]
+    edges = data.edges[x_var]
+    histograms = data.get_histograms(x_var, group_vars)
+    sketches = data.get_sketches(x_var, group_vars)
+    styles = get_group_styles(list(histograms), group_var, pattern_shape_var)
+
+    fig = go.Figure()
+    for group, counts in histograms.items():
+        name, color, pattern = styles[group]
+        y = counts
+        if hist_type == "pdf":
+            y = counts / max(counts.sum(), 1)
+        fig.add_trace(go.Bar(
+            x = (edges[:-1] + edges[1:]) / 2,
+            y = y,
+            width = numpy.diff(edges),
+            name = name,
+            legendgroup = name,
+            showlegend = len(group_vars) > 0,
+            opacity = opacity,
+            marker = dict(color = color, pattern_shape = pattern),
+        ))
+
+        # The marginal is drawn above the histogram, as done by plotly express
+        if marginal_type is None or sketches[group].count == 0:
+            continue
+        marginal_options = dict(name = name, legendgroup = name, showlegend = False, marker_color = color, xaxis = "x2", yaxis = "y2")
+        if marginal_type == "box":
+            statistics = streaming_summary.get_box_statistics(sketches[group])
+            fig.add_trace(go.Box(
+                y = [name],
+                orientation = "h",
+                **{key: [value] for key, value in statistics.items() if key != "notchspan"},
+                **marginal_options,
+            ))
+        elif marginal_type == "violin":
+            fig.add_trace(go.Violin(x = data.get_sample_values(x_var, group_vars, group), **marginal_options))
+        elif marginal_type == "rug":
+            fig.add_trace(go.Box(
+                x = data.get_sample_values(x_var, group_vars, group),
+                boxpoints = "all",
+                jitter = 0,
+                fillcolor = "rgba(255,255,255,0)",
+                line_color = "rgba(255,255,255,0)",
+                marker_symbol = "line-ns-open",
+                **marginal_options,
+            ))
+
+    fig.update_layout(
+        barmode = "overlay",
+        bargap = 0,
+        legend_title_text = ", ".join(group_vars),
+        xaxis = dict(range = range_x),
+    )
+    if logy:
+        fig.update_layout(yaxis_type = "log")
+    if marginal_type is not None:
+        fig.update_layout(
+            yaxis = dict(domain = [0, 0.74]),
+            xaxis2 = dict(matches = "x", showticklabels = False),
+            yaxis2 = dict(domain = [0.76, 1], anchor = "x2", showticklabels = False),
+        )
+
+    return fig
+
+def make_summarised_box_figure(
+    data: streaming_summary.StreamedData,
+    x_var: str,
+    group_var: str = None,
+    pattern_shape_var: str = None,
+    range_x: list[float] = None,
+    ):
+    import plotly.graph_objects as go
+
+    group_vars = [var for var in [group_var, pattern_shape_var] if var is not None]
+    sketches = data.get_sketches(x_var, group_vars)
+    styles = get_group_styles(list(sketches), group_var, None)
+
+    # One trace per color, with a box for each pattern_shape_var value along the y axis
+    traces = {}
+    for group, sketch in sketches.items():
+        if sketch.count == 0:
+            continue
+        name, color, _ = styles[group]
+        if pattern_shape_var is not None:
+            name = ", ".join(str(value) for value in group[:-1]) if group_var is not None else x_var
+        trace = traces.setdefault(name, {"color": color, "y": [], "statistics": {}})
+        trace["y"] += [str(group[-1]) if pattern_shape_var is not None else ""]
+        for key, value in streaming_summary.get_box_statistics(sketch).items():
+            trace["statistics"].setdefault(key, []).append(value)
+
+    fig = go.Figure()
+    for name, trace in traces.items():
+        fig.add_trace(go.Box(
+            y = trace["y"],
+            orientation = "h",
+            name = name,
+            notched = True,
+            marker_color = trace["color"],
+            showlegend = group_var is not None,
+            **trace["statistics"],
+        ))
+
+    fig.update_layout(
+        boxmode = "group",
+        legend_title_text = group_var,
+        xaxis = dict(range = range_x),
+        yaxis_title = pattern_shape_var,
+    )
+    return fig
+
 def make_multiscatter_plot(
     data_df:pandas.DataFrame,
     run_name: str,
@@ -137,6 +459,20 @@ def make_multiscatter_plot(
     marker_size: float = 2,
     ):
 
+    # Only the dimensions selected by the plot spec are plotted
+    selected_dimensions = plot_spec.filter_dimensions(dimensions, [color_var, symbol_var])
+    if len(selected_dimensions) == 0 or (len(selected_dimensions) < 2 and len(selected_dimensions) < len(dimensions)):
+        return
+    dimensions = selected_dimensions
+
+    # Streamed data is too large to plot every point, a random sample of the rows is plotted instead
+    if isinstance(data_df, streaming_summary.StreamedData):
+        extra_title = f'{extra_title}<br>{data_df.get_sample_title()}'
+        data_df = data_df.sample
+
+    # Plotly is only imported when a plot is made, so data only runs do not pay for the import
+    import plotly.express as px
+
     fig = px.scatter_matrix(
         data_df,
         dimensions = sorted(dimensions),
@@ -174,12 +510,7 @@ def make_multiscatter_plot(
     #fig.update_layout({"yaxis{}".format(i+1): dict(title = labels[dimensions[i]], tickangle = -45) for i in range(len(labels))})
     fig.update_layout(legend= {'itemsizing': 'constant'})
 
-    fig.write_html(
-        base_path/f'{file_name}.html',
-        full_html = full_html,
-        include_plotlyjs = 'cdn',
-        include_mathjax = 'cdn',
-    )
+    write_figure(fig, base_path/f'{file_name}.html', full_html)
 
 def make_histogram_plot(
     data_df: pandas.DataFrame,
@@ -273,6 +604,8 @@ def make_histogram_plot_type_choice(
     ):
     if hist_type not in ["count", "pdf"]:
         raise RuntimeError("Unknown histogram type")
+    if not plot_spec.is_wanted("histogram" if hist_type == "count" else "pdf", x_var, [group_var, pattern_shape_var]):
+        return
 
     if extra_title != "":
         extra_title = "<br>" + extra_title
@@ -296,24 +629,42 @@ def make_histogram_plot_type_choice(
     if min_x is not None and max_x is not None:
         range_x = [min_x, max_x]
 
-    fig = px.histogram(
-        data_frame = data_df,
-        x = x_var,
-        nbins = nbins,
-        opacity = opacity,
-        log_y = logy,
-        labels = labels,
-        range_x = range_x,
-        color = group_var,
-        barmode = "overlay",
-        marginal = marginal_type,
-        facet_col = facet_col_var,
-        facet_col_wrap = facet_col_wrap,
-        facet_row = facet_row_var,
-        #facet_row_wrap = facet_row_wrap,
-        pattern_shape = pattern_shape_var,
-        histnorm = histnorm,
-    )
+    if isinstance(data_df, streaming_summary.StreamedData):
+        # The bins of streamed data are fixed when it is read, so nbins is not used
+        if facet_col_var is not None or facet_row_var is not None:
+            raise RuntimeError("Facets are not supported for streamed data")
+        fig = make_binned_histogram_figure(
+            data = data_df,
+            x_var = x_var,
+            hist_type = hist_type,
+            group_var = group_var,
+            pattern_shape_var = pattern_shape_var,
+            marginal_type = marginal_type,
+            logy = logy,
+            opacity = opacity,
+            range_x = range_x,
+        )
+    else:
+        import plotly.express as px
+
+        fig = px.histogram(
+            data_frame = data_df,
+            x = x_var,
+            nbins = nbins,
+            opacity = opacity,
+            log_y = logy,
+            labels = labels,
+            range_x = range_x,
+            color = group_var,
+            barmode = "overlay",
+            marginal = marginal_type,
+            facet_col = facet_col_var,
+            facet_col_wrap = facet_col_wrap,
+            facet_row = facet_row_var,
+            #facet_row_wrap = facet_row_wrap,
+            pattern_shape = pattern_shape_var,
+            histnorm = histnorm,
+        )
 
     fig.update_layout(
         title_text="Histogram of {}<br><sup>Run: {}{}</sup>".format(x_var, run_name, extra_title),
@@ -326,12 +677,7 @@ def make_histogram_plot_type_choice(
             xaxis_title=x_label,
         )
 
-    fig.write_html(
-        base_path/'{}.html'.format(file_name),
-        full_html = full_html,
-        include_plotlyjs = 'cdn',
-        include_mathjax = 'cdn',
-    )
+    write_figure(fig, base_path/'{}.html'.format(file_name), full_html)
 
 def make_box_plot(
     data_df: pandas.DataFrame,
@@ -351,6 +697,9 @@ def make_box_plot(
     max_x: float = None,
     extra_title: str = "",
     ):
+    if not plot_spec.is_wanted("box", x_var, [group_var, pattern_shape_var]):
+        return
+
     if extra_title != "":
         extra_title = "<br>" + extra_title
 
@@ -358,17 +707,31 @@ def make_box_plot(
     if min_x is not None and max_x is not None:
         range_x = [min_x, max_x]
 
-    fig = px.box(
-        data_frame = data_df,
-        x = x_var,
-        y = pattern_shape_var,
-        color = group_var,
-        notched = True,
-        facet_col = facet_col_var,
-        facet_col_wrap = facet_col_wrap,
-        facet_row = facet_row_var,
-        range_x = range_x,
-    )
+    if isinstance(data_df, (streaming_summary.StreamedData, aggregate_cube.CubeData)):
+        # The boxes of streamed data and of aggregate cubes are drawn from the quantile sketches
+        if facet_col_var is not None or facet_row_var is not None:
+            raise RuntimeError("Facets are not supported for streamed data")
+        fig = make_summarised_box_figure(
+            data = data_df,
+            x_var = x_var,
+            group_var = group_var,
+            pattern_shape_var = pattern_shape_var,
+            range_x = range_x,
+        )
+    else:
+        import plotly.express as px
+
+        fig = px.box(
+            data_frame = data_df,
+            x = x_var,
+            y = pattern_shape_var,
+            color = group_var,
+            notched = True,
+            facet_col = facet_col_var,
+            facet_col_wrap = facet_col_wrap,
+            facet_row = facet_row_var,
+            range_x = range_x,
+        )
 
     fig.update_layout(
         title_text="Box plot of {}<br><sup>Run: {}{}</sup>".format(x_var, run_name, extra_title),
@@ -380,12 +743,7 @@ def make_box_plot(
             xaxis_title=x_label,
         )
 
-    fig.write_html(
-        base_path/'{}_box.html'.format(file_name),
-        full_html = full_html,
-        include_plotlyjs = 'cdn',
-        include_mathjax = 'cdn',
-    )
+    write_figure(fig, base_path/'{}_box.html'.format(file_name), full_html)
 
 def make_violin_plot(
     data_df: pandas.DataFrame,
@@ -405,6 +763,14 @@ def make_violin_plot(
     max_x: float = None,
     extra_title: str = "",
     ):
+    if not plot_spec.is_wanted("violin", x_var, [group_var, pattern_shape_var]):
+        return
+
+    # Streamed data is too large to plot every point, the violins are made from a random sample of the rows
+    if isinstance(data_df, streaming_summary.StreamedData):
+        extra_title = data_df.get_sample_title() if extra_title == "" else f'{extra_title} - {data_df.get_sample_title()}'
+        data_df = data_df.sample
+
     if extra_title != "":
         extra_title = "<br>" + extra_title
 
@@ -412,6 +778,8 @@ def make_violin_plot(
     if min_x is not None and max_x is not None:
         range_x = [min_x, max_x]
 
+    import plotly.express as px
+
     fig = px.violin(
         data_frame = data_df,
         x = x_var,
@@ -433,12 +801,7 @@ def make_violin_plot(
             xaxis_title=x_label,
         )
 
-    fig.write_html(
-        base_path/'{}_violin.html'.format(file_name),
-        full_html = full_html,
-        include_plotlyjs = 'cdn',
-        include_mathjax = 'cdn',
-    )
+    write_figure(fig, base_path/'{}_violin.html'.format(file_name), full_html)
 
 if __name__ == "__main__":
     raise RuntimeError("Do not try to run this file, it is not a standalone script. It contains several common utilities used by the other scripts")
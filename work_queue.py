@@ -0,0 +1,454 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+from pathlib import Path
+import logging
+import threading
+import traceback
+import subprocess
+import socket
+import shutil
+import uuid
+import json
+import time
+import sys
+import os
+
+# Work queue kept in a directory on a shared filesystem, so the assays can be read by workers on several nodes
+# without a broker. Only file creation with O_EXCL and renames are used for synchronisation, as both are atomic
+# on network filesystems (unlike the locks SQLite relies on):
+#  - jobs/<id>.json      the job, written by the coordinator, the published file marks the end of the publishing
+#  - claims/<id>.json    created exclusively by the worker running the job, its mtime is the lease which the
+#                        worker renews while the job runs, claims older than the lease time are taken over
+#  - failed/<id>.json    the number of failed attempts and their errors, jobs are retried up to max_attempts
+#  - done/<id>.json      written when the job completed
+default_lease_time = 300
+default_max_attempts = 3
+default_poll_interval = 5
+
+published_name = "published"
+
+def _write_json_atomic(path: Path, data: dict):
+    temporary_file = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+    with open(temporary_file, 'w') as json_file:
+        json.dump(data, json_file, indent = 2)
+    os.replace(temporary_file, path)
+
+def _read_json(path: Path):
+    try:
+        with open(path, 'r') as json_file:
+            return json.load(json_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def create_queue(queue_directory: Path):
+    if queue_directory.exists():
+        shutil.rmtree(queue_directory)
+    for directory in ["jobs", "claims", "failed", "done"]:
+        (queue_directory / directory).mkdir(parents = True)
+
+def publish_job(queue_directory: Path, job_id: str, job: dict):
+    _write_json_atomic(queue_directory / "jobs" / f'{job_id}.json', {"id": job_id, **job})
+
+def close_queue(queue_directory: Path):
+    (queue_directory / published_name).touch()
+
+def get_attempts(queue_directory: Path, job_id: str):
+    failures = _read_json(queue_directory / "failed" / f'{job_id}.json')
+    if failures is None:
+        return 0
+    return failures["attempts"]
+
+def get_queue_status(
+                        queue_directory: Path,
+                        max_attempts: int = default_max_attempts,
+                        ):
+    # Lists of the job ids which are done, given up after max_attempts failures, claimed and waiting
+    status = {"done": [], "failed": [], "claimed": [], "waiting": []}
+    for job_file in sorted((queue_directory / "jobs").glob("*.json")):
+        job_id = job_file.stem
+        if (queue_directory / "done" / f'{job_id}.json').exists():
+            status["done"] += [job_id]
+        elif get_attempts(queue_directory, job_id) >= max_attempts:
+            status["failed"] += [job_id]
+        elif (queue_directory / "claims" / f'{job_id}.json').exists():
+            status["claimed"] += [job_id]
+        else:
+            status["waiting"] += [job_id]
+    return status
+
+def is_finished(queue_directory: Path, status: dict):
+    return (queue_directory / published_name).exists() and len(status["claimed"]) == 0 and len(status["waiting"]) == 0
+
+def record_failure(
+                    queue_directory: Path,
+                    job_id: str,
+                    error: str,
+                    ):
+    failures = _read_json(queue_directory / "failed" / f'{job_id}.json')
+    if failures is None:
+        failures = {"attempts": 0, "errors": []}
+    failures["attempts"] += 1
+    failures["errors"] += [error]
+    _write_json_atomic(queue_directory / "failed" / f'{job_id}.json', failures)
+
+def give_up_job(
+                queue_directory: Path,
+                job_id: str,
+                error: str,
+                max_attempts: int = default_max_attempts,
+                ):
+    # Records a failure which is not retried, i.e. when there is no worker left to run the job
+    failures = _read_json(queue_directory / "failed" / f'{job_id}.json')
+    if failures is None:
+        failures = {"attempts": 0, "errors": []}
+    failures["attempts"] = max(failures["attempts"] + 1, max_attempts)
+    failures["errors"] += [error]
+    _write_json_atomic(queue_directory / "failed" / f'{job_id}.json', failures)
+
+def _is_stale(path: Path, lease_time: float):
+    try:
+        return time.time() - os.stat(path).st_mtime > lease_time
+    except FileNotFoundError:
+        return False
+
+def _break_stale_claim(
+                        queue_directory: Path,
+                        job_id: str,
+                        worker_id: str,
+                        lease_time: float,
+                        logger: logging.Logger,
+                        ):
+    # The claim is renamed away, only one of the workers trying to break it succeeds
+    claim_file = queue_directory / "claims" / f'{job_id}.json'
+    stale_file = claim_file.with_name(f'{job_id}.stale-{worker_id}')
+    try:
+        os.rename(claim_file, stale_file)
+    except FileNotFoundError:
+        return
+
+    # Another worker may have broken the stale claim and claimed the job in the meantime, that claim is put back
+    if not _is_stale(stale_file, lease_time):
+        try:
+            os.link(stale_file, claim_file)
+        except FileExistsError:
+            pass
+        stale_file.unlink()
+        return
+
+    stale_claim = _read_json(stale_file)
+    stale_file.unlink()
+    stale_worker = stale_claim["worker"] if stale_claim is not None else "unknown"
+    logger.warning(f"The lease of worker {stale_worker} on job {job_id} expired, the job will be retried")
+    record_failure(queue_directory, job_id, f"The lease of worker {stale_worker} expired")
+
+def break_stale_claims(
+                        queue_directory: Path,
+                        worker_id: str,
+                        lease_time: float = default_lease_time,
+                        max_attempts: int = default_max_attempts,
+                        logger: logging.Logger = None,
+                        ):
+    # The jobs of the workers which died are retried (or given up after max_attempts)
+    if logger is None:
+        logger = logging.getLogger('work_queue')
+
+    status = get_queue_status(queue_directory, max_attempts)
+    for job_id in status["claimed"]:
+        if _is_stale(queue_directory / "claims" / f'{job_id}.json', lease_time):
+            _break_stale_claim(queue_directory, job_id, worker_id, lease_time, logger)
+
+def claim_job(
+                queue_directory: Path,
+                worker_id: str,
+                lease_time: float = default_lease_time,
+                max_attempts: int = default_max_attempts,
+                logger: logging.Logger = None,
+                ):
+    # Returns the first job which could be claimed, or None if there is none
+    break_stale_claims(queue_directory, worker_id, lease_time, max_attempts, logger)
+
+    status = get_queue_status(queue_directory, max_attempts)
+    for job_id in status["waiting"]:
+        claim_file = queue_directory / "claims" / f'{job_id}.json'
+        try:
+            claim_descriptor = os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue
+        with os.fdopen(claim_descriptor, 'w') as json_file:
+            json.dump({
+                "worker": worker_id,
+                "attempt": get_attempts(queue_directory, job_id) + 1,
+                "claimed": time.time(),
+            }, json_file)
+
+        # The job may have finished between listing the queue and claiming it
+        if (queue_directory / "done" / f'{job_id}.json').exists():
+            claim_file.unlink()
+            continue
+
+        return _read_json(queue_directory / "jobs" / f'{job_id}.json')
+    return None
+
+def owns_claim(queue_directory: Path, job_id: str, worker_id: str):
+    claim = _read_json(queue_directory / "claims" / f'{job_id}.json')
+    return claim is not None and claim["worker"] == worker_id
+
+def release_claim(queue_directory: Path, job_id: str, worker_id: str):
+    if owns_claim(queue_directory, job_id, worker_id):
+        (queue_directory / "claims" / f'{job_id}.json').unlink()
+
+class LeaseKeeper(threading.Thread):
+    # Renews the lease of a claim (the mtime of the claim file) while the job runs
+    def __init__(
+                    self,
+                    queue_directory: Path,
+                    job_id: str,
+                    worker_id: str,
+                    lease_time: float,
+                    logger: logging.Logger,
+                    ):
+        super().__init__(daemon = True)
+        self.queue_directory = queue_directory
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.lease_time = lease_time
+        self.logger = logger
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.lease_time / 3):
+            if not owns_claim(self.queue_directory, self.job_id, self.worker_id):
+                self.logger.warning(f"Worker {self.worker_id} lost the claim on job {self.job_id}")
+                return
+            os.utime(self.queue_directory / "claims" / f'{self.job_id}.json')
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def get_plot_assets():
+    # The plot assets of the coordinator, so the workers make the plots in the same way
+    import utilities
+    return {name: {"path": str(asset)} if isinstance(asset, Path) else {"value": asset} for name, asset in utilities.plot_assets.items()}
+
+def set_plot_assets(plot_assets: dict):
+    import utilities
+    for name, asset in plot_assets.items():
+        utilities.plot_assets[name] = Path(asset["path"]) if "path" in asset else asset["value"]
+
+def run_job(job: dict):
+    # Jobs read a single assay, the job has the arguments of read_mitometer_file.script_main and the catalog node of
+    # the assay, so the assays inside archives are read without scanning their (archive member) path again
+    from read_mitometer_file import script_main as read_mitometer_file
+    import plot_spec
+    import preview
+    import progress
+
+    set_plot_assets(job["plot_assets"])
+    plot_spec.set_plot_spec(job["plot_spec"])
+    preview_settings = job.get("preview")
+    if preview_settings is None:
+        preview.set_preview(None)
+    else:
+        preview.set_preview(preview_settings["rows"], preview_settings["seed"])
+    progress.set_report_interval(job.get("progress_interval"))
+    read_mitometer_file(
+        mitometer_path = Path(job["mitometer_path"]),
+        run_name = job["run_name"],
+        output_path = Path(job["output_path"]),
+        marginal_type = job["marginal_type"],
+        disable_plots = job["disable_plots"],
+        memory_budget = job["memory_budget"],
+        catalog = job.get("catalog"),
+    )
+
+def run_worker(
+                queue_directory: Path,
+                logger: logging.Logger,
+                lease_time: float = default_lease_time,
+                max_attempts: int = default_max_attempts,
+                poll_interval: float = default_poll_interval,
+                ):
+    # Claims and runs jobs until all the published jobs are done or have failed too many times
+    worker_id = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+    logger.info(f"Worker {worker_id} processing the queue in {queue_directory}")
+
+    while True:
+        job = claim_job(queue_directory, worker_id, lease_time, max_attempts, logger)
+        if job is None:
+            if is_finished(queue_directory, get_queue_status(queue_directory, max_attempts)):
+                break
+            time.sleep(poll_interval)
+            continue
+
+        job_id = job["id"]
+        logger.info(f"Worker {worker_id} running job {job_id}")
+        lease_keeper = LeaseKeeper(queue_directory, job_id, worker_id, lease_time, logger)
+        lease_keeper.start()
+        try:
+            run_job(job)
+        except Exception:
+            lease_keeper.stop()
+            logger.error(f"Job {job_id} failed on worker {worker_id}")
+            record_failure(queue_directory, job_id, traceback.format_exc())
+            release_claim(queue_directory, job_id, worker_id)
+            continue
+        lease_keeper.stop()
+
+        _write_json_atomic(queue_directory / "done" / f'{job_id}.json', {"worker": worker_id, "finished": time.time()})
+        release_claim(queue_directory, job_id, worker_id)
+
+    logger.info(f"Worker {worker_id} finished, there are no jobs left")
+
+def start_local_workers(
+                        queue_directory: Path,
+                        workers: int,
+                        lease_time: float = default_lease_time,
+                        max_attempts: int = default_max_attempts,
+                        poll_interval: float = default_poll_interval,
+                        ):
+    command = [
+        sys.executable, str(Path(__file__).absolute()),
+        "--queue", str(queue_directory),
+        "--leaseTime", str(lease_time),
+        "--maxAttempts", str(max_attempts),
+        "--pollInterval", str(poll_interval),
+    ]
+    return [subprocess.Popen(command) for _ in range(workers)]
+
+def iter_finished_jobs(
+                        queue_directory: Path,
+                        max_attempts: int = default_max_attempts,
+                        poll_interval: float = default_poll_interval,
+                        lease_time: float = default_lease_time,
+                        local_workers: list[subprocess.Popen] = None,
+                        logger: logging.Logger = None,
+                        ):
+    # Yields the id of each job and whether it was done, as the jobs are done or fail too many times, until all the
+    # jobs are finished. The claims of dead workers are broken here too, so the jobs are retried even if no other
+    # worker is polling the queue, and if all the local workers exited the jobs left waiting are given up
+    if logger is None:
+        logger = logging.getLogger('work_queue')
+    coordinator_id = f'{socket.gethostname()}-{os.getpid()}-coordinator'
+
+    seen = set()
+    while True:
+        break_stale_claims(queue_directory, coordinator_id, lease_time, max_attempts, logger)
+        status = get_queue_status(queue_directory, max_attempts)
+
+        if not is_finished(queue_directory, status) and local_workers and len(status["claimed"]) == 0:
+            if all(worker.poll() is not None for worker in local_workers):
+                for job_id in status["waiting"]:
+                    logger.error(f"All the local workers exited, job {job_id} is not run")
+                    give_up_job(queue_directory, job_id, "All the local workers exited before running the job", max_attempts)
+                status = get_queue_status(queue_directory, max_attempts)
+
+        for job_id in status["done"] + status["failed"]:
+            if job_id not in seen:
+                seen.add(job_id)
+                yield job_id, job_id in status["done"]
+        if is_finished(queue_directory, status):
+            return
+        time.sleep(poll_interval)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+                    prog='work_queue.py',
+                    description='This script runs a worker processing the assay jobs of a process_all_assays.py run with --distributed. Start as many as desired, on any node with access to the output directory',
+                    #epilog='Text at the bottom of help'
+                    )
+
+    parser.add_argument(
+        '-q',
+        '--queue',
+        metavar = 'PATH',
+        type = Path,
+        help = 'Path to the work queue directory, the work_queue directory inside the process_all_assays.py run directory',
+        required = True,
+        dest = 'queue_directory',
+    )
+    parser.add_argument(
+        '--leaseTime',
+        metavar = 'SECONDS',
+        type = float,
+        help = 'Time without renewal after which the claim of a worker on a job is considered stale and the job is retried by another worker. Default: 300',
+        default = default_lease_time,
+        dest = 'lease_time',
+    )
+    parser.add_argument(
+        '--maxAttempts',
+        metavar = 'N',
+        type = int,
+        help = 'Number of times a job is attempted before giving up on it. Default: 3',
+        default = default_max_attempts,
+        dest = 'max_attempts',
+    )
+    parser.add_argument(
+        '--pollInterval',
+        metavar = 'SECONDS',
+        type = float,
+        help = 'Time between checks of the queue when there are no jobs to claim. Default: 5',
+        default = default_poll_interval,
+        dest = 'poll_interval',
+    )
+    parser.add_argument(
+        '-l',
+        '--log-level',
+        metavar = 'LEVEL',
+        type = str,
+        help = 'Set the logging level. Default: WARNING',
+        choices = ["CRITICAL","ERROR","WARNING","INFO","DEBUG","NOTSET"],
+        default = "WARNING",
+        dest = 'log_level',
+    )
+
+    args = parser.parse_args()
+
+    if args.log_level == "CRITICAL":
+        logging.basicConfig(level=50)
+    elif args.log_level == "ERROR":
+        logging.basicConfig(level=40)
+    elif args.log_level == "WARNING":
+        logging.basicConfig(level=30)
+    elif args.log_level == "INFO":
+        logging.basicConfig(level=20)
+    elif args.log_level == "DEBUG":
+        logging.basicConfig(level=10)
+    elif args.log_level == "NOTSET":
+        logging.basicConfig(level=0)
+
+    queue_directory: Path = args.queue_directory
+    if not queue_directory.is_dir():
+        logging.error("You must define a valid work queue path")
+        exit(1)
+
+    run_worker(
+        queue_directory = queue_directory.absolute(),
+        logger = logging.getLogger('work_queue'),
+        lease_time = args.lease_time,
+        max_attempts = args.max_attempts,
+        poll_interval = args.poll_interval,
+    )